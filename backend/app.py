@@ -26,6 +26,15 @@ async def startup_logic():
         print(f"❌ CRITICAL ERROR: Failed to run Redis-OM Migrator: {e}")
         print("   請檢查您的 Upstash 連線 URL (必須是 rediss://) 是否正確，或連線是否超時。")
 
+    try:
+        # 載入寫入路徑使用的 Lua 腳本，之後一律以 EVALSHA 呼叫
+        from database.redis_client import get_redis_client
+        from database.scripts import load_scripts
+        await load_scripts(await get_redis_client())
+    except Exception as e:
+        print(f"❌ ERROR: Failed to load Redis scripts: {e}")
+        print("   寫入時會在收到 NOSCRIPT 後自動重新載入。")
+
     print("=" * 60)
     print("✅ Application startup complete.")
     print("📡 WebSocket endpoint: ws://localhost:8000/ws/chat/{session_id}")
@@ -37,8 +46,31 @@ async def lifespan(app_instance: FastAPI):
     """應用生命週期管理"""
     # 啟動
     await startup_logic()
+
+    # 預先建立模型客戶端與連線（DNS、TLS），第一則聊天不必等待連線建立
+    from services.ai_service import close_clients, prewarm_clients
+    if settings.AI_PREWARM_ENABLED:
+        await prewarm_clients()
+
+    # 背景工作：清理過期的刪除紀錄、回收已刪除的會話、事件流投影（可改以 manage.py run-projections 獨立執行）
+    from services.deleted_store import run_retention_sweeper
+    from services.deletion_service import run_deletion_worker
+    from services.projection_service import run_projection_worker
+    background_stop = asyncio.Event()
+    background_tasks = [
+        asyncio.create_task(run_retention_sweeper(background_stop)),
+        asyncio.create_task(run_deletion_worker(background_stop)),
+    ]
+    if settings.PROJECTION_IN_APP:
+        background_tasks.append(asyncio.create_task(run_projection_worker(background_stop)))
+
     yield
-    # 關閉
+    # 關閉：工作進度都記錄在 Redis，直接取消即可，下次啟動會接續
+    background_stop.set()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await close_clients()
     # await close_redis() # ❌ 移除這個調用，讓 Redis 連線池自動關閉和清理資源
     print("=" * 60)
     print("🛑 Application shutdown complete.")
@@ -59,10 +91,11 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],  # 讓前端讀得到分頁游標與版本標記
 )
 
 # 延遲導入 routes（避免循環導入）
-from routes import sessions, messages, search, analytics, websocket
+from routes import sessions, messages, search, analytics, websocket, backup, ai
 
 # 註冊路由
 app.include_router(sessions.router)
@@ -70,6 +103,8 @@ app.include_router(messages.router)
 app.include_router(search.router)
 app.include_router(analytics.router)
 app.include_router(websocket.router)
+app.include_router(backup.router)
+app.include_router(ai.router)
 
 # Root 端點
 @app.get("/", tags=["Root"])
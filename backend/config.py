@@ -21,8 +21,123 @@ class Settings:
     AZURE_OPENAI_MODEL: str = os.getenv("AZURE_OPENAI_MODEL", "gpt-4o")
     
     # 業務邏輯配置
-    DELETE_RECORD_RETENTION_DAYS: int = 30
+    DELETE_RECORD_RETENTION_DAYS: int = int(os.getenv("DELETE_RECORD_RETENTION_DAYS", "30"))
     DELETE_RECORD_RETENTION_SECONDS: int = DELETE_RECORD_RETENTION_DAYS * 24 * 60 * 60
+    # 過期刪除紀錄的背景清理間隔（秒）
+    DELETED_SWEEP_INTERVAL_SECONDS: int = int(os.getenv("DELETED_SWEEP_INTERVAL_SECONDS", "3600"))
+    
+    # 會話列表每頁筆數（側邊欄；以 X-Next-Cursor 取得下一頁）
+    SESSION_PAGE_SIZE: int = int(os.getenv("SESSION_PAGE_SIZE", "200"))
+    SESSION_PAGE_SIZE_MAX: int = int(os.getenv("SESSION_PAGE_SIZE_MAX", "1000"))
+    # 會話列表中最後一則訊息的預覽長度（UTF-8 bytes，中文約 3 bytes/字）
+    SESSION_PREVIEW_BYTES: int = int(os.getenv("SESSION_PREVIEW_BYTES", "120"))
+    
+    # 背景刪除會話：每批回收的訊息數與沒有工作時的輪詢間隔（秒）
+    DELETION_BATCH_SIZE: int = int(os.getenv("DELETION_BATCH_SIZE", "500"))
+    DELETION_POLL_SECONDS: float = float(os.getenv("DELETION_POLL_SECONDS", "2"))
+    # 回收工作連續失敗幾次後標記為 failed（移出佇列，不再阻擋後面的工作；以 retry-deletion-jobs 重新排入）
+    DELETION_MAX_ATTEMPTS: int = int(os.getenv("DELETION_MAX_ATTEMPTS", "5"))
+
+    # 訊息事件流（chat_stream）：分區方式 none / session / day，以及保留策略
+    # STREAM_RETENTION_SECONDS > 0 時以 MINID 依時間修剪（優先），否則以 STREAM_MAXLEN 限制長度；兩者皆為 0 表示不修剪
+    STREAM_PARTITION: str = os.getenv("STREAM_PARTITION", "none")
+    STREAM_MAXLEN: int = int(os.getenv("STREAM_MAXLEN", "100000"))
+    STREAM_RETENTION_SECONDS: int = int(os.getenv("STREAM_RETENTION_SECONDS", "0"))
+    STREAM_WINDOW_MAX: int = int(os.getenv("STREAM_WINDOW_MAX", "1000"))
+
+    # 事件流投影（消費者群組）：是否在 API 程序內執行、群組 / 消費者名稱、每批筆數、阻塞時間與接手閒置事件的門檻
+    PROJECTION_IN_APP: bool = os.getenv("PROJECTION_IN_APP", "true").lower() == "true"
+    PROJECTION_GROUP: str = os.getenv("PROJECTION_GROUP", "projections")
+    PROJECTION_CONSUMER: str = os.getenv("PROJECTION_CONSUMER", "")
+    PROJECTION_BATCH_SIZE: int = int(os.getenv("PROJECTION_BATCH_SIZE", "200"))
+    PROJECTION_BLOCK_MS: int = int(os.getenv("PROJECTION_BLOCK_MS", "2000"))
+    PROJECTION_CLAIM_IDLE_MS: int = int(os.getenv("PROJECTION_CLAIM_IDLE_MS", "60000"))
+
+    # 全域統計：各解析度的保留天數與單次查詢的最大點數
+    ROLLUP_MINUTE_RETENTION_DAYS: int = int(os.getenv("ROLLUP_MINUTE_RETENTION_DAYS", "7"))
+    ROLLUP_HOUR_RETENTION_DAYS: int = int(os.getenv("ROLLUP_HOUR_RETENTION_DAYS", "90"))
+    ROLLUP_DAY_RETENTION_DAYS: int = int(os.getenv("ROLLUP_DAY_RETENTION_DAYS", "1095"))
+    ROLLUP_MAX_POINTS: int = int(os.getenv("ROLLUP_MAX_POINTS", "500"))
+
+    # 不重複活躍會話 / 使用者（HyperLogLog）：小時 / 日桶保留天數、範圍合併結果的快取秒數
+    DISTINCT_HOUR_RETENTION_DAYS: int = int(os.getenv("DISTINCT_HOUR_RETENTION_DAYS", "30"))
+    DISTINCT_DAY_RETENTION_DAYS: int = int(os.getenv("DISTINCT_DAY_RETENTION_DAYS", "400"))
+    DISTINCT_MERGE_CACHE_SECONDS: int = int(os.getenv("DISTINCT_MERGE_CACHE_SECONDS", "60"))
+    
+    # 聊天歷史分頁：預設 / 最大每頁筆數
+    HISTORY_PAGE_SIZE: int = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+    HISTORY_PAGE_SIZE_MAX: int = int(os.getenv("HISTORY_PAGE_SIZE_MAX", "500"))
+    # WebSocket 連線時推送的歷史筆數（0 = 全部；前端支援往上捲動載入後可改為與 HISTORY_PAGE_SIZE 相同）
+    WS_HISTORY_LIMIT: int = int(os.getenv("WS_HISTORY_LIMIT", "0"))
+    # AI 回覆以 WebSocket 增量訊框串流（false 時等待完整回覆後一次送出）
+    AI_STREAMING: bool = os.getenv("AI_STREAMING", "true").lower() == "true"
+    
+    # AI 對話上下文：總 token 預算（系統提示 + 摘要 + 近期對話 + 本次訊息）、最多回看的訊息數、
+    # token 估算方式（auto = 有安裝 tiktoken 時使用，否則以字元估算；heuristic = 一律估算）
+    AI_CONTEXT_ENABLED: bool = os.getenv("AI_CONTEXT_ENABLED", "true").lower() == "true"
+    AI_CONTEXT_TOKEN_BUDGET: int = int(os.getenv("AI_CONTEXT_TOKEN_BUDGET", "3000"))
+    AI_CONTEXT_MAX_MESSAGES: int = int(os.getenv("AI_CONTEXT_MAX_MESSAGES", "40"))
+    AI_TOKENIZER: str = os.getenv("AI_TOKENIZER", "auto").lower()
+    AI_SYSTEM_PROMPT: str = os.getenv("AI_SYSTEM_PROMPT", "")
+    # 滾動摘要：摘要長度上限、累積多少 token 的舊對話才更新一次、單次最多併入的 token 數
+    AI_SUMMARY_MAX_TOKENS: int = int(os.getenv("AI_SUMMARY_MAX_TOKENS", "400"))
+    AI_SUMMARY_MIN_TOKENS: int = int(os.getenv("AI_SUMMARY_MIN_TOKENS", "300"))
+    AI_SUMMARY_BATCH_TOKENS: int = int(os.getenv("AI_SUMMARY_BATCH_TOKENS", "3000"))
+    # AI 回覆快取（預設關閉）：行程內 LRU 容量與 Redis TTL（秒）
+    AI_CACHE_ENABLED: bool = os.getenv("AI_CACHE_ENABLED", "false").lower() == "true"
+    AI_CACHE_SIZE: int = int(os.getenv("AI_CACHE_SIZE", "256"))
+    AI_CACHE_TTL_SECONDS: int = int(os.getenv("AI_CACHE_TTL_SECONDS", "86400"))
+    # AI 請求排程：同時進行的上游呼叫數、每分鐘 token 預算（0 = 不限制，設為部署的 TPM 配額）、
+    # 排隊等待上限（秒）、可重試錯誤（429 / 5xx / 連線）的重試次數與退避秒數
+    AI_MAX_CONCURRENCY: int = int(os.getenv("AI_MAX_CONCURRENCY", "8"))
+    AI_TOKENS_PER_MINUTE: int = int(os.getenv("AI_TOKENS_PER_MINUTE", "0"))
+    AI_QUEUE_TIMEOUT_SECONDS: float = float(os.getenv("AI_QUEUE_TIMEOUT_SECONDS", "60"))
+    AI_RETRY_MAX_ATTEMPTS: int = int(os.getenv("AI_RETRY_MAX_ATTEMPTS", "3"))
+    AI_RETRY_BASE_SECONDS: float = float(os.getenv("AI_RETRY_BASE_SECONDS", "1"))
+    AI_RETRY_MAX_SECONDS: float = float(os.getenv("AI_RETRY_MAX_SECONDS", "30"))
+    # 多部署路由：AI_DEPLOYMENTS 為 JSON 陣列（未設定時只使用上方的 AZURE_OPENAI_* 部署），例如
+    # [{"name": "east", "endpoint": "https://east.openai.azure.com/", "api_key": "...", "model": "gpt-4o",
+    #   "weight": 2, "tokens_per_minute": 120000, "max_concurrency": 8}]
+    # 省略的 api_key / api_version / model 沿用 AZURE_OPENAI_* 設定
+    AI_DEPLOYMENTS: str = os.getenv("AI_DEPLOYMENTS", "")
+    # 熔斷：連續失敗次數門檻與冷卻秒數
+    AI_BREAKER_FAILURES: int = int(os.getenv("AI_BREAKER_FAILURES", "5"))
+    AI_BREAKER_COOLDOWN_SECONDS: float = float(os.getenv("AI_BREAKER_COOLDOWN_SECONDS", "30"))
+    # 對沖請求：主要部署超過其 p95 延遲（至少 AI_HEDGE_MIN_DELAY_MS）仍未回應時，向另一個部署送出同一請求
+    AI_HEDGE_ENABLED: bool = os.getenv("AI_HEDGE_ENABLED", "false").lower() == "true"
+    AI_HEDGE_MIN_DELAY_MS: int = int(os.getenv("AI_HEDGE_MIN_DELAY_MS", "1500"))
+    # 模型呼叫共用的 HTTP 連線池：HTTP/2（需安裝 h2）、連線數上限、保留的閒置連線數與閒置秒數、逾時秒數
+    AI_HTTP2_ENABLED: bool = os.getenv("AI_HTTP2_ENABLED", "true").lower() == "true"
+    AI_HTTP_MAX_CONNECTIONS: int = int(os.getenv("AI_HTTP_MAX_CONNECTIONS", "100"))
+    AI_HTTP_MAX_KEEPALIVE: int = int(os.getenv("AI_HTTP_MAX_KEEPALIVE", "20"))
+    AI_HTTP_KEEPALIVE_SECONDS: float = float(os.getenv("AI_HTTP_KEEPALIVE_SECONDS", "120"))
+    AI_HTTP_CONNECT_TIMEOUT_SECONDS: float = float(os.getenv("AI_HTTP_CONNECT_TIMEOUT_SECONDS", "5"))
+    AI_HTTP_TIMEOUT_SECONDS: float = float(os.getenv("AI_HTTP_TIMEOUT_SECONDS", "120"))
+    # 啟動時預熱各部署的連線（DNS、TLS、一次輕量請求），最多等待的秒數
+    AI_PREWARM_ENABLED: bool = os.getenv("AI_PREWARM_ENABLED", "true").lower() == "true"
+    AI_PREWARM_TIMEOUT_SECONDS: float = float(os.getenv("AI_PREWARM_TIMEOUT_SECONDS", "10"))
+    
+    # 訊息儲存編碼：壓縮演算法（zlib / zstd / none）與開始壓縮的大小門檻（bytes）
+    MESSAGE_CODEC_COMPRESSION: str = os.getenv("MESSAGE_CODEC_COMPRESSION", "zlib").lower()
+    MESSAGE_COMPRESS_THRESHOLD: int = int(os.getenv("MESSAGE_COMPRESS_THRESHOLD", "512"))
+    
+    # 熱門關鍵詞配置：每個時間桶最多保留的關鍵詞數量（超過兩倍時修剪回此數量）
+    TRENDING_BUCKET_CAPACITY: int = int(os.getenv("TRENDING_BUCKET_CAPACITY", "1000"))
+    # 視窗合併結果的快取秒數
+    TRENDING_WINDOW_CACHE_SECONDS: int = int(os.getenv("TRENDING_WINDOW_CACHE_SECONDS", "60"))
+    
+    # 搜尋結果快取配置
+    SEARCH_CACHE_SIZE: int = int(os.getenv("SEARCH_CACHE_SIZE", "512"))
+    SEARCH_CACHE_TTL_SECONDS: int = int(os.getenv("SEARCH_CACHE_TTL_SECONDS", "300"))
+    SEARCH_CACHE_REDIS_ENABLED: bool = os.getenv("SEARCH_CACHE_REDIS_ENABLED", "false").lower() == "true"
+
+    # 輪詢端點（會話列表、聊天歷史、趨勢）的行程內回應快取：容量與 TTL（以版本號驗證，TTL 只是上限）
+    RESPONSE_CACHE_SIZE: int = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+    RESPONSE_CACHE_TTL_SECONDS: int = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "300"))
+    
+    # 備份匯出 / 匯入：串流送出的區塊大小（位元組）與每個 pipeline 的紀錄數
+    BACKUP_CHUNK_BYTES: int = int(os.getenv("BACKUP_CHUNK_BYTES", str(64 * 1024)))
+    BACKUP_IMPORT_BATCH_SIZE: int = int(os.getenv("BACKUP_IMPORT_BATCH_SIZE", "500"))
     
     # CORS 配置
     CORS_ORIGINS: list = ["*"]
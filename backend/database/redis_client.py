@@ -2,6 +2,7 @@
 
 import redis.asyncio as redis
 from config import settings
+from database.scripts import load_scripts_on_connect
 from redis.asyncio.connection import ConnectionPool
 from typing import Optional
 
@@ -23,7 +24,9 @@ async def init_redis_pool():
                 # 增加超時時間，尤其針對 Upstash 的 Serverless 特性
                 socket_timeout=60, 
                 socket_connect_timeout=5,
-                max_connections=10 # 限制連線數量
+                max_connections=10, # 限制連線數量
+                # 每條連線建立時先載入 Lua 腳本（Redis 重啟後交易中的 EVALSHA 不會遇到 NOSCRIPT）
+                redis_connect_func=load_scripts_on_connect,
             )
             print("INFO: Redis Connection Pool initialized successfully.")
         except Exception as e:
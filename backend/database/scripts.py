@@ -0,0 +1,401 @@
+# backend/database/scripts.py
+"""
+Redis Lua 腳本
+
+以 SCRIPT LOAD 載入後以 EVALSHA 呼叫。
+服務層把 EVALSHA 與其他衍生資料（搜尋索引、版本號等）放進同一個 MULTI pipeline，
+每個邏輯操作只需要一次往返，且整體原子執行。
+
+除了啟動時載入一次，每條連線建立時也會載入（load_scripts_on_connect，包含 Redis 重啟後的重新連線），
+因此交易中不會遇到 NOSCRIPT；
+只有連線期間執行 SCRIPT FLUSH 時，execute_pipeline 會重新載入並重跑整個交易（見其說明）。
+"""
+import hashlib
+from typing import Any, Dict, List, Sequence
+import redis.asyncio as redis
+from redis.exceptions import NoScriptError
+
+# 會話摘要（:chatsession:{session_id} 的 message_count / last_activity / preview / last_sender）共用函式。
+# 只在會話 hash 存在時更新；preview 以 bytes 截斷，並退回到 UTF-8 字元邊界。
+SESSION_SUMMARY_LUA = """
+local function clip(text, limit)
+    if #text <= limit then
+        return text
+    end
+    local i = limit
+    while i > 0 do
+        local b = string.byte(text, i + 1)
+        if b < 128 or b >= 192 then
+            break
+        end
+        i = i - 1
+    end
+    return string.sub(text, 1, i)
+end
+
+local function touch_summary(session_key, activity_key, session_id, ts, sender, content, limit)
+    local last = tonumber(redis.call('HGET', session_key, 'last_activity') or '0')
+    if tonumber(ts) >= last then
+        redis.call('HSET', session_key, 'last_activity', ts, 'preview', clip(content, limit), 'last_sender', sender)
+        redis.call('ZADD', activity_key, 'XX', 'GT', ts, session_id)
+    end
+end
+"""
+
+# 會話活躍度時段計數（見 services/activity_service.py）；時段為空字串表示此訊息不計入，歸零的時段會被移除
+ACTIVITY_LUA = """
+local function bump_activity(hourly_key, daily_key, hour_slot, day_slot, delta)
+    if hour_slot == '' then
+        return
+    end
+    if redis.call('HINCRBY', hourly_key, hour_slot, delta) <= 0 then
+        redis.call('HDEL', hourly_key, hour_slot)
+    end
+    if redis.call('HINCRBY', daily_key, day_slot, delta) <= 0 then
+        redis.call('HDEL', daily_key, day_slot)
+    end
+end
+"""
+
+# 不重複活躍會話 / 使用者（見 services/distinct_service.py）：PFADD 建立新 key 時設定到期時間
+DISTINCT_LUA = """
+local function add_distinct(key, member, expire_at)
+    if redis.call('PFADD', key, member) == 1 and redis.call('PTTL', key) == -1 then
+        redis.call('PEXPIREAT', key, expire_at)
+    end
+end
+
+local function count_distinct(session_key, session_id, keys, hour_expire, day_expire)
+    add_distinct(keys[1], session_id, hour_expire)
+    add_distinct(keys[2], session_id, day_expire)
+    local user_id = redis.call('HGET', session_key, 'user_id')
+    if user_id and user_id ~= '' then
+        add_distinct(keys[3], user_id, hour_expire)
+        add_distinct(keys[4], user_id, day_expire)
+    end
+end
+"""
+
+# 事件流寫入（見 services/stream_service.py）
+# stream_args 依序為 id_ms, trim_strategy, trim_threshold, expire_at：
+# id_ms 非空時先嘗試 "{id_ms}-*"，比串流最後一筆舊（或伺服器不支援）時退回 "*"；
+# trim_strategy 為 MAXLEN / MINID（空字串表示不修剪）；expire_at 非空時對分區 key 設 PEXPIREAT。
+STREAM_LUA = """
+local function append_event(stream_key, partitions_key, stream_args, fields)
+    local args = {stream_key}
+    if stream_args[2] ~= '' then
+        table.insert(args, stream_args[2])
+        table.insert(args, '~')
+        table.insert(args, stream_args[3])
+    end
+    local id_pos = #args + 1
+    args[id_pos] = '*'
+    for i, value in ipairs(fields) do
+        args[id_pos + i] = value
+    end
+    local id = nil
+    if stream_args[1] ~= '' then
+        args[id_pos] = stream_args[1] .. '-*'
+        local ok, result = pcall(redis.call, 'XADD', unpack(args))
+        if ok then
+            id = result
+        end
+    end
+    if not id then
+        args[id_pos] = '*'
+        id = redis.call('XADD', unpack(args))
+    end
+    redis.call('SADD', partitions_key, stream_key)
+    if stream_args[4] ~= '' then
+        redis.call('PEXPIREAT', stream_key, stream_args[4])
+    end
+    return id
+end
+"""
+
+# 儲存訊息
+# KEYS: order, body, orm, stream, session, session_activity, activity_hourly, activity_daily, stream_partitions,
+#       hll_sessions_hour, hll_sessions_day, hll_users_hour, hll_users_day
+# ARGV: ts, body_json, pk, session_id, sender, content, preview_bytes, hour_slot, day_slot,
+#       id_ms, trim_strategy, trim_threshold, expire_at, hll_hour_expire_at, hll_day_expire_at
+# 回傳 1 = 新訊息，0 = 覆蓋同 ts 的訊息
+# 不重複活躍數與活躍度統計計入相同的訊息（hour_slot 非空），但不論是否為新訊息都 PFADD（本身即冪等）
+SAVE_MESSAGE_LUA = SESSION_SUMMARY_LUA + ACTIVITY_LUA + DISTINCT_LUA + STREAM_LUA + """
+local ts = ARGV[1]
+local is_new = redis.call('ZADD', KEYS[1], ts, ts)
+redis.call('HSET', KEYS[2], ts, ARGV[2])
+redis.call('HSET', KEYS[3], 'pk', ARGV[3], 'session_id', ARGV[4], 'sender', ARGV[5], 'content', ARGV[6], 'ts', ts)
+append_event(KEYS[4], KEYS[9], {ARGV[10], ARGV[11], ARGV[12], ARGV[13]},
+    {'session_id', ARGV[4], 'sender', ARGV[5], 'content', ARGV[6], 'ts', ts, 'deleted', 'false'})
+if redis.call('EXISTS', KEYS[5]) == 1 then
+    if is_new == 1 then
+        redis.call('HINCRBY', KEYS[5], 'message_count', 1)
+    end
+    touch_summary(KEYS[5], KEYS[6], ARGV[4], ts, ARGV[5], ARGV[6], tonumber(ARGV[7]))
+end
+if is_new == 1 then
+    bump_activity(KEYS[7], KEYS[8], ARGV[8], ARGV[9], 1)
+end
+if ARGV[8] ~= '' then
+    count_distinct(KEYS[5], ARGV[4], {KEYS[10], KEYS[11], KEYS[12], KEYS[13]}, ARGV[14], ARGV[15])
+end
+return is_new
+"""
+
+# 批量刪除訊息
+# KEYS: order, body, deleted_index, deleted_body, deleted_sessions, stream, session, session_activity,
+#       activity_hourly, activity_daily, stream_partitions, ai_summary, [survivor_orm], orm_1..orm_n
+# ARGV: session_id, deleted_at, preview_bytes, survivor_ts,
+#       id_ms, trim_strategy, trim_threshold, expire_at,
+#       ts_1, record_1, hour_slot_1, day_slot_1, ts_2, ...（record 為寫入刪除紀錄的編碼字串）
+# 回傳實際刪除的 ts 列表（已被並行刪除的會略過）
+# 刪到最新一則時，摘要改為腳本內讀出的剩下的最新訊息。呼叫端讀取要刪除的訊息時一併取得預期的最新訊息
+# （survivor_ts，沒有時為空字串，KEYS 中也不含 survivor_orm），其 ORM hash 放在 KEYS 中供讀取內容；
+# 並行寫入 / 刪除讓實際的最新訊息不同時，改從訊息本文（KEYS[2]，未壓縮的 JSON）解出內容，
+# 壓縮過的本文無法在腳本中解碼，預覽先清空，下一次寫入會再更新。
+# 刪除的訊息落在 AI 滾動摘要涵蓋的範圍內（ts <= covered_ts）時一併捨棄摘要。
+DELETE_MESSAGES_LUA = SESSION_SUMMARY_LUA + ACTIVITY_LUA + STREAM_LUA + """
+local function message_fields(raw)
+    local payload = nil
+    if raw and string.sub(raw, 1, 3) == '1j:' then
+        payload = string.sub(raw, 4)
+    elseif raw and string.sub(raw, 1, 1) == '{' then
+        payload = raw
+    end
+    if payload then
+        local ok, doc = pcall(cjson.decode, payload)
+        if ok and type(doc) == 'table' then
+            local sender, content = doc['sender'], doc['content']
+            return type(sender) == 'string' and sender or '', type(content) == 'string' and content or ''
+        end
+    end
+    return '', ''
+end
+
+local deleted = {}
+local deleted_at = ARGV[2]
+local survivor_ts = ARGV[4]
+local first_orm = 13
+if survivor_ts ~= '' then
+    first_orm = 14
+end
+local stream_args = {ARGV[5], ARGV[6], ARGV[7], ARGV[8]}
+local covered = tonumber(redis.call('HGET', KEYS[12], 'covered_ts') or '0')
+local drop_summary = false
+local n = (#ARGV - 8) / 4
+for i = 1, n do
+    local base = 4 + 4 * i
+    local ts = ARGV[base + 1]
+    if redis.call('ZREM', KEYS[1], ts) == 1 then
+        local record_id = ts .. ':' .. deleted_at
+        redis.call('HDEL', KEYS[2], ts)
+        redis.call('ZADD', KEYS[3], deleted_at, record_id)
+        redis.call('HSET', KEYS[4], record_id, ARGV[base + 2])
+        redis.call('UNLINK', KEYS[first_orm + i - 1])
+        bump_activity(KEYS[9], KEYS[10], ARGV[base + 3], ARGV[base + 4], -1)
+        append_event(KEYS[6], KEYS[11], stream_args,
+            {'session_id', ARGV[1], 'sender', '', 'content', '', 'ts', ts, 'deleted', 'true'})
+        table.insert(deleted, ts)
+        if tonumber(ts) <= covered then
+            drop_summary = true
+        end
+    end
+end
+if drop_summary then
+    redis.call('UNLINK', KEYS[12])
+end
+if #deleted > 0 then
+    redis.call('SADD', KEYS[5], ARGV[1])
+    if redis.call('EXISTS', KEYS[7]) == 1 then
+        if redis.call('HINCRBY', KEYS[7], 'message_count', -#deleted) < 0 then
+            redis.call('HSET', KEYS[7], 'message_count', 0)
+        end
+        local last = redis.call('HGET', KEYS[7], 'last_activity')
+        local latest = redis.call('ZREVRANGE', KEYS[1], 0, 0)
+        if #latest == 0 then
+            redis.call('HSET', KEYS[7], 'preview', '', 'last_sender', '')
+        elseif latest[1] ~= last then
+            local sender, content
+            if latest[1] == survivor_ts then
+                local doc = redis.call('HMGET', KEYS[13], 'sender', 'content')
+                sender, content = doc[1] or '', doc[2] or ''
+            else
+                sender, content = message_fields(redis.call('HGET', KEYS[2], latest[1]))
+            end
+            redis.call('HSET', KEYS[7], 'last_activity', latest[1], 'preview', clip(content, tonumber(ARGV[3])),
+                'last_sender', sender)
+            redis.call('ZADD', KEYS[8], 'XX', latest[1], ARGV[1])
+        end
+    end
+end
+return deleted
+"""
+
+# 復原訊息
+# KEYS: deleted_index, deleted_body, order, body, orm, stream, session, session_activity, activity_hourly, activity_daily,
+#       stream_partitions, ai_summary, global_version, session_version, term_1..term_n
+# ARGV: record_id（"{ts}:{deleted_at}"）, ts, body_json, pk, session_id, sender, content, preview_bytes, hour_slot, day_slot,
+#       id_ms, trim_strategy, trim_threshold, expire_at, posting
+# 回傳 1 = 已復原，0 = 刪除紀錄不存在（已被復原或過期，此時不寫入任何資料）
+# 搜尋索引、版本號與 AI 滾動摘要的失效（ts 落在摘要涵蓋範圍內時）都在取回紀錄成功後於同一次執行中完成
+RESTORE_MESSAGE_LUA = SESSION_SUMMARY_LUA + ACTIVITY_LUA + STREAM_LUA + """
+if redis.call('HDEL', KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+local ts = ARGV[2]
+local is_new = redis.call('ZADD', KEYS[3], ts, ts)
+redis.call('HSET', KEYS[4], ts, ARGV[3])
+redis.call('HSET', KEYS[5], 'pk', ARGV[4], 'session_id', ARGV[5], 'sender', ARGV[6], 'content', ARGV[7], 'ts', ts)
+append_event(KEYS[6], KEYS[11], {ARGV[11], ARGV[12], ARGV[13], ARGV[14]},
+    {'session_id', ARGV[5], 'sender', ARGV[6], 'content', ARGV[7], 'ts', ts, 'deleted', 'false'})
+if redis.call('EXISTS', KEYS[7]) == 1 then
+    if is_new == 1 then
+        redis.call('HINCRBY', KEYS[7], 'message_count', 1)
+    end
+    touch_summary(KEYS[7], KEYS[8], ARGV[5], ts, ARGV[6], ARGV[7], tonumber(ARGV[8]))
+end
+if is_new == 1 then
+    bump_activity(KEYS[9], KEYS[10], ARGV[9], ARGV[10], 1)
+end
+for i = 15, #KEYS do
+    redis.call('SADD', KEYS[i], ARGV[15])
+end
+if tonumber(ts) <= tonumber(redis.call('HGET', KEYS[12], 'covered_ts') or '0') then
+    redis.call('UNLINK', KEYS[12])
+end
+redis.call('INCR', KEYS[13])
+redis.call('INCR', KEYS[14])
+return 1
+"""
+
+# 將存在的 key 改名（刪除會話時把資料移到墓碑 key，交給背景工作回收）
+# KEYS: src_1, dst_1, src_2, dst_2, ...
+# 回傳實際改名的數量
+RENAME_KEYS_LUA = """
+local renamed = 0
+for i = 1, #KEYS, 2 do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('RENAME', KEYS[i], KEYS[i + 1])
+        renamed = renamed + 1
+    end
+end
+return renamed
+"""
+
+# 熱門關鍵詞累加（見 services/trending_service.py）
+# KEYS: 各時間桶
+# ARGV: capacity, ttl_1..ttl_n, keyword...
+TRACK_KEYWORDS_LUA = """
+local capacity = tonumber(ARGV[1])
+local first_word = 2 + #KEYS
+for i, key in ipairs(KEYS) do
+    for j = first_word, #ARGV do
+        redis.call('ZINCRBY', key, 1, ARGV[j])
+    end
+    if redis.call('ZCARD', key) > capacity * 2 then
+        redis.call('ZREMRANGEBYRANK', key, 0, -(capacity + 1))
+    end
+    redis.call('EXPIRE', key, tonumber(ARGV[1 + i]))
+end
+return #ARGV - first_word + 1
+"""
+
+# 會話訊息時間範圍（見 services/projection_service.py）：first_ts 只往小、last_ts 只往大更新，
+# 多個消費者同時處理同一會話的事件時不會互相覆寫
+# KEYS: session_stats
+# ARGV: first_ts, last_ts（本批事件的最小 / 最大 ts）
+SESSION_RANGE_LUA = """
+local first = tonumber(redis.call('HGET', KEYS[1], 'first_ts') or '')
+local last = tonumber(redis.call('HGET', KEYS[1], 'last_ts') or '')
+if first == nil or tonumber(ARGV[1]) < first then
+    redis.call('HSET', KEYS[1], 'first_ts', ARGV[1])
+end
+if last == nil or tonumber(ARGV[2]) > last then
+    redis.call('HSET', KEYS[1], 'last_ts', ARGV[2])
+end
+return 1
+"""
+
+# 釋放鎖：只有值仍是自己的 token 時才刪除（鎖已過期並被其他工作取得時不會誤刪）
+# KEYS: lock
+# ARGV: token
+# 回傳 1 = 已釋放，0 = 鎖已不屬於自己
+RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+SCRIPTS: Dict[str, str] = {
+    "save_message": SAVE_MESSAGE_LUA,
+    "delete_messages": DELETE_MESSAGES_LUA,
+    "restore_message": RESTORE_MESSAGE_LUA,
+    "rename_keys": RENAME_KEYS_LUA,
+    "track_keywords": TRACK_KEYWORDS_LUA,
+    "session_range": SESSION_RANGE_LUA,
+    "release_lock": RELEASE_LOCK_LUA,
+}
+
+SCRIPT_SHAS: Dict[str, str] = {
+    name: hashlib.sha1(source.encode("utf-8")).hexdigest() for name, source in SCRIPTS.items()
+}
+
+
+async def load_scripts(redis_client: redis.Redis) -> None:
+    """SCRIPT LOAD 所有腳本（啟動時呼叫；重複呼叫無副作用）"""
+    for name, source in SCRIPTS.items():
+        sha = await redis_client.script_load(source)
+        if sha != SCRIPT_SHAS[name]:
+            raise RuntimeError(f"Unexpected SHA for script '{name}': {sha}")
+    print(f"INFO: Loaded {len(SCRIPTS)} Redis Lua scripts.")
+
+
+def queue_script(pipe, name: str, keys: Sequence[Any], args: Sequence[Any]) -> None:
+    """將 EVALSHA 加入 pipeline（不執行）"""
+    pipe.evalsha(SCRIPT_SHAS[name], len(keys), *keys, *args)
+
+
+async def load_scripts_on_connect(connection) -> None:
+    """
+    連線池的 redis_connect_func：每條連線建立時（包含 Redis 重啟後的重新連線）先 SCRIPT LOAD 所有腳本，
+    因此之後交易中的 EVALSHA 不會因伺服器遺失腳本而遇到 NOSCRIPT。
+    """
+    await connection.on_connect()
+    for source in SCRIPTS.values():
+        await connection.send_command("SCRIPT", "LOAD", source)
+    for _ in SCRIPTS:
+        await connection.read_response()
+
+
+async def execute_pipeline(redis_client: redis.Redis, pipe) -> List[Any]:
+    """
+    執行 pipeline；若有 EVALSHA 因 NOSCRIPT 失敗，重新載入腳本後以新的 MULTI 重跑整個 pipeline。
+
+    SCRIPT FLUSH 會清掉所有腳本，同一交易中的 EVALSHA 會一起失敗，重跑時每個腳本只會實際執行一次；
+    非腳本指令（搜尋索引 SADD / SREM、快取 UNLINK、版本號 INCR）會執行兩次，這些指令重複執行不影響結果
+    （版本號多遞增一次只會讓快取多失效一次）。
+    連線建立時已載入腳本（load_scripts_on_connect），這只會發生在連線期間伺服器執行了 SCRIPT FLUSH。
+    """
+    commands = list(pipe.command_stack)
+    results = await pipe.execute(raise_on_error=False)
+
+    if any(
+        isinstance(result, NoScriptError) and args[0] == "EVALSHA"
+        for result, (args, _) in zip(results, commands)
+    ):
+        print("WARNING: Redis scripts missing (SCRIPT FLUSH?), reloading and re-running the transaction.")
+        await load_scripts(redis_client)
+        async with redis_client.pipeline() as retry:
+            for args, options in commands:
+                retry.execute_command(*args, **options)
+            results = await retry.execute(raise_on_error=False)
+
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
+
+
+__all__ = ["SCRIPTS", "SCRIPT_SHAS", "load_scripts", "load_scripts_on_connect", "queue_script", "execute_pipeline"]
@@ -0,0 +1,236 @@
+"""
+維運指令列工具
+
+用法（在 backend 目錄下執行）：
+    python manage.py rebuild-search-index
+    python manage.py rebuild-message-docs
+    python manage.py migrate-message-store
+    python manage.py rebuild-session-index
+    python manage.py backfill-activity
+    python manage.py backfill-rollups
+    python manage.py backfill-distinct
+    python manage.py export -o backup.ndjson [--session SID ...]
+    python manage.py import -i backup.ndjson     # 會一併重算匯入會話的摘要 / 活躍度，不需再執行 backfill-*
+    python manage.py benchmark-codec [--session SID ...]
+    python manage.py split-stream [--keep-source]
+    python manage.py run-projections [--consumer NAME]
+    python manage.py retry-deletion-jobs
+    python manage.py mock-ai [--port 9001] [--latency-ms 200] [--error-rate 0.1 --error-status 429]
+"""
+import argparse
+import asyncio
+import sys
+
+from database.redis_client import get_redis_client
+
+
+async def _rebuild_search_index(args: argparse.Namespace):
+    from services.search_index import rebuild_index
+
+    redis_client = await get_redis_client()
+    await rebuild_index(redis_client)
+
+
+async def _rebuild_message_docs(args: argparse.Namespace):
+    from services.search_service import rebuild_message_documents
+
+    redis_client = await get_redis_client()
+    await rebuild_message_documents(redis_client)
+
+
+async def _migrate_message_store(args: argparse.Namespace):
+    from services import deleted_store, message_store
+
+    redis_client = await get_redis_client()
+    await message_store.migrate_all_sessions(redis_client)
+    await deleted_store.migrate_all_sessions(redis_client)
+
+
+async def _rebuild_session_index(args: argparse.Namespace):
+    from services.session_index import rebuild_index
+
+    redis_client = await get_redis_client()
+    await rebuild_index(redis_client)
+
+
+async def _backfill_activity(args: argparse.Namespace):
+    from services.activity_service import backfill
+
+    redis_client = await get_redis_client()
+    await backfill(redis_client)
+
+
+async def _backfill_rollups(args: argparse.Namespace):
+    from services.rollup_service import backfill
+
+    redis_client = await get_redis_client()
+    await backfill(redis_client)
+
+
+async def _backfill_distinct(args: argparse.Namespace):
+    from services.distinct_service import backfill
+
+    redis_client = await get_redis_client()
+    await backfill(redis_client)
+
+
+async def _export(args: argparse.Namespace):
+    from services.backup_service import export_ndjson
+
+    redis_client = await get_redis_client()
+    # 匯出只寫入檔案：日誌會輸出到 stdout，不能與資料混在一起
+    with open(args.output, "wb") as out:
+        async for chunk in export_ndjson(redis_client, args.session):
+            out.write(chunk)
+
+
+async def _import(args: argparse.Namespace):
+    from services.backup_service import import_ndjson
+
+    async def read_chunks():
+        src = sys.stdin.buffer if args.input == "-" else open(args.input, "rb")
+        try:
+            while True:
+                chunk = src.read(64 * 1024)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            if src is not sys.stdin.buffer:
+                src.close()
+
+    redis_client = await get_redis_client()
+    await import_ndjson(redis_client, read_chunks())
+
+
+async def _benchmark_codec(args: argparse.Namespace):
+    from services import message_store
+    from utils.codec_benchmark import run_benchmark, sample_messages
+
+    messages = sample_messages(args.count)
+    if args.session:
+        # 以實際會話內容取代模擬資料
+        redis_client = await get_redis_client()
+        messages = []
+        for session_id in args.session:
+            messages.extend(await message_store.fetch_all(redis_client, session_id))
+        if not messages:
+            print("❌ 指定的會話沒有訊息")
+            return
+    run_benchmark(messages, rounds=args.rounds)
+
+
+async def _split_stream(args: argparse.Namespace):
+    from services.stream_service import split_stream
+
+    redis_client = await get_redis_client()
+    await split_stream(redis_client, keep_source=args.keep_source)
+
+
+async def _run_projections(args: argparse.Namespace):
+    from services.projection_service import run_projection_worker
+
+    stop_event = asyncio.Event()
+    try:
+        await run_projection_worker(stop_event, consumer=args.consumer)
+    except asyncio.CancelledError:
+        stop_event.set()
+
+
+async def _retry_deletion_jobs(args: argparse.Namespace):
+    from services.deletion_service import retry_failed_jobs
+
+    redis_client = await get_redis_client()
+    await retry_failed_jobs(redis_client)
+
+
+async def _mock_ai(args: argparse.Namespace):
+    from utils.mock_openai import serve
+
+    await serve(
+        args.port,
+        host=args.host,
+        name=args.name,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        token_delay_ms=args.token_delay_ms,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after,
+    )
+
+
+def _export_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("-o", "--output", required=True, help="輸出檔案")
+    parser.add_argument("--session", action="append", help="只匯出指定會話（可重複）")
+
+
+def _import_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("-i", "--input", default="-", help="輸入檔案（預設 stdin）")
+
+
+def _benchmark_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--count", type=int, default=1000, help="模擬訊息數量")
+    parser.add_argument("--rounds", type=int, default=5, help="重複輪數")
+    parser.add_argument("--session", action="append", help="改用指定會話的實際訊息（可重複）")
+
+
+def _split_stream_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--keep-source", action="store_true", help="完成後保留原本的 chat_stream")
+
+
+def _projection_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--consumer", help="消費者名稱（預設 主機名稱-pid；多個程序可加入同一群組分擔工作）")
+
+
+def _mock_ai_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--port", type=int, default=9001, help="監聽埠")
+    parser.add_argument("--host", default="127.0.0.1", help="監聽位址")
+    parser.add_argument("--name", default="mock", help="部署名稱（出現在回覆內容中）")
+    parser.add_argument("--latency-ms", type=int, default=200, help="第一個 token 之前的延遲")
+    parser.add_argument("--jitter-ms", type=int, default=50, help="延遲的隨機抖動")
+    parser.add_argument("--token-delay-ms", type=int, default=20, help="串流時每段之間的延遲")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="回傳錯誤的比例（0~1）")
+    parser.add_argument("--error-status", type=int, default=429, help="錯誤的 HTTP 狀態碼")
+    parser.add_argument("--retry-after", type=float, help="錯誤回應附帶的 Retry-After 秒數")
+
+
+# 指令名稱 -> (處理函式, 說明, 參數設定函式)
+COMMANDS = {
+    "migrate-message-store": (_migrate_message_store, "將 chat_history:* / deleted_history:* List 轉換為 ts 索引結構", None),
+    "rebuild-search-index": (_rebuild_search_index, "從訊息資料重建搜尋倒排索引", None),
+    "rebuild-message-docs": (_rebuild_message_docs, "以固定主鍵重建 chatmessage_idx 的訊息文件", None),
+    "rebuild-session-index": (_rebuild_session_index, "重建會話索引（ChatSession 改以 session_id 為主鍵）", None),
+    "backfill-activity": (_backfill_activity, "從訊息資料回填每個會話的小時 / 日活躍度統計", None),
+    "backfill-rollups": (_backfill_rollups, "從訊息與刪除紀錄重建全域分鐘 / 小時 / 日統計", None),
+    "backfill-distinct": (_backfill_distinct, "從訊息資料回填不重複活躍會話 / 使用者（HyperLogLog）", None),
+    "export": (_export, "以 NDJSON 串流匯出會話、訊息與刪除紀錄", _export_arguments),
+    "import": (
+        _import,
+        "匯入 NDJSON 備份（可重複執行；完成後自動重算匯入會話的摘要、活躍度與不重複活躍數，新訊息計入全域統計）",
+        _import_arguments,
+    ),
+    "benchmark-codec": (_benchmark_codec, "比較訊息編碼格式的大小與編解碼速度", _benchmark_arguments),
+    "run-projections": (_run_projections, "以消費者群組執行事件流投影工作（Ctrl+C 結束）", _projection_arguments),
+    "split-stream": (_split_stream, "依 STREAM_PARTITION 將 chat_stream 拆分為分區串流並套用保留設定", _split_stream_arguments),
+    "retry-deletion-jobs": (_retry_deletion_jobs, "將失敗（status=failed）的會話回收工作重新排入佇列", None),
+    "mock-ai": (_mock_ai, "啟動模擬 Azure OpenAI 部署的本機伺服器（測試多部署路由用，Ctrl+C 結束）", _mock_ai_arguments),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="全跡AI對話室 維運工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for name, (_, help_text, add_arguments) in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=help_text)
+        if add_arguments:
+            add_arguments(subparser)
+
+    args = parser.parse_args()
+    handler, _, _ = COMMANDS[args.command]
+    asyncio.run(handler(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,11 +7,21 @@ from database.redis_client import redis_om_conn
 class ChatMessage(HashModel):
     """聊天訊息 ORM 模型"""
     session_id: str = Field(index=True)
-    sender: str
+    sender: str = Field(index=True)
     content: str = Field(index=True, full_text_search=True)
-    ts: int
+    ts: int = Field(index=True, sortable=True)
 
     class Meta:
         database = redis_om_conn
         model_key_prefix = "chat_msg"
         index_name = "chatmessage_idx"
+
+    @classmethod
+    def redisearch_schema(cls):
+        """以中文分詞（LANGUAGE chinese）建立索引，預設的 english 分詞無法切分中文句子"""
+        return super().redisearch_schema().replace(" SCHEMA ", " LANGUAGE chinese SCHEMA ", 1)
+
+    @staticmethod
+    def message_pk(session_id: str, ts: int) -> str:
+        """以 session_id + ts 作為固定主鍵，刪除/復原時可直接定位到同一個 hash"""
+        return f"{session_id}:{int(ts)}"
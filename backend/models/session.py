@@ -8,5 +8,9 @@ class ChatSession(HashModel):
     created_at: datetime = Field(index=True, default=datetime.utcnow())
     user_id: Optional[str] = Field(index=True, default=None)
     message_count: int = Field(default=0)
+    # 以下摘要欄位由寫入腳本維護（見 database/scripts.py）
+    last_activity: int = Field(default=0) # 最後一則訊息的 ts（毫秒）
+    preview: str = Field(default="") # 最後一則訊息的預覽（截斷至 SESSION_PREVIEW_BYTES）
+    last_sender: str = Field(default="")
     class Meta:
         model_key_prefix = "chatsession"
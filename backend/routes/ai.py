@@ -0,0 +1,25 @@
+# routes/ai.py
+from fastapi import APIRouter
+from services.ai_cache import ai_cache
+from services.ai_router import ai_router
+from services.ai_scheduler import ai_scheduler
+
+router = APIRouter(prefix="/ai", tags=["AI"])
+
+
+@router.get("/cache_stats")
+async def ai_cache_stats_endpoint():
+    """AI 回覆快取的命中率、合併的請求數與省下的上游延遲"""
+    return ai_cache.stats()
+
+
+@router.get("/scheduler_stats")
+async def ai_scheduler_stats_endpoint():
+    """AI 請求排程的排隊數、進行中請求、token 預算、重試次數與排隊等待時間"""
+    return ai_scheduler.stats()
+
+
+@router.get("/deployments")
+async def ai_deployments_endpoint():
+    """各部署的狀態（熔斷 / 限流）、負載、延遲、錯誤與對沖統計"""
+    return ai_router.stats()
@@ -1,86 +1,199 @@
 """
 分析/統計相關的 API 路由
 """
-from fastapi import APIRouter, HTTPException, Depends
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
 from redis.asyncio import Redis
-from typing import Dict, List
-from datetime import datetime, timezone, timedelta
 
+from config import settings
 from database.redis_client import get_redis_client
+from services.stream_service import read_window
+from services import distinct_service, projection_service, rollup_service
+from services.response_cache import versioned_json
+from services.version_service import get_session_versions
+from services.activity_service import get_hourly_trend as read_hourly_trend, get_daily_trend as read_daily_trend
 
 router = APIRouter(prefix="/aggregation", tags=["Analytics"])
-TZ = timezone(timedelta(hours=8))  # 台灣時間
 
 
 @router.get("/hourly_trend/{session_id}")
 async def get_hourly_trend(
+    request: Request,
     session_id: str,
     redis_client: Redis = Depends(get_redis_client),
 ):
     """
-    獲取會話的小時活躍趨勢（不使用 RediSearch / Redis-OM，只讀 chat_stream）。
-    只統計未標記刪除的使用者訊息（sender=me, deleted != "true"），
-    且同一個 ts 只算一次。
+    獲取會話的小時活躍趨勢（台灣時間）。
+    只統計內容非空的使用者訊息（sender=me），同一個 ts 只算一次，已刪除的訊息不計入；
+    計數在寫入時累加（見 services/activity_service.py），這裡只讀取一個 hash；
+    ETag 取自會話版本號，沒有變動時回 304。
     """
-    try:
-        entries = await redis_client.xrange("chat_stream", "-", "+")
-        print("DEBUG chat_stream entries for", session_id, ":", entries)
-
-        hourly_counts: Dict[str, int] = {}
-        seen_ts: set[int] = set()  # 避免同一則訊息被算多次
-
-        for entry_id, fields in entries:
-            if fields.get("session_id") != session_id:
-                continue
-
-            if fields.get("deleted") == "true":
-                continue
+    async def build():
+        hourly_trend = await read_hourly_trend(redis_client, session_id)
 
-            sender = fields.get("sender", "")
-            if sender.lower() != "me":
-                continue
-
-            content = fields.get("content", "")
-            if not content.strip():
-                continue  # 空內容不算
+        if not hourly_trend:
+            return {
+                "hourly_trend": [],
+                "message": "No data available for this session",
+            }, None
 
-            ts_str = fields.get("ts")
-            if not ts_str:
-                continue
+        return {"hourly_trend": hourly_trend}, None
 
-            try:
-                ts_ms = int(ts_str)
-            except ValueError:
-                continue
+    try:
+        version = (await get_session_versions(redis_client, [session_id]))[session_id]
+        return await versioned_json(request, version, ("hourly_trend", session_id), build)
 
-            # 同一個 ts 只算一次（避免刪除/復原後多次 xadd）
-            if ts_ms in seen_ts:
-                continue
-            seen_ts.add(ts_ms)
+    except Exception as e:
+        print(f"❌ Failed to get hourly trend for {session_id}: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to get hourly trend: {str(e)}",
+        )
 
-            try:
-                dt = datetime.fromtimestamp(ts_ms / 1000.0, tz=TZ)
-                time_slot = dt.strftime("%Y-%m-%d %H:00")
-                hourly_counts[time_slot] = hourly_counts.get(time_slot, 0) + 1
-            except Exception:
-                continue
 
-        hourly_trend: List[Dict[str, int]] = [
-            {"time_slot": k, "count": v}
-            for k, v in sorted(hourly_counts.items())
-        ]
+@router.get("/daily_trend/{session_id}")
+async def get_daily_trend(
+    session_id: str,
+    redis_client: Redis = Depends(get_redis_client),
+):
+    """
+    獲取會話的每日活躍趨勢（統計規則同 hourly_trend）。
+    """
+    try:
+        daily_trend = await read_daily_trend(redis_client, session_id)
 
-        if not hourly_trend:
+        if not daily_trend:
             return {
-                "hourly_trend": [],
+                "daily_trend": [],
                 "message": "No data available for this session",
             }
 
-        return {"hourly_trend": hourly_trend}
+        return {"daily_trend": daily_trend}
 
     except Exception as e:
-        print(f"❌ Failed to get hourly trend for {session_id}: {e}")
+        print(f"❌ Failed to get daily trend for {session_id}: {e}")
         raise HTTPException(
             status_code=500,
-            detail=f"Failed to get hourly trend: {str(e)}",
+            detail=f"Failed to get daily trend: {str(e)}",
+        )
+
+
+@router.get("/events")
+async def get_events(
+    start_ts: int = Query(..., description="起始時間（毫秒）"),
+    end_ts: int = Query(..., description="結束時間（毫秒）"),
+    session_id: Optional[str] = Query(None),
+    limit: int = Query(200, ge=1),
+    redis_client: Redis = Depends(get_redis_client),
+):
+    """
+    讀取時間範圍內的訊息事件（chat_stream）。
+    儲存事件的 ID 即訊息 ts，直接以 XRANGE 切片；只會讀到保留期間內的事件。
+    """
+    if end_ts < start_ts:
+        raise HTTPException(status_code=400, detail="end_ts must not be earlier than start_ts")
+    try:
+        events = await read_window(
+            redis_client, start_ts, end_ts, session_id, min(limit, settings.STREAM_WINDOW_MAX)
+        )
+        return {"events": events}
+
+    except Exception as e:
+        print(f"❌ Failed to read events: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to read events: {str(e)}",
         )
+
+
+@router.get("/projections/status")
+async def get_projection_status(redis_client: Redis = Depends(get_redis_client)):
+    """事件流投影的進度與落後量（待確認事件數、未讀事件數、落後毫秒）"""
+    try:
+        return await projection_service.get_status(redis_client)
+    except Exception as e:
+        print(f"❌ Failed to get projection status: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to get projection status: {str(e)}")
+
+
+@router.get("/senders")
+async def get_sender_counts(redis_client: Redis = Depends(get_redis_client)):
+    """各發送者寫入的訊息數（由投影工作維護，最終一致）"""
+    try:
+        return {"senders": await projection_service.get_sender_counts(redis_client)}
+    except Exception as e:
+        print(f"❌ Failed to get sender counts: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to get sender counts: {str(e)}")
+
+
+@router.get("/global_hourly_trend")
+async def get_global_hourly_trend(redis_client: Redis = Depends(get_redis_client)):
+    """所有會話的每小時訊息數（台灣時間，由投影工作維護，最終一致）"""
+    try:
+        return {"hourly_trend": await projection_service.get_global_hourly(redis_client)}
+    except Exception as e:
+        print(f"❌ Failed to get global hourly trend: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to get global hourly trend: {str(e)}")
+
+
+@router.get("/session_stats/{session_id}")
+async def get_session_stats(session_id: str, redis_client: Redis = Depends(get_redis_client)):
+    """會話的事件統計（寫入 / 刪除次數、第一與最後一則訊息時間，由投影工作維護）"""
+    try:
+        return await projection_service.get_session_stats(redis_client, session_id)
+    except Exception as e:
+        print(f"❌ Failed to get session stats for {session_id}: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to get session stats: {str(e)}")
+
+
+@router.get("/rollup/{metric}")
+async def get_rollup(
+    metric: str,
+    start_ts: int = Query(..., description="起始時間（毫秒）"),
+    end_ts: int = Query(..., description="結束時間（毫秒）"),
+    max_points: Optional[int] = Query(None, ge=1),
+    resolution: Optional[str] = Query(None, description="minute / hour / day，預設自動挑選"),
+    redis_client: Redis = Depends(get_redis_client),
+):
+    """
+    全域時間序列（所有會話）：messages / user_messages / ai_replies / deleted / active_sessions。
+    最多回傳 max_points 點（上限 ROLLUP_MAX_POINTS），由投影工作維護，最終一致。
+    """
+    if end_ts < start_ts:
+        raise HTTPException(status_code=400, detail="end_ts must not be earlier than start_ts")
+    try:
+        return await rollup_service.query(redis_client, metric, start_ts, end_ts, max_points, resolution)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(f"❌ Failed to query rollup {metric}: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to query rollup: {str(e)}")
+
+
+@router.get("/distinct/{kind}")
+async def get_distinct(
+    kind: str,
+    start_ts: int = Query(..., description="起始時間（毫秒）"),
+    end_ts: int = Query(..., description="結束時間（毫秒）"),
+    resolution: Optional[str] = Query(None, description="hour / day：另外回傳每個時間桶的不重複數"),
+    redis_client: Redis = Depends(get_redis_client),
+):
+    """
+    範圍內不重複的活躍會話（sessions）或使用者（users）數。
+    以 HyperLogLog 合併時間桶，誤差約 1%；寫入時更新，即時一致。
+    """
+    if end_ts < start_ts:
+        raise HTTPException(status_code=400, detail="end_ts must not be earlier than start_ts")
+    try:
+        # 先取 series（會檢查解析度與點數上限），不合法的請求不會先做 PFMERGE
+        series = await distinct_service.series(redis_client, kind, resolution, start_ts, end_ts) if resolution else None
+        result = await distinct_service.count_range(redis_client, kind, start_ts, end_ts)
+        if series is not None:
+            result["series"] = series
+        return result
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(f"❌ Failed to count distinct {kind}: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to count distinct {kind}: {str(e)}")
@@ -0,0 +1,38 @@
+# routes/backup.py
+from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from redis.asyncio import Redis
+from database.redis_client import get_redis_client
+from services.backup_service import export_ndjson, import_ndjson
+
+router = APIRouter(prefix="/backup", tags=["Backup"])
+
+
+@router.get("/export")
+async def export_endpoint(
+    session_id: Optional[List[str]] = Query(None),
+    redis_client: Redis = Depends(get_redis_client),
+):
+    """
+    以 NDJSON 串流匯出會話（可重複帶入 session_id 只匯出指定會話，預設全部）。
+    """
+    return StreamingResponse(
+        export_ndjson(redis_client, session_id),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="tracechat-backup.ndjson"'},
+    )
+
+
+@router.post("/import")
+async def import_endpoint(
+    request: Request,
+    redis_client: Redis = Depends(get_redis_client),
+):
+    """
+    匯入 NDJSON（請求本文以串流方式逐行讀取，不會整份載入記憶體）。
+    """
+    try:
+        return await import_ndjson(redis_client, request.stream())
+    except (ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid backup record: {e}")
@@ -1,6 +1,6 @@
 """
 Routes package
 """
-from . import sessions, messages, search, analytics, websocket
+from . import sessions, messages, search, analytics, websocket, ai
 
-__all__ = ["sessions", "messages", "search", "analytics", "websocket"]
+__all__ = ["sessions", "messages", "search", "analytics", "websocket", "ai"]
@@ -1,14 +1,18 @@
 # backend/routes/messages.py
 
-from fastapi import APIRouter, HTTPException, Depends
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
+from config import settings
 from models.schemas import BatchDeleteRequest, RestoreMessageRequest
 from services.message_service import (
     save_message,
     delete_messages_batch,
     restore_message,
     get_deleted_history,
-    get_message_history 
+    get_message_page
 )
+from services.response_cache import versioned_json
+from services.version_service import get_session_versions
 # 導入 get_redis_client 和異步 Redis 類型
 from database.redis_client import get_redis_client
 from redis.asyncio import Redis
@@ -22,18 +26,9 @@ async def add_message(
     redis_client: Redis = Depends(get_redis_client) 
 ):
     """新增訊息"""
-    # 關鍵修正：save_message 需要 redis_client 參數
+    # save_message 會在同一次往返中一併寫入 chat_stream
     await save_message(redis_client, data["session_id"], data) 
     
-    # 關鍵修正：使用 DI 獲取的 redis_client
-    await redis_client.xadd("chat_stream", fields={
-        "session_id": data["session_id"],
-        "sender": data["sender"],
-        "content": data["content"],
-        "ts": str(data["ts"]),
-        "deleted": "false"
-    })
-    
     return {"msg": "Message saved successfully"}
 
 @router.post("/batch_delete")
@@ -75,21 +70,32 @@ async def get_deleted_history_endpoint(
     
 @router.get("/{session_id}")
 async def get_chat_history_endpoint(
+    request: Request,
     session_id: str,
+    limit: int = Query(settings.HISTORY_PAGE_SIZE, ge=1, le=settings.HISTORY_PAGE_SIZE_MAX),
+    before: Optional[int] = Query(None, description="只取 ts 小於此值的訊息（往舊的方向捲動）"),
+    after: Optional[int] = Query(None, description="只取 ts 大於此值的訊息（往新的方向補齊）"),
     redis_client: Redis = Depends(get_redis_client)
 ):
     """
-    獲取特定會話的聊天歷史紀錄。
+    以游標分頁獲取特定會話的聊天歷史紀錄。
+    回傳 next_cursor，前端將其帶入 before（或 after）即可載入下一頁。
+    ETag 取自會話版本號，會話沒有新增 / 刪除 / 復原訊息時回 304。
     """
+    if before is not None and after is not None:
+        raise HTTPException(status_code=400, detail="Only one of 'before' or 'after' can be specified")
+
     try:
-        # 呼叫 message_service.py 中已有的 get_message_history 函數
-        messages = await get_message_history(redis_client, session_id)
-        
-        # 🌟 確保回傳格式為 {"messages": [...] }，這與前端預期一致
-        print(f"📤 返回 {len(messages)} 條聊天歷史紀錄給會話 {session_id}")
-        return {"messages": messages}
+        async def build():
+            page = await get_message_page(redis_client, session_id, limit, before=before, after=after)
+            # 🌟 確保回傳格式包含 {"messages": [...] }，這與前端預期一致
+            print(f"📤 返回 {len(page['messages'])} 條聊天歷史紀錄給會話 {session_id}")
+            return page, None
+
+        version = (await get_session_versions(redis_client, [session_id]))[session_id]
+        return await versioned_json(request, version, ("messages", session_id, limit, before, after), build)
         
     except Exception as e:
         print(f"❌ 獲取聊天歷史失敗: {e}")
         # 發生錯誤時，返回空列表，避免前端崩潰
-        return {"messages": []}
\ No newline at end of file
+        return {"messages": [], "next_cursor": None, "has_more": False}
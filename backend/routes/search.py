@@ -1,8 +1,10 @@
 # routes/search.py
-from fastapi import APIRouter, Depends
+from typing import Literal, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
 from redis.asyncio import Redis
 from database.redis_client import get_redis_client
-from services.search_service import search_messages
+from services.search_service import search_messages, search_message_hits, get_hot_keywords
+from services.search_cache import search_cache
 
 router = APIRouter(prefix="/search_messages", tags=["Search"])
 
@@ -10,7 +12,53 @@ router = APIRouter(prefix="/search_messages", tags=["Search"])
 @router.get("")
 async def search_messages_endpoint(
     query: str,
+    mode: Literal["sessions", "messages"] = "sessions",
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    session_id: Optional[str] = None,
+    sender: Optional[str] = None,
+    start_ts: Optional[int] = None,
+    end_ts: Optional[int] = None,
+    sort: Literal["relevance", "newest"] = "relevance",
     redis_client: Redis = Depends(get_redis_client),
 ):
+    """
+    mode=sessions（預設）：回傳包含關鍵字的 session_id 列表。
+    mode=messages：透過 chatmessage_idx 回傳排序、分頁後的訊息命中（含 highlight 片段），
+    可依 session_id / sender / ts 範圍過濾，以 next_offset 取得下一頁。
+    """
+    if mode == "messages":
+        try:
+            return await search_message_hits(
+                query,
+                redis_client,
+                limit=limit,
+                offset=offset,
+                session_id=session_id,
+                sender=sender,
+                start_ts=start_ts,
+                end_ts=end_ts,
+                sort=sort,
+            )
+        except Exception as e:
+            print(f"❌ 訊息搜尋失敗: {e}")
+            raise HTTPException(status_code=500, detail=f"Failed to search messages: {str(e)}")
+
     session_ids = await search_messages(query, redis_client)
     return {"session_ids": session_ids}
+
+
+@router.get("/hot_keywords")
+async def hot_keywords_endpoint(
+    n: int = Query(10, ge=1, le=100),
+    window: Literal["hour", "day", "week"] = "day",
+    redis_client: Redis = Depends(get_redis_client),
+):
+    """最近一小時 / 一天 / 一週的熱門關鍵詞"""
+    return await get_hot_keywords(n, redis_client, window=window)
+
+
+@router.get("/cache_stats")
+async def search_cache_stats_endpoint():
+    """搜尋結果快取的命中 / 未命中 / 淘汰統計"""
+    return search_cache.stats()
@@ -1,13 +1,17 @@
 """
 會話相關的 API 路由
 """
-from fastapi import APIRouter, HTTPException, Depends, status
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, status
 from redis.asyncio import Redis
-from typing import List
+from typing import List, Literal, Optional
+from config import settings
 
 # 假設這些模型和服務已存在
 from models.session import ChatSession 
-from services.session_service import get_all_sessions, create_session, delete_session
+from services.session_service import get_all_sessions, create_session, delete_session, get_session_summary
+from services.deletion_service import get_job, list_pending_jobs
+from services.response_cache import versioned_json
+from services.version_service import get_global_version
 # 統一使用 get_redis_client 作為異步 Redis 客戶端的依賴
 from database.redis_client import get_redis_client 
 
@@ -20,14 +24,79 @@ router = APIRouter(prefix="/sessions", tags=["Sessions"])
     summary="獲取所有活動會話"
 )
 async def list_sessions(
+    request: Request,
+    limit: int = Query(settings.SESSION_PAGE_SIZE, ge=1, le=settings.SESSION_PAGE_SIZE_MAX),
+    cursor: Optional[str] = Query(None, description="上一頁回應的 X-Next-Cursor"),
+    order: Literal["created", "activity"] = "created",
     # 統一使用 get_redis_client
     redis_client: Redis = Depends(get_redis_client)
 ):
     """
-    獲取所有活動會話列表，用於側邊欄顯示。
+    獲取活動會話列表（新到舊），用於側邊欄顯示。
+    回應本體維持會話陣列；還有下一頁時以 X-Next-Cursor 標頭回傳游標。
+    ETag 取自全域版本號（任何會話的訊息或建立 / 刪除都會改變），未變動時回 304。
     """
-    sessions = await get_all_sessions(redis_client) 
-    return sessions
+    if cursor is not None:
+        try:
+            float(cursor.partition(":")[0])
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    async def build():
+        sessions, next_cursor = await get_all_sessions(redis_client, limit=limit, cursor=cursor, order=order)
+        headers = {"X-Next-Cursor": next_cursor} if next_cursor is not None else None
+        return sessions, headers
+
+    version = await get_global_version(redis_client)
+    return await versioned_json(request, version, ("sessions", limit, cursor, order), build)
+
+@router.get(
+    "/deletion_jobs",
+    summary="列出尚未完成（含已放棄、status=failed）的會話回收工作"
+)
+async def deletion_jobs(
+    redis_client: Redis = Depends(get_redis_client)
+):
+    return await list_pending_jobs(redis_client)
+
+@router.get(
+    "/deletion_jobs/{job_id}",
+    summary="查詢會話回收進度"
+)
+async def deletion_job(
+    job_id: str,
+    redis_client: Redis = Depends(get_redis_client)
+):
+    """
+    回傳回收工作的狀態（pending / running / retrying / failed / done）、目前階段、已處理的訊息數，
+    以及失敗次數（attempts）與最後一次錯誤（last_error）。
+    """
+    job = await get_job(redis_client, job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Deletion job '{job_id}' not found."
+        )
+    return job
+
+@router.get(
+    "/{session_id}/summary",
+    summary="獲取會話摘要"
+)
+async def session_summary(
+    session_id: str,
+    redis_client: Redis = Depends(get_redis_client)
+):
+    """
+    回傳會話的訊息數、最後活動時間與最後一則訊息預覽（由寫入路徑維護，不讀取訊息列表）。
+    """
+    summary = await get_session_summary(redis_client, session_id)
+    if summary is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Session ID '{session_id}' not found."
+        )
+    return summary
 
 @router.post(
     "/{session_id}", # 修正: 移除重複的 /sessions，路徑為 /sessions/{session_id}
@@ -36,13 +105,14 @@ async def list_sessions(
 )
 async def add_session(
     session_id: str,
+    user_id: Optional[str] = Query(None, description="建立會話的使用者（用於不重複活躍使用者統計）"),
     # 統一使用 get_redis_client
     redis_client: Redis = Depends(get_redis_client) 
 ):
     """
     使用指定的 ID 建立新的聊天會話，並發送一個 AI 歡迎訊息。
     """
-    await create_session(redis_client, session_id)
+    await create_session(redis_client, session_id, user_id=user_id)
     return {"message": f"Session {session_id} created successfully"}
 
 @router.delete(
@@ -55,12 +125,12 @@ async def remove_session(
     redis_client: Redis = Depends(get_redis_client)
 ):
     """
-    刪除會話及其所有訊息。
+    刪除會話：立即從列表移除，訊息等資料由背景工作回收（進度見 /sessions/deletion_jobs/{job_id}）。
     """
-    success = await delete_session(redis_client, session_id)
-    if not success:
+    job_id = await delete_session(redis_client, session_id)
+    if job_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, 
             detail=f"Session ID '{session_id}' not found."
         )
-    return {"message": f"Session {session_id} deleted successfully."}
\ No newline at end of file
+    return {"message": f"Session {session_id} deleted successfully.", "job_id": job_id}
\ No newline at end of file
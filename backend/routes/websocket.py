@@ -4,11 +4,38 @@ from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
 from services.message_service import save_message, get_message_history
 from database.redis_client import get_redis_client
 from redis.asyncio import Redis
+from config import settings
+from typing import AsyncIterator, List, Tuple
 import json
 import time
 
 router = APIRouter(tags=["WebSocket"])
 
+
+async def _stream_reply(websocket: WebSocket, deltas: AsyncIterator[str], ts: int) -> Tuple[str, bool]:
+    """
+    轉發 AI 增量文字，回傳 (完整內容, 前端是否仍連線)。
+    前端中途斷線時停止轉發但繼續接收到生成結束，讓回覆可以完整儲存。
+    """
+    parts: List[str] = []
+    connected = True
+    try:
+        await websocket.send_text(json.dumps({"type": "ai_start", "ts": ts}))
+    except (WebSocketDisconnect, RuntimeError):
+        connected = False
+
+    async for delta in deltas:
+        parts.append(delta)
+        if not connected:
+            continue
+        try:
+            await websocket.send_text(json.dumps({"type": "ai_delta", "ts": ts, "delta": delta}))
+        except (WebSocketDisconnect, RuntimeError):
+            connected = False
+            print(f"INFO: Client left during AI streaming, finishing reply in background (ts={ts}).")
+
+    return "".join(parts), connected
+
 @router.websocket("/ws/chat/{session_id}")
 async def websocket_chat(
     websocket: WebSocket, 
@@ -16,14 +43,29 @@ async def websocket_chat(
     # 🌟 修正：使用 Depends 獲取異步 Redis 客戶端
     redis_client: Redis = Depends(get_redis_client)
 ):
-    """WebSocket 聊天端點"""
-    from services.ai_service import get_ai_response
+    """
+    WebSocket 聊天端點
+
+    伺服器送出的訊框：
+    - 一般訊息（歷史、使用者訊息、完整的 AI 回覆）：{"sender", "content", "ts"}
+    - AI 回覆串流（AI_STREAMING=true）：
+        {"type": "ai_start", "ts"}            開始生成，ts 即最後儲存的 AI 訊息 ts
+        {"type": "ai_delta", "ts", "delta"}   增量文字
+      生成完成後儲存訊息，再送出一般訊息格式的完整回覆（前端以 ts 取代串流中的訊息）
+
+    AI_CONTEXT_ENABLED=true 時，模型會收到 token 預算內的先前對話與滾動摘要
+    （services/context_service.py），回覆儲存後在背景更新摘要。
+    """
+    from services.ai_service import get_ai_response, stream_ai_response
+    from services import context_service
     await websocket.accept()
     print(f"INFO: WebSocket connected for session: {session_id}")
     
     # 發送歷史訊息
     # 關鍵修正：get_message_history 需要 redis_client 參數
-    history = await get_message_history(redis_client, session_id)
+    history = await get_message_history(
+        redis_client, session_id, limit=settings.WS_HISTORY_LIMIT or None
+    )
     for msg in history:
         await websocket.send_text(json.dumps(msg))
     
@@ -32,40 +74,38 @@ async def websocket_chat(
             data_raw = await websocket.receive_text()
             data = json.loads(data_raw)
             
-            # 儲存用戶訊息
+            # 儲存用戶訊息（含 chat_stream 記錄）
             await save_message(redis_client, session_id, data) # 傳遞 redis_client
             await websocket.send_text(json.dumps(data))
             
-            # Stream 記錄
-            await redis_client.xadd("chat_stream", fields={ # 使用 redis_client
-                "session_id": session_id,
-                "sender": data["sender"],
-                "content": data["content"],
-                "ts": str(data["ts"]),
-                "deleted": "false"
-            })
-            
             # 獲取 AI 回應
             if data.get("sender") == "me":
-                ai_response_content = await get_ai_response(data["content"])
+                context = None
+                if settings.AI_CONTEXT_ENABLED:
+                    context = await context_service.build_context(
+                        redis_client, session_id, data["content"], before_ts=int(data["ts"])
+                    )
+                ai_ts = int(time.time() * 1000)
+                if settings.AI_STREAMING:
+                    ai_response_content, connected = await _stream_reply(
+                        websocket, stream_ai_response(data["content"], context, session_id), ai_ts
+                    )
+                else:
+                    ai_response_content, connected = await get_ai_response(data["content"], context, session_id), True
                 
                 ai_msg = {
                     "sender": "AI",
                     "content": ai_response_content,
-                    "ts": int(time.time() * 1000)
+                    "ts": ai_ts
                 }
                 
+                # 即使前端已斷線，完整回覆仍會被儲存，重新連線時可從歷史看到
                 await save_message(redis_client, session_id, ai_msg) # 傳遞 redis_client
+                if settings.AI_CONTEXT_ENABLED:
+                    context_service.schedule_refresh(redis_client, session_id)
+                if not connected:
+                    raise WebSocketDisconnect()
                 await websocket.send_text(json.dumps(ai_msg))
-                
-                # Stream 記錄
-                await redis_client.xadd("chat_stream", fields={ # 使用 redis_client
-                    "session_id": session_id,
-                    "sender": "AI",
-                    "content": ai_response_content,
-                    "ts": str(ai_msg["ts"]),
-                    "deleted": "false"
-                })
     
     except WebSocketDisconnect:
         print(f"INFO: WebSocket disconnected for session: {session_id}")
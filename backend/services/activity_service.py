@@ -0,0 +1,98 @@
+"""
+會話活躍度統計（寫入時累加）
+
+- activity_hourly:{session_id}  Hash，field = "YYYY-MM-DD HH:00"（台灣時間），value = 訊息數
+- activity_daily:{session_id}   Hash，field = "YYYY-MM-DD"，value = 訊息數
+
+只統計內容非空的使用者訊息（sender=me）。save / restore 腳本只在 ZADD 確實新增訊息時 +1
+（同一個 ts 只算一次），delete 腳本對實際刪除的訊息 -1，歸零的時段會被移除。
+趨勢查詢只需讀取一個小 hash，與 chat_stream 的長度無關。
+
+舊資料以 python manage.py backfill-activity 回填。
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import redis.asyncio as redis
+
+from services.version_service import bump_versions
+
+TZ = timezone(timedelta(hours=8))  # 台灣時間
+
+
+def hourly_key(session_id: str) -> str:
+    return f"activity_hourly:{session_id}"
+
+
+def daily_key(session_id: str) -> str:
+    return f"activity_daily:{session_id}"
+
+
+def is_counted(msg_data: Dict[str, Any]) -> bool:
+    return (
+        str(msg_data.get("sender", "")).lower() == "me"
+        and bool(str(msg_data.get("content", "")).strip())
+    )
+
+
+def time_slots(ts_ms: Any) -> Tuple[str, str]:
+    dt = datetime.fromtimestamp(int(ts_ms) / 1000.0, tz=TZ)
+    return dt.strftime("%Y-%m-%d %H:00"), dt.strftime("%Y-%m-%d")
+
+
+def slot_args(msg_data: Dict[str, Any]) -> List[str]:
+    """寫入腳本使用的 [小時時段, 日期]；不計入統計的訊息回傳空字串"""
+    if not is_counted(msg_data):
+        return ["", ""]
+    return list(time_slots(msg_data["ts"]))
+
+
+async def _trend(redis_client: redis.Redis, key: str) -> List[Dict[str, Any]]:
+    counts = await redis_client.hgetall(key)
+    return [
+        {"time_slot": slot, "count": int(count)}
+        for slot, count in sorted(counts.items())
+        if int(count) > 0
+    ]
+
+
+async def get_hourly_trend(redis_client: redis.Redis, session_id: str) -> List[Dict[str, Any]]:
+    return await _trend(redis_client, hourly_key(session_id))
+
+
+async def get_daily_trend(redis_client: redis.Redis, session_id: str) -> List[Dict[str, Any]]:
+    return await _trend(redis_client, daily_key(session_id))
+
+
+async def backfill(redis_client: redis.Redis, session_ids: Optional[Iterable[str]] = None) -> Dict[str, int]:
+    """從訊息資料重新計算所有（或指定）會話的小時 / 日統計（覆蓋現有值）"""
+    from services import message_store  # 避免循環導入（message_store 寫入時需要本模組的 key）
+
+    selected = set(session_ids) if session_ids is not None else None
+    session_count = 0
+    message_count = 0
+
+    async for session_id in message_store.iter_session_ids(redis_client):
+        if selected is not None and session_id not in selected:
+            continue
+        hourly: Dict[str, int] = {}
+        daily: Dict[str, int] = {}
+        async for messages in message_store.iter_batches(redis_client, session_id):
+            for msg in messages:
+                if not is_counted(msg):
+                    continue
+                hour, day = time_slots(msg["ts"])
+                hourly[hour] = hourly.get(hour, 0) + 1
+                daily[day] = daily.get(day, 0) + 1
+                message_count += 1
+
+        async with redis_client.pipeline() as pipe:
+            pipe.unlink(hourly_key(session_id), daily_key(session_id))
+            if hourly:
+                pipe.hset(hourly_key(session_id), mapping=hourly)
+                pipe.hset(daily_key(session_id), mapping=daily)
+            bump_versions(pipe, session_id)  # 讓趨勢端點的 ETag / 回應快取失效
+            await pipe.execute()
+        session_count += 1
+
+    print(f"✅ 活躍度統計回填完成：{session_count} 個會話，{message_count} 則使用者訊息")
+    return {"sessions": session_count, "messages": message_count}
@@ -0,0 +1,128 @@
+"""
+AI 回覆快取（AI_CACHE_ENABLED=true 時啟用，預設關閉）
+
+常見問題會被不同使用者反覆詢問，每次都要等待數秒並消耗 token。相同的請求改為直接回傳先前的回覆：
+
+- 快取 key = sha1(模型、參數、正規化後的訊息)；正規化為 NFKC、轉小寫、合併空白、去掉結尾標點，
+  因此「你好？」與「你好 ?」視為同一個問題。上下文（摘要、近期對話）也在 key 內，
+  只有對話狀態相同時才會命中，新會話的第一個問題最常命中
+- 儲存沿用 SearchResultCache：行程內 LRU（AI_CACHE_SIZE）+ Redis ai_cache:{key}（AI_CACHE_TTL_SECONDS），
+  多個 worker 共用
+- 相同的請求正在呼叫上游時，後到的請求等待同一個結果（in-flight 合併），不重複呼叫；
+  第一個請求失敗時，由其中一個等待者重新呼叫上游，其餘繼續等待
+- 只快取成功的完整回覆，失敗訊息與中斷的串流不會寫入
+
+統計（GET /ai/cache_stats）：命中 / 未命中 / 命中率、合併等待的請求數（coalesced）與其中取得結果的數量（shared）、
+省下的上游呼叫數、命中時省下的上游延遲（以原本呼叫的耗時計）。
+"""
+import asyncio
+import re
+from typing import Any, Dict, Optional
+
+from config import settings
+from database.redis_client import get_redis_client
+from services.search_cache import SearchResultCache
+from utils.tokenizer import normalize_text
+
+REDIS_KEY_PREFIX = "ai_cache:"
+# 快取值格式版本（格式變更時遞增，舊值自動失效）
+CACHE_VERSION = 1
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_TRAILING_PUNCT = " ?!.。~…"
+
+
+def normalize_prompt(text: str) -> str:
+    text = _WHITESPACE_RE.sub(" ", normalize_text(text)).strip()
+    return text.rstrip(_TRAILING_PUNCT) or text
+
+
+def cache_key(args: Dict[str, Any]) -> str:
+    """chat completion 參數的快取 key"""
+    messages = [
+        {"role": m["role"], "content": normalize_prompt(str(m.get("content") or ""))}
+        for m in args["messages"]
+    ]
+    params = {name: value for name, value in args.items() if name != "messages"}
+    return SearchResultCache.make_key(params, messages)
+
+
+class AIResponseCache:
+    """Redis + 行程內 LRU 的回覆快取，附帶 in-flight 合併"""
+
+    def __init__(self, max_size: int, ttl_seconds: int):
+        self.store = SearchResultCache(max_size, ttl_seconds, use_redis=True, key_prefix=REDIS_KEY_PREFIX)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.coalesced = 0
+        self.shared = 0
+        self.stored = 0
+        self.errors = 0
+        self.latency_saved_ms = 0.0
+
+    async def get(self, key: str) -> Optional[str]:
+        try:
+            value = await self.store.get(await get_redis_client(), key, CACHE_VERSION)
+        except Exception as e:
+            # 快取無法使用時直接呼叫上游
+            self.errors += 1
+            print(f"WARNING: AI cache lookup failed: {e}")
+            return None
+        if value is None:
+            return None
+        self.latency_saved_ms += value["latency_ms"]
+        return value["content"]
+
+    async def set(self, key: str, content: str, latency_ms: float) -> None:
+        try:
+            await self.store.set(
+                await get_redis_client(), key, CACHE_VERSION,
+                {"content": content, "latency_ms": round(latency_ms, 1)},
+            )
+            self.stored += 1
+        except Exception as e:
+            self.errors += 1
+            print(f"WARNING: AI cache store failed: {e}")
+
+    def join_inflight(self, key: str) -> Optional[asyncio.Future]:
+        """
+        相同請求正在進行時回傳其結果的 Future（等待者）；
+        否則登記為負責呼叫上游的請求並回傳 None，完成後必須呼叫 release。
+        """
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return future
+        self._inflight[key] = asyncio.get_running_loop().create_future()
+        return None
+
+    def release(self, key: str, content: Optional[str]) -> None:
+        """結束 in-flight 請求；content 為 None 表示失敗，等待者會重新登記並重試"""
+        future = self._inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(content)
+
+    async def wait(self, future: asyncio.Future) -> Optional[str]:
+        # shield：等待者被取消時不影響其他等待者
+        content = await asyncio.shield(future)
+        if content is not None:
+            self.shared += 1
+        return content
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": settings.AI_CACHE_ENABLED,
+            **self.store.stats(),
+            "inflight": len(self._inflight),
+            "coalesced": self.coalesced,
+            "shared": self.shared,
+            "upstream_calls_saved": self.store.hits + self.shared,
+            "stored": self.stored,
+            "errors": self.errors,
+            "latency_saved_ms": round(self.latency_saved_ms, 1),
+        }
+
+
+ai_cache = AIResponseCache(
+    max_size=settings.AI_CACHE_SIZE,
+    ttl_seconds=settings.AI_CACHE_TTL_SECONDS,
+)
@@ -0,0 +1,412 @@
+"""
+多部署路由（Azure OpenAI）
+
+只有一個部署時，它一變慢或被限流，所有對話都會跟著卡住。AI_DEPLOYMENTS 設定多個部署
+（未設定時只有 AZURE_OPENAI_* 這一個），每個請求在排程器取得名額後由這裡挑選部署：
+
+- 可用：未熔斷、未被 429 限流、進行中未達該部署的 max_concurrency；
+  優先挑 token 配額（tokens_per_minute）足夠的部署
+- 挑選：依權重隨機抽兩個，取「(進行中 + 1) × 延遲 EWMA ÷ 權重」較低者（power of two choices），
+  兼顧負載、延遲與權重，也不會讓所有請求同時湧向同一個最快的部署；還沒有延遲樣本的部署視為最快
+- 熔斷：連續 AI_BREAKER_FAILURES 次可重試錯誤（5xx、連線錯誤）後停用 AI_BREAKER_COOLDOWN_SECONDS 秒，
+  之後半開放行一個試探請求，成功即恢復；429 只依 Retry-After 暫停該部署，不計入熔斷
+- 失敗轉移：可重試的錯誤立即改送下一個可用部署；都失敗時拋出最後一個錯誤，由排程器退避重試
+- 對沖（AI_HEDGE_ENABLED）：主要部署超過其 p95 延遲（樣本不足或較短時用 AI_HEDGE_MIN_DELAY_MS）
+  仍未回應（串流為第一個 token），向另一個部署送出相同請求，採用先回應者並取消另一個。
+  對沖會多消耗配額，預設關閉
+
+延遲樣本：串流為第一個 token 的時間，非串流為完整回應時間。
+本機測試可用 python manage.py mock-ai 啟動模擬部署（見 utils/mock_openai.py）。
+統計：GET /ai/deployments。
+"""
+import asyncio
+import json
+import random
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from openai import APIStatusError
+
+from config import settings
+from services.ai_scheduler import TokenBucket, UpstreamUnavailable, estimate_cost, retry_delay
+from utils.token_counter import count_tokens
+
+LATENCY_SAMPLES = 200
+MIN_P95_SAMPLES = 20
+EWMA_ALPHA = 0.2
+# 所有部署都達到並行上限時，多久後再試
+BUSY_RETRY_SECONDS = 0.5
+
+
+class Deployment:
+    """單一部署的設定與即時狀態（負載、延遲、熔斷）"""
+
+    def __init__(
+        self,
+        name: str,
+        endpoint: str,
+        api_key: str,
+        model: str,
+        api_version: str,
+        weight: float = 1.0,
+        tokens_per_minute: int = 0,
+        max_concurrency: int = 0,
+    ):
+        self.name = name
+        self.endpoint = (endpoint or "").rstrip("/")
+        self.api_key = api_key
+        self.model = model
+        self.api_version = api_version
+        self.weight = max(float(weight), 0.01)
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(tokens_per_minute)
+        self.in_flight = 0
+        self.latency_ms: Optional[float] = None
+        self._samples: Deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self.failures = 0
+        self.open_until = 0.0
+        self.throttled_until = 0.0
+        self.trial_in_flight = False
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.hedge_wins = 0
+
+    @classmethod
+    def from_config(cls, data: Dict[str, Any], index: int) -> "Deployment":
+        return cls(
+            name=str(data.get("name") or f"deployment-{index}"),
+            endpoint=data["endpoint"],
+            api_key=data.get("api_key") or settings.AZURE_OPENAI_API_KEY,
+            model=data.get("model") or settings.AZURE_OPENAI_MODEL,
+            api_version=data.get("api_version") or settings.AZURE_OPENAI_API_VERSION,
+            weight=float(data.get("weight", 1)),
+            tokens_per_minute=int(data.get("tokens_per_minute", 0)),
+            max_concurrency=int(data.get("max_concurrency", 0)),
+        )
+
+    # ----- 狀態 -----
+
+    def state(self, now: float) -> str:
+        if self.failures >= settings.AI_BREAKER_FAILURES:
+            return "open" if now < self.open_until else "half_open"
+        if now < self.throttled_until:
+            return "throttled"
+        return "closed"
+
+    def unavailable_for(self, now: float) -> float:
+        """還要多久才能接受新請求（0 = 現在可用）"""
+        state = self.state(now)
+        if state == "open":
+            return self.open_until - now
+        if state == "half_open" and self.trial_in_flight:
+            return BUSY_RETRY_SECONDS
+        if state == "throttled":
+            return self.throttled_until - now
+        if self.max_concurrency and self.in_flight >= self.max_concurrency:
+            return BUSY_RETRY_SECONDS
+        return 0.0
+
+    def p95_ms(self) -> Optional[float]:
+        if len(self._samples) < MIN_P95_SAMPLES:
+            return None
+        samples = sorted(self._samples)
+        return samples[int(len(samples) * 0.95)]
+
+    # ----- 記錄 -----
+
+    def begin(self, cost: int) -> None:
+        if self.state(time.monotonic()) == "half_open":
+            self.trial_in_flight = True
+        self.in_flight += 1
+        self.requests += 1
+        self.bucket.take(self.bucket.clamp(cost))
+
+    def end(self) -> None:
+        self.in_flight -= 1
+        self.trial_in_flight = False
+
+    def observe_latency(self, latency_ms: float) -> None:
+        self._samples.append(latency_ms)
+        if self.latency_ms is None:
+            self.latency_ms = latency_ms
+        else:
+            self.latency_ms += EWMA_ALPHA * (latency_ms - self.latency_ms)
+
+    def record_success(self) -> None:
+        if self.failures >= settings.AI_BREAKER_FAILURES:
+            print(f"INFO: AI deployment '{self.name}' recovered, circuit closed.")
+        self.failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self, error: Exception) -> None:
+        self.errors += 1
+        now = time.monotonic()
+        if isinstance(error, APIStatusError) and error.status_code == 429:
+            self.throttled += 1
+            self.throttled_until = now + (retry_delay(error, 0) or settings.AI_RETRY_BASE_SECONDS)
+            return
+        self.failures += 1
+        if self.failures >= settings.AI_BREAKER_FAILURES:
+            self.open_until = now + settings.AI_BREAKER_COOLDOWN_SECONDS
+            print(
+                f"WARNING: AI deployment '{self.name}' circuit open for "
+                f"{settings.AI_BREAKER_COOLDOWN_SECONDS:.0f}s after {self.failures} failures: {error}"
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        p95 = self.p95_ms()
+        return {
+            "name": self.name,
+            "endpoint": self.endpoint,
+            "model": self.model,
+            "weight": self.weight,
+            "state": self.state(time.monotonic()),
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "tokens_per_minute": self.bucket.tokens_per_minute,
+            "tokens_available": self.bucket.available,
+            "latency_ewma_ms": round(self.latency_ms, 1) if self.latency_ms is not None else None,
+            "latency_p95_ms": round(p95, 1) if p95 is not None else None,
+            "requests": self.requests,
+            "errors": self.errors,
+            "throttled": self.throttled,
+            "consecutive_failures": self.failures,
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+def load_deployments() -> List[Deployment]:
+    """從 AI_DEPLOYMENTS 讀取部署清單；未設定時使用 AZURE_OPENAI_* 單一部署"""
+    if settings.AI_DEPLOYMENTS.strip():
+        entries = json.loads(settings.AI_DEPLOYMENTS)
+        if entries:
+            return [Deployment.from_config(entry, i) for i, entry in enumerate(entries)]
+    return [Deployment(
+        name="default",
+        endpoint=settings.AZURE_OPENAI_ENDPOINT,
+        api_key=settings.AZURE_OPENAI_API_KEY,
+        model=settings.AZURE_OPENAI_MODEL,
+        api_version=settings.AZURE_OPENAI_API_VERSION,
+    )]
+
+
+class AIRouter:
+    """在多個部署之間挑選、失敗轉移與對沖"""
+
+    def __init__(self, deployments: List[Deployment]):
+        self.deployments = deployments
+        self.hedges = 0
+        self.failovers = 0
+
+    def select(self, cost: int, exclude: Tuple[Deployment, ...] = ()) -> Deployment:
+        now = time.monotonic()
+        others = [d for d in self.deployments if d not in exclude]
+        candidates = [d for d in others if d.unavailable_for(now) == 0]
+        if not candidates:
+            retry_after = min((d.unavailable_for(now) for d in others), default=settings.AI_BREAKER_COOLDOWN_SECONDS)
+            raise UpstreamUnavailable("No AI deployment available", retry_after)
+
+        funded = [d for d in candidates if d.bucket.wait_time(d.bucket.clamp(cost)) == 0] or candidates
+        if len(funded) == 1:
+            return funded[0]
+        first = random.choices(funded, weights=[d.weight for d in funded])[0]
+        rest = [d for d in funded if d is not first]
+        second = random.choices(rest, weights=[d.weight for d in rest])[0]
+
+        known = [d.latency_ms for d in funded if d.latency_ms is not None]
+        default_latency = min(known) if known else 1.0
+
+        def score(d: Deployment) -> float:
+            latency = d.latency_ms if d.latency_ms is not None else default_latency
+            return (d.in_flight + 1) * latency / d.weight
+
+        return min((first, second), key=score)
+
+    def _hedge_delay(self, primary: Deployment) -> Optional[float]:
+        if not settings.AI_HEDGE_ENABLED or len(self.deployments) < 2:
+            return None
+        return max(settings.AI_HEDGE_MIN_DELAY_MS, primary.p95_ms() or 0) / 1000
+
+    # ----- 非串流 -----
+
+    async def _attempt(
+        self, d: Deployment, cost: int, prompt: int, call: Callable[[Deployment], Awaitable[str]]
+    ) -> str:
+        d.begin(cost)
+        started = time.perf_counter()
+        try:
+            content = await call(d)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            d.record_failure(e)
+            raise
+        finally:
+            d.end()
+        d.observe_latency((time.perf_counter() - started) * 1000)
+        d.record_success()
+        d.bucket.refund(cost - prompt - count_tokens(content))
+        return content
+
+    async def complete(self, args: Dict[str, Any], call: Callable[[Deployment], Awaitable[str]]) -> str:
+        """以 call(deployment) 取得完整回覆（挑選部署、失敗轉移、對沖）"""
+        cost = estimate_cost(args)
+        prompt = cost - int(args.get("max_tokens") or 0)
+        tried: List[Deployment] = []
+        pending: Dict[asyncio.Future, Deployment] = {}
+        last_error: Optional[Exception] = None
+
+        def launch() -> Deployment:
+            d = self.select(cost, exclude=tuple(tried))
+            tried.append(d)
+            pending[asyncio.ensure_future(self._attempt(d, cost, prompt, call))] = d
+            return d
+
+        primary = launch()
+        hedged = False
+        try:
+            while True:
+                delay = None if hedged else self._hedge_delay(primary)
+                done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    try:
+                        launch()
+                        self.hedges += 1
+                    except UpstreamUnavailable:
+                        pass
+                    continue
+
+                for task in done:
+                    d = pending.pop(task)
+                    try:
+                        content = task.result()
+                    except Exception as e:
+                        if retry_delay(e, 0) is None:
+                            raise
+                        last_error = e
+                        continue
+                    if hedged and d is not primary:
+                        d.hedge_wins += 1
+                    return content
+
+                if not pending:
+                    try:
+                        launch()
+                        self.failovers += 1
+                    except UpstreamUnavailable:
+                        raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    # ----- 串流 -----
+
+    async def _tracked_stream(
+        self, d: Deployment, cost: int, prompt: int, call: Callable[[Deployment], AsyncIterator[str]]
+    ) -> AsyncIterator[str]:
+        d.begin(cost)
+        started = time.perf_counter()
+        produced: List[str] = []
+        try:
+            async for delta in call(d):
+                if not produced:
+                    d.observe_latency((time.perf_counter() - started) * 1000)
+                produced.append(delta)
+                yield delta
+        except Exception as e:
+            d.record_failure(e)
+            raise
+        finally:
+            d.end()
+            d.bucket.refund(cost - prompt - count_tokens("".join(produced)))
+        if not produced:
+            d.observe_latency((time.perf_counter() - started) * 1000)
+        d.record_success()
+
+    async def stream(
+        self, args: Dict[str, Any], call: Callable[[Deployment], AsyncIterator[str]]
+    ) -> AsyncIterator[str]:
+        """轉發 call(deployment) 的增量文字；第一個 token 之前的失敗會轉移，對沖以第一個 token 為準"""
+        cost = estimate_cost(args)
+        prompt = cost - int(args.get("max_tokens") or 0)
+        tried: List[Deployment] = []
+        attempts: Dict[asyncio.Future, Tuple[Deployment, AsyncIterator[str]]] = {}
+        last_error: Optional[Exception] = None
+
+        def launch() -> Deployment:
+            d = self.select(cost, exclude=tuple(tried))
+            tried.append(d)
+            gen = self._tracked_stream(d, cost, prompt, call)
+            attempts[asyncio.ensure_future(gen.__anext__())] = (d, gen)
+            return d
+
+        primary = launch()
+        hedged = False
+        winner: Optional[Tuple[Deployment, AsyncIterator[str], Optional[str]]] = None
+        try:
+            while winner is None:
+                delay = None if hedged else self._hedge_delay(primary)
+                done, _ = await asyncio.wait(attempts, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    try:
+                        launch()
+                        self.hedges += 1
+                    except UpstreamUnavailable:
+                        pass
+                    continue
+
+                for task in done:
+                    d, gen = attempts.pop(task)
+                    try:
+                        first = task.result()
+                    except StopAsyncIteration:
+                        first = None
+                    except Exception as e:
+                        if retry_delay(e, 0) is None:
+                            raise
+                        last_error = e
+                        continue
+                    winner = (d, gen, first)
+                    break
+
+                if winner is None and not attempts:
+                    try:
+                        launch()
+                        self.failovers += 1
+                    except UpstreamUnavailable:
+                        raise last_error
+        finally:
+            # 取消其餘的嘗試（對沖落敗者）
+            for task, (_, gen) in attempts.items():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await gen.aclose()
+
+        d, gen, first = winner
+        if hedged and d is not primary:
+            d.hedge_wins += 1
+        try:
+            if first is None:
+                return
+            yield first
+            async for delta in gen:
+                yield delta
+        finally:
+            await gen.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hedge_enabled": settings.AI_HEDGE_ENABLED,
+            "hedges": self.hedges,
+            "failovers": self.failovers,
+            "deployments": [d.stats() for d in self.deployments],
+        }
+
+
+ai_router = AIRouter(load_deployments())
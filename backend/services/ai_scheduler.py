@@ -0,0 +1,337 @@
+"""
+AI 請求排程（所有上游模型呼叫都經過這裡）
+
+突發流量時若每則訊息都立刻呼叫模型，共用的部署配額很快就會回 429。排程器在行程內：
+
+- 同時進行的呼叫最多 AI_MAX_CONCURRENCY 個（串流期間持續佔用）
+- 每分鐘 token 預算 AI_TOKENS_PER_MINUTE（token bucket，連續補充；0 = 不限制）
+  每個請求預扣「提示估算 token + max_tokens」，完成後依實際輸出估算退回多扣的部分
+- 依會話排隊，會話之間輪流（round-robin）：單一會話連續送出大量請求時不會擋住其他會話
+- 排隊超過 AI_QUEUE_TIMEOUT_SECONDS 放棄（QueueTimeout），由呼叫端回覆忙碌訊息
+- 429 / 408 / 409 / 5xx / 連線錯誤最多重試 AI_RETRY_MAX_ATTEMPTS 次：
+  有 Retry-After（retry-after-ms / retry-after）時依其等待，否則指數退避加隨機抖動；
+  429 時整個排程器暫停到 Retry-After 結束（配額是共用的，其他請求送出也只會再被拒絕）；
+  等待重試期間釋放名額。串流已送出部分內容後不再重試
+
+OpenAI 客戶端的內建重試需關閉（max_retries=0），避免重試次數相乘。
+統計（GET /ai/scheduler_stats）：排隊數、進行中、可用 token、暫停剩餘時間、重試 / 429 次數、排隊等待時間分佈。
+"""
+import asyncio
+import random
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional
+
+from openai import APIConnectionError, APIStatusError
+
+from config import settings
+from utils.token_counter import count_message_tokens, count_tokens
+
+RETRYABLE_STATUS = {408, 409, 429}
+DEFAULT_LANE = "default"
+WAIT_SAMPLES = 500
+
+
+class QueueTimeout(Exception):
+    """排隊等待超過 AI_QUEUE_TIMEOUT_SECONDS"""
+
+
+class UpstreamUnavailable(Exception):
+    """目前沒有可用的部署（熔斷 / 被限流中），retry_after 秒後再試"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """每分鐘 tokens_per_minute 個 token、連續補充的 token bucket（0 = 不限制）"""
+
+    def __init__(self, tokens_per_minute: int):
+        self.tokens_per_minute = tokens_per_minute
+        self._tokens = float(tokens_per_minute)
+        self._refilled_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if self.tokens_per_minute:
+            rate = self.tokens_per_minute / 60
+            self._tokens = min(float(self.tokens_per_minute), self._tokens + (now - self._refilled_at) * rate)
+        self._refilled_at = now
+
+    def clamp(self, cost: int) -> int:
+        # 超過整個預算的請求只能等 bucket 滿了再送出
+        return min(cost, self.tokens_per_minute) if self.tokens_per_minute else cost
+
+    def wait_time(self, cost: int) -> float:
+        """還要等多少秒才有 cost 個 token（0 = 現在就夠）"""
+        if not self.tokens_per_minute:
+            return 0.0
+        self._refill()
+        return max(0.0, (cost - self._tokens) * 60 / self.tokens_per_minute)
+
+    def take(self, cost: int) -> None:
+        if self.tokens_per_minute:
+            self._refill()
+            self._tokens -= cost
+
+    def refund(self, tokens: int) -> None:
+        if self.tokens_per_minute and tokens > 0:
+            self._refill()
+            self._tokens = min(float(self.tokens_per_minute), self._tokens + tokens)
+
+    @property
+    def available(self) -> Optional[int]:
+        if not self.tokens_per_minute:
+            return None
+        self._refill()
+        return round(self._tokens)
+
+
+@dataclass
+class _Ticket:
+    future: asyncio.Future
+    cost: int
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+def estimate_cost(args: Dict[str, Any]) -> int:
+    """一次 chat completion 預扣的 token：提示估算 + max_tokens"""
+    return sum(count_message_tokens(m) for m in args["messages"]) + int(args.get("max_tokens") or 0)
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+def retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """可重試的錯誤回傳等待秒數，否則回傳 None"""
+    if isinstance(error, UpstreamUnavailable):
+        return min(error.retry_after, settings.AI_RETRY_MAX_SECONDS)
+    if isinstance(error, APIStatusError):
+        if error.status_code not in RETRYABLE_STATUS and error.status_code < 500:
+            return None
+    elif not isinstance(error, APIConnectionError):
+        return None
+    delay = _retry_after(error)
+    if delay is None:
+        delay = settings.AI_RETRY_BASE_SECONDS * (2 ** attempt) * random.uniform(0.5, 1.0)
+    return min(delay, settings.AI_RETRY_MAX_SECONDS)
+
+
+def _is_throttled(error: Exception) -> bool:
+    return isinstance(error, APIStatusError) and error.status_code == 429
+
+
+class AIScheduler:
+    """並行上限 + TPM token bucket + 會話間輪流的排程器"""
+
+    def __init__(self, max_concurrency: int, tokens_per_minute: int, queue_timeout: float):
+        self.max_concurrency = max(1, max_concurrency)
+        self.tokens_per_minute = tokens_per_minute
+        self.queue_timeout = queue_timeout
+        self._queues: "OrderedDict[str, Deque[_Ticket]]" = OrderedDict()
+        self._active = 0
+        self._bucket = TokenBucket(tokens_per_minute)
+        self._paused_until = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_at = 0.0
+        self._waits: Deque[float] = deque(maxlen=WAIT_SAMPLES)
+        self.granted = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.throttled = 0
+
+    # ----- 派發 -----
+
+    def _wake_after(self, delay: float) -> None:
+        wake_at = time.monotonic() + delay
+        if self._timer is not None and self._timer_at <= wake_at:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer_at = wake_at
+        self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        now = time.monotonic()
+        if now < self._paused_until:
+            self._wake_after(self._paused_until - now)
+            return
+
+        while self._queues and self._active < self.max_concurrency:
+            lane, queue = next(iter(self._queues.items()))
+            while queue and queue[0].future.done():  # 已逾時 / 取消
+                queue.popleft()
+            if not queue:
+                del self._queues[lane]
+                continue
+
+            ticket = queue[0]
+            wait = self._bucket.wait_time(ticket.cost)
+            if wait > 0:
+                self._wake_after(wait)
+                return
+
+            queue.popleft()
+            # 輪流：這個會話排到最後
+            if queue:
+                self._queues.move_to_end(lane)
+            else:
+                del self._queues[lane]
+            self._active += 1
+            self._bucket.take(ticket.cost)
+            self.granted += 1
+            self._waits.append((now - ticket.enqueued_at) * 1000)
+            ticket.future.set_result(None)
+
+    async def acquire(self, lane: str, cost: int) -> int:
+        """排隊取得一個名額，回傳實際預扣的 token（release 時傳回）"""
+        cost = self._bucket.clamp(cost)
+        ticket = _Ticket(asyncio.get_running_loop().create_future(), cost)
+        self._queues.setdefault(lane or DEFAULT_LANE, deque()).append(ticket)
+        self._dispatch()
+        try:
+            await asyncio.wait_for(ticket.future, self.queue_timeout or None)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise QueueTimeout(f"AI request queued longer than {self.queue_timeout}s")
+        except BaseException:
+            # 已取得名額後才被取消：歸還
+            if ticket.future.done() and not ticket.future.cancelled():
+                self.release(cost)
+            raise
+        return cost
+
+    def release(self, cost: int, used: Optional[int] = None) -> None:
+        """歸還名額；used 為實際用量估算時退回多扣的 token"""
+        self._active -= 1
+        if used is not None:
+            self._bucket.refund(cost - used)
+        self._dispatch()
+
+    def pause(self, seconds: float) -> None:
+        """暫停派發（共用配額被 429 時）"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    @asynccontextmanager
+    async def slot(self, lane: str, cost: int) -> AsyncIterator[Dict[str, Optional[int]]]:
+        """
+        async with scheduler.slot(session_id, cost) as usage: ...
+        結束前可設定 usage["tokens"]（提示 + 輸出的實際用量估算），讓多扣的 token 退回。
+        """
+        reserved = await self.acquire(lane, cost)
+        usage: Dict[str, Optional[int]] = {"tokens": None}
+        try:
+            yield usage
+        finally:
+            self.release(reserved, usage["tokens"])
+
+    # ----- 重試 -----
+
+    async def _backoff(self, error: Exception, attempt: int) -> bool:
+        delay = retry_delay(error, attempt)
+        if delay is None or attempt >= settings.AI_RETRY_MAX_ATTEMPTS:
+            return False
+        self.retries += 1
+        if _is_throttled(error):
+            self.throttled += 1
+            self.pause(delay)
+        print(f"WARNING: AI request failed ({error}); retry {attempt + 1} in {delay:.1f}s")
+        await asyncio.sleep(delay)
+        return True
+
+    async def run(self, lane: str, args: Dict[str, Any], call: Callable[[], Awaitable[str]]) -> str:
+        """排程並呼叫 call()（不串流），可重試的錯誤在釋放名額後等待重試"""
+        cost = estimate_cost(args)
+        prompt = cost - int(args.get("max_tokens") or 0)
+        attempt = 0
+        while True:
+            try:
+                async with self.slot(lane, cost) as usage:
+                    content = await call()
+                    usage["tokens"] = prompt + count_tokens(content)
+                    return content
+            except (APIStatusError, APIConnectionError, UpstreamUnavailable) as e:
+                if not await self._backoff(e, attempt):
+                    raise
+                attempt += 1
+
+    async def stream(
+        self, lane: str, args: Dict[str, Any], call: Callable[[], AsyncIterator[str]]
+    ) -> AsyncIterator[str]:
+        """排程並轉發 call() 的增量文字；尚未產生內容前失敗才重試"""
+        cost = estimate_cost(args)
+        prompt = cost - int(args.get("max_tokens") or 0)
+        attempt = 0
+        while True:
+            parts: List[str] = []
+            try:
+                async with self.slot(lane, cost) as usage:
+                    try:
+                        async for delta in call():
+                            parts.append(delta)
+                            yield delta
+                    finally:
+                        usage["tokens"] = prompt + count_tokens("".join(parts))
+                    return
+            except (APIStatusError, APIConnectionError, UpstreamUnavailable) as e:
+                if parts or not await self._backoff(e, attempt):
+                    raise
+                attempt += 1
+
+    # ----- 統計 -----
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._waits)
+
+        def percentile(p: float) -> float:
+            return round(waits[min(len(waits) - 1, int(len(waits) * p))], 1) if waits else 0.0
+
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self._active,
+            "queued": sum(1 for queue in self._queues.values() for t in queue if not t.future.done()),
+            "queued_sessions": len(self._queues),
+            "tokens_per_minute": self.tokens_per_minute,
+            "tokens_available": self._bucket.available,
+            "paused_for_seconds": round(max(0.0, self._paused_until - time.monotonic()), 2),
+            "granted": self.granted,
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "wait_ms": {
+                "samples": len(waits),
+                "avg": round(sum(waits) / len(waits), 1) if waits else 0.0,
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "max": round(waits[-1], 1) if waits else 0.0,
+            },
+        }
+
+
+ai_scheduler = AIScheduler(
+    max_concurrency=settings.AI_MAX_CONCURRENCY,
+    tokens_per_minute=settings.AI_TOKENS_PER_MINUTE,
+    queue_timeout=settings.AI_QUEUE_TIMEOUT_SECONDS,
+)
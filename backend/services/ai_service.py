@@ -1,31 +1,61 @@
 """
 AI 對話相關的業務邏輯（Azure OpenAI）
+
+使用原生非同步的 AsyncAzureOpenAI：等待回應時不佔用執行緒，一個 worker 可以同時服務多個生成。
+- stream_ai_response：stream=True，逐段產生增量文字（WebSocket 以此轉發 token）
+- get_ai_response：一次取得完整回覆
+- complete_chat：以自訂訊息呼叫（對話摘要等內部用途），失敗時拋出例外
+
+context 為 services/context_service.py 組裝的先前對話（系統提示、滾動摘要、近期訊息），
+會放在本次使用者訊息之前。
+
+AI_CACHE_ENABLED=true 時，前兩者先查回覆快取並合併相同的進行中請求（見 services/ai_cache.py）；
+命中時串流只產生一段完整文字。
+
+所有上游呼叫都經過 services/ai_scheduler.py 排程（並行上限、TPM 預算、會話間輪流、429 重試），
+session_id 決定排隊的會話；排隊逾時回覆 BUSY_MESSAGE。
+取得名額後由 services/ai_router.py 挑選部署（多部署時負載 / 延遲感知、熔斷、失敗轉移、對沖），
+每個部署各有一個客戶端，全部共用同一個 httpx 連線池（HTTP/2、keepalive，見 get_http_client）；
+啟動時由 app.py 的 lifespan 呼叫 prewarm_clients 預先建立客戶端與連線，關閉時 close_clients。
 """
 import asyncio
 import os
+import time
 import traceback  # <-- 必須導入 traceback 模組
+from typing import AsyncIterator, Dict, List, Optional
 import httpx
-from openai import AzureOpenAI
+from openai import APIStatusError, AsyncAzureOpenAI
 from config import settings  # 從環境變數讀取設定
+from services.ai_cache import ai_cache, cache_key
+from services.ai_router import Deployment, ai_router
+from services.ai_scheduler import QueueTimeout, ai_scheduler
 
+try:
+    import h2  # httpx 的 HTTP/2 支援（httpx[http2]）
+except ImportError:  # pragma: no cover - 選用相依套件
+    h2 = None
 
-# 全域客戶端
-_client: AzureOpenAI | None = None
+# 失敗時回給使用者的訊息
+FALLBACK_MESSAGE = "抱歉，AI 暫時無法回應您的問題，請稍後再試。\n\n後端日誌詳情請查閱 Render 輸出。"
+# 排隊逾時（請求過多）時回給使用者的訊息
+BUSY_MESSAGE = "目前使用人數較多，AI 暫時無法回應，請稍後再試。"
 
+# 全域客戶端（部署名稱 -> 客戶端），共用同一個 HTTP 連線池
+_clients: Dict[str, AsyncAzureOpenAI] = {}
+_http_client: Optional[httpx.AsyncClient] = None
 
-def get_openai_client() -> AzureOpenAI:
+
+def get_http_client() -> httpx.AsyncClient:
     """
-    取得 Azure OpenAI 客戶端實例。
+    取得所有部署共用的 httpx 非同步客戶端（連線池）。
 
-    流程：
-    1. 若已初始化則直接返回。
-    2. 清除 HTTP_PROXY / HTTPS_PROXY，避免代理造成問題。
-    3. 建立不帶代理的 httpx 客戶端。
-    4. 使用 settings 中的環境變數建立 AzureOpenAI 客戶端。
+    - 有安裝 h2 且 AI_HTTP2_ENABLED=true 時使用 HTTP/2：同一部署的並行請求多工在少數連線上
+    - 連線數上限與閒置連線的保留數量 / 秒數依 AI_HTTP_* 設定，讓後續請求重用已建立的 TLS 連線
+    - 清除 HTTP_PROXY / HTTPS_PROXY，避免代理造成問題
     """
-    global _client
-    if _client is not None:
-        return _client
+    global _http_client
+    if _http_client is not None:
+        return _http_client
 
     # 清除可能殘留的代理設定 (解決 'proxies' 錯誤)
     if "HTTP_PROXY" in os.environ:
@@ -35,60 +65,242 @@ def get_openai_client() -> AzureOpenAI:
         print("DEBUG: Removing HTTPS_PROXY from os.environ.")
         del os.environ["HTTPS_PROXY"]
 
-    # 不使用代理的 httpx 客戶端
-    safe_http_client = httpx.Client(proxies=None)
+    http2 = settings.AI_HTTP2_ENABLED and h2 is not None
+    if settings.AI_HTTP2_ENABLED and h2 is None:
+        print("WARNING: h2 is not installed, AI HTTP client falls back to HTTP/1.1 (pip install 'httpx[http2]').")
+
+    _http_client = httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=settings.AI_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.AI_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=settings.AI_HTTP_KEEPALIVE_SECONDS,
+        ),
+        timeout=httpx.Timeout(settings.AI_HTTP_TIMEOUT_SECONDS, connect=settings.AI_HTTP_CONNECT_TIMEOUT_SECONDS),
+    )
+    print(
+        f"INFO: AI HTTP client created (http2={http2}, max_connections={settings.AI_HTTP_MAX_CONNECTIONS}, "
+        f"keepalive={settings.AI_HTTP_MAX_KEEPALIVE})"
+    )
+    return _http_client
+
+
+def get_openai_client(deployment: Optional[Deployment] = None) -> AsyncAzureOpenAI:
+    """
+    取得部署的 Azure OpenAI 非同步客戶端實例（未指定時為第一個部署）。
+
+    流程：
+    1. 若已初始化則直接返回（啟動時 prewarm_clients 已建立，聊天時不再付出初始化成本）。
+    2. 取得共用的 httpx 連線池（get_http_client）。
+    3. 使用部署設定（預設為 settings 中的環境變數）建立 AsyncAzureOpenAI 客戶端。
+    """
+    deployment = deployment or ai_router.deployments[0]
+    client = _clients.get(deployment.name)
+    if client is not None:
+        return client
 
-    print("DEBUG: Attempting to initialize AzureOpenAI client.")
+    print(f"DEBUG: Attempting to initialize AsyncAzureOpenAI client for deployment '{deployment.name}'.")
 
     try:
-        new_client = AzureOpenAI(
-            azure_endpoint=settings.AZURE_OPENAI_ENDPOINT,
-            api_key=settings.AZURE_OPENAI_API_KEY,
-            api_version=settings.AZURE_OPENAI_API_VERSION,
-            http_client=safe_http_client,
+        new_client = AsyncAzureOpenAI(
+            azure_endpoint=deployment.endpoint,
+            api_key=deployment.api_key,
+            api_version=deployment.api_version,
+            http_client=get_http_client(),
+            # 重試由 ai_scheduler 負責（依 Retry-After 並釋放名額），避免次數相乘
+            max_retries=0,
         )
     except Exception as e:
-        print(f"❌ FATAL ERROR during AzureOpenAI client initialization: {e}")
+        print(f"❌ FATAL ERROR during AsyncAzureOpenAI client initialization: {e}")
         # 打印完整的錯誤堆棧，這是診斷 Render 錯誤的關鍵
         traceback.print_exc() 
         raise # 重新拋出異常，讓外層程式知道初始化失敗
 
-    _client = new_client
+    _clients[deployment.name] = new_client
+
+    print(f"✅ Azure OpenAI client initialized ({deployment.name}).")
+    print(f"   Endpoint: {deployment.endpoint}")
+    print(f"   Model: {deployment.model}")
+
+    return new_client
+
+
+async def _prewarm(deployment: Deployment) -> None:
+    """以一次輕量請求（列出模型）完成 DNS 查詢、TCP / TLS 交握，連線留在連線池中"""
+    started = time.perf_counter()
+    try:
+        response = await get_openai_client(deployment).models.with_raw_response.list()
+        status, version = response.http_response.status_code, response.http_response.http_version
+    except APIStatusError as e:
+        # 有回應（例如金鑰沒有列出模型的權限）代表連線已建立
+        status, version = e.status_code, e.response.http_version
+    except Exception as e:
+        print(f"WARNING: AI deployment '{deployment.name}' prewarm failed: {e}")
+        return
+    print(
+        f"INFO: AI deployment '{deployment.name}' prewarmed in {(time.perf_counter() - started) * 1000:.0f}ms "
+        f"({version}, status {status})"
+    )
+
+
+async def prewarm_clients() -> None:
+    """啟動時建立各部署的客戶端並預熱連線，最多等待 AI_PREWARM_TIMEOUT_SECONDS"""
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*(_prewarm(d) for d in ai_router.deployments)),
+            timeout=settings.AI_PREWARM_TIMEOUT_SECONDS,
+        )
+    except asyncio.TimeoutError:
+        print(f"WARNING: AI prewarm did not finish within {settings.AI_PREWARM_TIMEOUT_SECONDS}s, continuing startup.")
+
+
+async def close_clients() -> None:
+    """關閉共用的 HTTP 連線池（各部署的客戶端共用，只需關閉一次）"""
+    global _http_client
+    _clients.clear()
+    if _http_client is not None:
+        client, _http_client = _http_client, None
+        await client.aclose()
+        print("INFO: AI HTTP client closed.")
 
-    print("✅ Azure OpenAI client initialized.")
-    print(f"   Endpoint: {settings.AZURE_OPENAI_ENDPOINT}")
-    print(f"   Model: {settings.AZURE_OPENAI_MODEL}")
 
-    return _client
+def _completion_args(messages: List[Dict[str, str]], max_tokens: int = 800) -> dict:
+    return {
+        "model": settings.AZURE_OPENAI_MODEL,
+        "messages": messages,
+        "temperature": 0.7,
+        "max_tokens": max_tokens,
+    }
 
 
-async def get_ai_response(user_message: str) -> str:
+def _chat_messages(user_message: str, context: Optional[List[Dict[str, str]]]) -> List[Dict[str, str]]:
+    return [*(context or []), {"role": "user", "content": user_message}]
+
+
+async def _stream_upstream(deployment: Deployment, args: dict) -> AsyncIterator[str]:
+    client = get_openai_client(deployment)
+    stream = await client.chat.completions.create(**{**args, "model": deployment.model}, stream=True)
+    async for chunk in stream:
+        # Azure 的第一個 chunk 可能只有內容篩選結果，沒有 choices
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            yield delta
+
+
+async def _complete_upstream(deployment: Deployment, args: dict) -> str:
+    client = get_openai_client(deployment)
+    completion = await client.chat.completions.create(**{**args, "model": deployment.model})
+    return completion.choices[0].message.content or ""
+
+
+async def _lookup_cache(key: str) -> Optional[str]:
+    """快取命中或等到相同的進行中請求完成時回傳內容；否則登記為負責呼叫上游的請求並回傳 None"""
+    cached = await ai_cache.get(key)
+    if cached is not None:
+        print("INFO: AI response served from cache.")
+        return cached
+    while True:
+        waiter = ai_cache.join_inflight(key)
+        if waiter is None:
+            return None
+        content = await ai_cache.wait(waiter)
+        if content is not None:
+            print("INFO: AI response shared with an identical in-flight request.")
+            return content
+        # 進行中的請求失敗：重新登記，由其中一個等待者呼叫上游
+
+
+async def stream_ai_response(
+    user_message: str, context: Optional[List[Dict[str, str]]] = None, session_id: Optional[str] = None
+) -> AsyncIterator[str]:
     """
-    呼叫 Azure OpenAI，取得一段回覆文字。
+    以串流呼叫 Azure OpenAI，逐段產生增量文字。
+    尚未產生任何內容就失敗時改為產生 FALLBACK_MESSAGE；中途失敗則保留已產生的部分並附上提示。
     """
+    args = _completion_args(_chat_messages(user_message, context))
+    key = cache_key(args) if settings.AI_CACHE_ENABLED else None
+    if key is not None:
+        cached = await _lookup_cache(key)
+        if cached is not None:
+            yield cached
+            return
+
+    parts: List[str] = []
+    content: Optional[str] = None
+    started = time.perf_counter()
     try:
-        client = get_openai_client()
-
-        if client is None:
-            # 如果 client 初始化失敗，get_openai_client 應該已經拋出異常
-            raise RuntimeError("Azure OpenAI client failed to initialize.")
-
-        completion = await asyncio.to_thread(
-            client.chat.completions.create,
-            model=settings.AZURE_OPENAI_MODEL,
-            messages=[{"role": "user", "content": user_message}],
-            temperature=0.7,
-            max_tokens=800,
+        deltas = ai_scheduler.stream(
+            session_id, args, lambda: ai_router.stream(args, lambda d: _stream_upstream(d, args))
         )
+        async for delta in deltas:
+            parts.append(delta)
+            yield delta
+        content = "".join(parts)
+        print(f"INFO: AI response streamed, length={len(content)}")
+        if key is not None:
+            await ai_cache.set(key, content, (time.perf_counter() - started) * 1000)
+
+    except QueueTimeout as e:
+        print(f"WARNING: {e}")
+        yield BUSY_MESSAGE
+    except Exception as e:
+        print(f"ERROR: AI 串流回應失敗: {e}")
+        traceback.print_exc()
+        yield FALLBACK_MESSAGE if not parts else "\n\n（回應中斷，請稍後再試）"
+    finally:
+        if key is not None:
+            ai_cache.release(key, content)
+
+
+async def get_ai_response(
+    user_message: str, context: Optional[List[Dict[str, str]]] = None, session_id: Optional[str] = None
+) -> str:
+    """
+    呼叫 Azure OpenAI，取得一段回覆文字。
+    """
+    args = _completion_args(_chat_messages(user_message, context))
+    key = cache_key(args) if settings.AI_CACHE_ENABLED else None
+    if key is not None:
+        # 命中或共用進行中請求的結果時沒有登記 in-flight，不可 release（會結束別人的請求）
+        cached = await _lookup_cache(key)
+        if cached is not None:
+            return cached
 
-        content = completion.choices[0].message.content
+    content: Optional[str] = None
+    try:
+        started = time.perf_counter()
+        content = await ai_scheduler.run(
+            session_id, args, lambda: ai_router.complete(args, lambda d: _complete_upstream(d, args))
+        )
         print(f"INFO: AI response generated, length={len(content)}")
+        if key is not None:
+            await ai_cache.set(key, content, (time.perf_counter() - started) * 1000)
         return content
 
+    except QueueTimeout as e:
+        print(f"WARNING: {e}")
+        return BUSY_MESSAGE
     except Exception as e:
         error_msg = f"AI 回應失敗: {e}"
         print(f"ERROR: {error_msg}")
         # 打印完整的錯誤堆棧
         traceback.print_exc()
         # 提供更詳細的錯誤訊息給前端
-        return f"抱歉，AI 暫時無法回應您的問題，請稍後再試。\n\n後端日誌詳情請查閱 Render 輸出。"
\ No newline at end of file
+        return FALLBACK_MESSAGE
+    finally:
+        if key is not None:
+            ai_cache.release(key, content)
+
+
+async def complete_chat(
+    messages: List[Dict[str, str]], max_tokens: int, session_id: Optional[str] = None
+) -> str:
+    """
+    以自訂訊息取得一段回覆（不串流）；失敗時拋出例外，由呼叫端決定如何處理。
+    """
+    args = _completion_args(messages, max_tokens=max_tokens)
+    return await ai_scheduler.run(
+        session_id, args, lambda: ai_router.complete(args, lambda d: _complete_upstream(d, args))
+    )
@@ -0,0 +1,221 @@
+"""
+會話備份：NDJSON 串流匯出 / 匯入
+
+每行一筆 JSON 紀錄：
+- {"type": "header", "format": "tracechat-ndjson", "version": 1, "exported_at": ...}
+- {"type": "session_meta", "session_id": ..., "meta": {ChatSession hash}}
+- {"type": "session", "session_id": ...}                 active_sessions 成員
+- {"type": "message", "session_id": ..., "message": {...}}
+- {"type": "deleted", "session_id": ..., "record": {...}} 刪除紀錄（含 deleted_at）
+
+匯出以 async generator 逐批讀取（SSCAN / ZRANGEBYSCORE 有界視窗），累積到 BACKUP_CHUNK_BYTES 就送出；
+匯入逐行解析，每 BACKUP_IMPORT_BATCH_SIZE 筆以一個 pipeline 寫入，完成後重新計算受影響會話的衍生資料。
+兩者的記憶體用量只與批次大小有關，與資料總量無關。
+"""
+import json
+import time
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple
+import redis.asyncio as redis
+
+from config import settings
+from services import activity_service, deleted_store, distinct_service, message_store, rollup_service, session_index
+from services.search_index import index_message
+from services.version_service import bump_versions
+
+FORMAT_NAME = "tracechat-ndjson"
+FORMAT_VERSION = 1
+SCAN_BATCH_SIZE = 500
+
+
+def _line(record: Dict[str, Any]) -> bytes:
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+async def iter_export_records(
+    redis_client: redis.Redis, session_ids: Optional[Iterable[str]] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """依序產生所有匯出紀錄；session_ids 為 None 時匯出所有 active_sessions"""
+    selected = set(session_ids) if session_ids else None
+
+    yield {"type": "header", "format": FORMAT_NAME, "version": FORMAT_VERSION, "exported_at": int(time.time())}
+
+    if selected is None:
+        sessions: AsyncIterable[str] = redis_client.sscan_iter(session_index.ACTIVE_SESSIONS_KEY, count=SCAN_BATCH_SIZE)
+    else:
+        async def _selected() -> AsyncIterator[str]:
+            for sid in sorted(selected):
+                if await redis_client.sismember(session_index.ACTIVE_SESSIONS_KEY, sid):
+                    yield sid
+        sessions = _selected()
+
+    async for session_id in sessions:
+        meta = await redis_client.hgetall(session_index.session_key(session_id))
+        if meta:
+            yield {"type": "session_meta", "session_id": session_id, "meta": meta}
+        yield {"type": "session", "session_id": session_id}
+        async for messages in message_store.iter_batches(redis_client, session_id, settings.BACKUP_IMPORT_BATCH_SIZE):
+            for msg in messages:
+                yield {"type": "message", "session_id": session_id, "message": msg}
+        async for records in deleted_store.iter_batches(redis_client, session_id, settings.BACKUP_IMPORT_BATCH_SIZE):
+            for record in records:
+                yield {"type": "deleted", "session_id": session_id, "record": record}
+
+
+async def export_ndjson(
+    redis_client: redis.Redis, session_ids: Optional[Iterable[str]] = None
+) -> AsyncIterator[bytes]:
+    """以 NDJSON 匯出，累積到 BACKUP_CHUNK_BYTES 才送出一塊（給 StreamingResponse 或寫檔使用）"""
+    buffer = bytearray()
+    count = 0
+    async for record in iter_export_records(redis_client, session_ids):
+        buffer += _line(record)
+        count += 1
+        if len(buffer) >= settings.BACKUP_CHUNK_BYTES:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+    print(f"📤 匯出完成：{count} 筆紀錄")
+
+
+async def iter_ndjson_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[Dict[str, Any]]:
+    """將任意切分的位元組串流還原成逐行 JSON（只保留最後一行未完成的部分）"""
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if pending.strip():
+        yield json.loads(pending)
+
+
+def _queue_record(pipe, record: Dict[str, Any]) -> Optional[str]:
+    """將一筆匯入紀錄加入 pipeline，回傳受影響的 session_id（header 等回傳 None）"""
+    kind = record.get("type")
+    session_id = record.get("session_id")
+
+    if kind == "header":
+        if record.get("format") != FORMAT_NAME or int(record.get("version", 0)) > FORMAT_VERSION:
+            raise ValueError(f"Unsupported backup format: {record.get('format')} v{record.get('version')}")
+        return None
+    if not session_id:
+        raise ValueError(f"Record without session_id: {kind}")
+
+    if kind == "session":
+        pipe.sadd(session_index.ACTIVE_SESSIONS_KEY, session_id)
+        session_index.index_session(pipe, session_id, 0, nx=True)
+    elif kind == "session_meta":
+        # 一律以 session_id 為主鍵寫回
+        meta = {k: v for k, v in record["meta"].items() if v is not None}
+        meta["pk"] = session_id
+        pipe.hset(session_index.session_key(session_id), mapping=meta)
+        session_index.index_session(pipe, session_id, session_index.to_ms(meta.get("created_at")))
+    elif kind == "message":
+        msg = record["message"]
+        message_store.store_message(pipe, session_id, msg)
+        message_store.store_document(pipe, session_id, msg)
+        index_message(pipe, session_id, msg)
+        session_index.touch_session(pipe, session_id, msg["ts"])
+    elif kind == "deleted":
+        deleted_store.store_record(pipe, session_id, record["record"])
+    else:
+        raise ValueError(f"Unknown record type: {kind}")
+    return session_id
+
+
+async def _new_records(redis_client: redis.Redis, records: List[Dict[str, Any]]) -> List[Tuple[int, Dict[str, Any]]]:
+    """
+    批次中尚未存在的訊息 / 刪除紀錄，轉為全域統計事件 (時間, 欄位)。
+    匯入可重複執行，已存在（同 ts / 同一筆刪除紀錄）的不再計入，同一批中重複的只計一次。
+    """
+    candidates = [r for r in records if r.get("type") in ("message", "deleted") and r.get("session_id")]
+    if not candidates:
+        return []
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for record in candidates:
+            session_id = record["session_id"]
+            if record["type"] == "message":
+                pipe.zscore(message_store.order_key(session_id), str(int(record["message"]["ts"])))
+            else:
+                rec = record["record"]
+                pipe.hexists(deleted_store.body_key(session_id), deleted_store.record_id(rec["ts"], rec["deleted_at"]))
+        existing = await pipe.execute()
+
+    events: List[Tuple[int, Dict[str, Any]]] = []
+    seen: set = set()
+    for record, exists in zip(candidates, existing):
+        session_id = record["session_id"]
+        if record["type"] == "message":
+            msg = record["message"]
+            identity = ("message", session_id, int(msg["ts"]))
+            event = (int(msg["ts"]), {"session_id": session_id, "sender": msg.get("sender", ""), "deleted": "false"})
+        else:
+            rec = record["record"]
+            identity = ("deleted", session_id, deleted_store.record_id(rec["ts"], rec["deleted_at"]))
+            event = (int(rec["deleted_at"]) * 1000, {"session_id": session_id, "deleted": "true"})
+        if exists or identity in seen:
+            continue
+        seen.add(identity)
+        events.append(event)
+    return events
+
+
+async def _refresh_derived(redis_client: redis.Redis, session_ids: Set[str]) -> None:
+    """重新計算匯入會話的衍生資料：會話摘要、活躍度時段、不重複活躍數（與寫入腳本維護的相同）"""
+    await session_index.refresh_summaries(redis_client, session_ids)
+    await activity_service.backfill(redis_client, session_ids)
+    await distinct_service.backfill(redis_client, list(session_ids))
+
+
+async def import_ndjson(redis_client: redis.Redis, chunks: AsyncIterable[bytes]) -> Dict[str, int]:
+    """
+    匯入 NDJSON（可重複執行：同 ts 的訊息與同一筆刪除紀錄會被覆蓋而非重複）。
+    每 BACKUP_IMPORT_BATCH_SIZE 筆送出一個 pipeline，並遞增受影響會話的版本號讓快取失效。
+    匯入的是歷史資料，不寫入 chat_stream、也不計入熱門關鍵詞；
+    新的訊息 / 刪除紀錄直接計入全域統計（rollup），全部寫入後再重新計算受影響會話的
+    摘要（訊息數、最後活動、預覽）、活躍度時段與不重複活躍數。
+    """
+    counts = {"records": 0, "sessions": 0, "messages": 0, "deleted": 0}
+    batch_size = settings.BACKUP_IMPORT_BATCH_SIZE
+
+    batch: List[Dict[str, Any]] = []
+    imported: Set[str] = set()
+
+    async def flush():
+        events = await _new_records(redis_client, batch)
+        touched: Set[str] = set()
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for record in batch:
+                session_id = _queue_record(pipe, record)
+                if session_id is not None:
+                    touched.add(session_id)
+            rollup_service.queue_events(pipe, events)
+            for session_id in touched:
+                bump_versions(pipe, session_id)
+            await pipe.execute()
+        imported.update(touched)
+        batch.clear()
+
+    async for record in iter_ndjson_lines(chunks):
+        batch.append(record)
+        counts["records"] += 1
+        kind = record.get("type")
+        if kind == "session":
+            counts["sessions"] += 1
+        elif kind == "message":
+            counts["messages"] += 1
+        elif kind == "deleted":
+            counts["deleted"] += 1
+
+        if len(batch) >= batch_size:
+            await flush()
+
+    if batch:
+        await flush()
+    if imported:
+        await _refresh_derived(redis_client, imported)
+
+    print(f"📥 匯入完成：{counts}")
+    return counts
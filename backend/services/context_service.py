@@ -0,0 +1,267 @@
+"""
+AI 對話上下文組裝（token 預算 + 滾動摘要）
+
+每次呼叫模型只送出有界的上下文，提示長度（以及等待第一個 token 的時間）不隨會話變長而增加：
+
+    [系統提示] + [滾動摘要] + [近期訊息] + 本次使用者訊息
+
+- 近期訊息以 fetch_window 由新往舊分頁讀取，最多回看 AI_CONTEXT_MAX_MESSAGES 則，
+  以 utils/token_counter.py 在本機估算 token，整份提示不超過 AI_CONTEXT_TOKEN_BUDGET
+- 更早的訊息併入每個會話一份的滾動摘要 ai_summary:{session_id}
+  （Hash：summary、covered_ts、messages、updated_at）；ts <= covered_ts 的訊息已在摘要內，
+  近期訊息只回看到 covered_ts 為止，不會重複
+
+摘要在 AI 回覆儲存後於背景更新（refresh_summary），只把「已掉出近期視窗、尚未摘要」的訊息
+與現有摘要合併，不重新處理整個會話：
+- 未摘要的舊訊息累積到 AI_SUMMARY_MIN_TOKENS 才更新，避免每一輪都多一次模型呼叫；
+  在此之前這幾則訊息暫時不在上下文中
+- 單次最多併入 AI_SUMMARY_BATCH_TOKENS，落後很多時在之後的回合逐步追上
+- ai_summary_lock:{session_id}（值為隨機 token，只由持有者以 release_lock 腳本釋放）確保同一會話同時只有一個更新；
+  寫入前以 WATCH 確認生成期間摘要與訊息沒有被改動（例如刪除），否則放棄這次結果
+
+刪除或復原 ts <= covered_ts 的訊息會讓摘要失效（刪除 key），之後依上述規則重新累積。
+"""
+import asyncio
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Set, Tuple
+import redis.asyncio as redis
+
+from config import settings
+from database.scripts import execute_pipeline, queue_script
+from services import message_store
+from utils.token_counter import count_message_tokens
+
+ROLES = {"me": "user", "ai": "assistant"}
+SPEAKERS = {"user": "使用者", "assistant": "AI"}
+PAGE_SIZE = 20
+LOCK_SECONDS = 120
+
+SUMMARY_INSTRUCTIONS = (
+    "你負責維護一段對話的滾動摘要。請把「既有摘要」與「新的對話」整合成一份新的摘要，"
+    "保留使用者的需求、偏好、已確認的事實、重要結論與尚未解決的問題，省略寒暄與重複內容。"
+    "使用對話的語言，只輸出摘要本文。"
+)
+
+# 背景更新中的摘要工作（保留參照，避免被垃圾回收）
+_refresh_tasks: Set[asyncio.Task] = set()
+
+
+def summary_key(session_id: str) -> str:
+    return f"ai_summary:{session_id}"
+
+
+def summary_lock_key(session_id: str) -> str:
+    return f"ai_summary_lock:{session_id}"
+
+
+def to_chat_message(msg: Dict[str, Any]) -> Optional[Dict[str, str]]:
+    """儲存的訊息轉為 chat completion 訊息（非使用者 / AI 的訊息或空內容回傳 None）"""
+    role = ROLES.get(str(msg.get("sender", "")).lower())
+    content = msg.get("content")
+    if role is None or not content:
+        return None
+    return {"role": role, "content": str(content)}
+
+
+def _fixed_messages(summary: str) -> List[Dict[str, str]]:
+    messages = []
+    if settings.AI_SYSTEM_PROMPT:
+        messages.append({"role": "system", "content": settings.AI_SYSTEM_PROMPT})
+    if summary:
+        messages.append({"role": "system", "content": f"先前對話的摘要：\n{summary}"})
+    return messages
+
+
+async def _select_recent(
+    redis_client: redis.Redis,
+    session_id: str,
+    budget: int,
+    before: Optional[int],
+    covered_ts: int,
+) -> Tuple[List[Dict[str, str]], Optional[int]]:
+    """
+    由新往舊挑選預算內的近期訊息，回傳 (依時間遞增的 chat 訊息, evicted_before)。
+    covered_ts < ts < evicted_before 的訊息因預算或回看上限沒有放入；全部放入時為 None。
+    """
+    selected: List[Dict[str, str]] = []
+    scanned = 0
+    used = 0
+    cursor = before
+    while scanned < settings.AI_CONTEXT_MAX_MESSAGES:
+        limit = min(PAGE_SIZE, settings.AI_CONTEXT_MAX_MESSAGES - scanned)
+        page, has_more = await message_store.fetch_window(redis_client, session_id, limit, before=cursor)
+        for msg in reversed(page):
+            ts = int(msg["ts"])
+            if ts <= covered_ts:
+                return selected[::-1], None
+            chat = to_chat_message(msg)
+            if chat is not None:
+                tokens = count_message_tokens(chat)
+                if used + tokens > budget:
+                    return selected[::-1], ts + 1
+                used += tokens
+                selected.append(chat)
+            scanned += 1
+            cursor = ts
+        if not page or not has_more:
+            return selected[::-1], None
+    return selected[::-1], cursor
+
+
+async def build_context(
+    redis_client: redis.Redis, session_id: str, user_message: str, before_ts: Optional[int] = None
+) -> List[Dict[str, str]]:
+    """
+    組裝放在本次使用者訊息之前的上下文（系統提示、滾動摘要、ts < before_ts 的近期訊息）。
+    """
+    data = await redis_client.hgetall(summary_key(session_id))
+    summary = data.get("summary", "")
+    covered_ts = int(data.get("covered_ts") or 0)
+
+    fixed = _fixed_messages(summary)
+    budget = (
+        settings.AI_CONTEXT_TOKEN_BUDGET
+        - sum(count_message_tokens(m) for m in fixed)
+        - count_message_tokens({"content": user_message})
+    )
+    recent, _ = await _select_recent(redis_client, session_id, budget, before_ts, covered_ts)
+    return fixed + recent
+
+
+async def _pending_messages(
+    redis_client: redis.Redis, session_id: str, covered_ts: int, evicted_before: int
+) -> Tuple[List[Dict[str, Any]], int]:
+    """covered_ts 之後、evicted_before 之前尚未摘要的訊息（依時間遞增，最多約 AI_SUMMARY_BATCH_TOKENS）"""
+    pending: List[Dict[str, Any]] = []
+    tokens = 0
+    cursor = covered_ts
+    while True:
+        page, has_more = await message_store.fetch_window(redis_client, session_id, PAGE_SIZE, after=cursor)
+        for msg in page:
+            if int(msg["ts"]) >= evicted_before:
+                return pending, tokens
+            chat = to_chat_message(msg)
+            cost = count_message_tokens(chat) if chat else 0
+            # 至少併入一則，避免單則超長訊息卡住摘要
+            if pending and tokens + cost > settings.AI_SUMMARY_BATCH_TOKENS:
+                return pending, tokens
+            pending.append(msg)
+            tokens += cost
+            cursor = int(msg["ts"])
+        if not page or not has_more:
+            return pending, tokens
+
+
+def _summary_prompt(summary: str, pending: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    lines = []
+    for msg in pending:
+        chat = to_chat_message(msg)
+        if chat is not None:
+            lines.append(f"{SPEAKERS[chat['role']]}：{chat['content']}")
+    conversation = "\n".join(lines)
+    return [
+        {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+        {"role": "user", "content": f"既有摘要：\n{summary or '（無）'}\n\n新的對話：\n{conversation}"},
+    ]
+
+
+async def _store_summary(
+    redis_client: redis.Redis,
+    session_id: str,
+    covered_ts: int,
+    summary: str,
+    pending: List[Dict[str, Any]],
+    messages: int,
+) -> bool:
+    """摘要與併入的訊息在生成期間都沒有變動才寫入（WATCH）"""
+    key = summary_key(session_id)
+    order = message_store.order_key(session_id)
+    members = [str(int(msg["ts"])) for msg in pending]
+    async with redis_client.pipeline() as pipe:
+        try:
+            await pipe.watch(key, order)
+            if int(await pipe.hget(key, "covered_ts") or 0) != covered_ts:
+                return False
+            if any(score is None for score in await pipe.zmscore(order, members)):
+                return False
+            pipe.multi()
+            pipe.hset(key, mapping={
+                "summary": summary,
+                "covered_ts": members[-1],
+                "messages": messages + len(pending),
+                "updated_at": int(time.time()),
+            })
+            await pipe.execute()
+        except redis.WatchError:
+            return False
+    return True
+
+
+async def refresh_summary(redis_client: redis.Redis, session_id: str) -> bool:
+    """
+    把已掉出近期視窗的訊息併入滾動摘要，回傳是否有更新。
+    """
+    from services.ai_service import complete_chat  # 避免循環導入
+
+    lock = summary_lock_key(session_id)
+    token = uuid.uuid4().hex
+    if not await redis_client.set(lock, token, nx=True, ex=LOCK_SECONDS):
+        return False
+    try:
+        data = await redis_client.hgetall(summary_key(session_id))
+        summary = data.get("summary", "")
+        covered_ts = int(data.get("covered_ts") or 0)
+
+        # 與 build_context 相同的預算；本次訊息未知，改為預留摘要的長度上限
+        budget = (
+            settings.AI_CONTEXT_TOKEN_BUDGET
+            - sum(count_message_tokens(m) for m in _fixed_messages(""))
+            - settings.AI_SUMMARY_MAX_TOKENS
+        )
+        _, evicted_before = await _select_recent(redis_client, session_id, budget, None, covered_ts)
+        if evicted_before is None:
+            return False
+        pending, tokens = await _pending_messages(redis_client, session_id, covered_ts, evicted_before)
+        if not pending or tokens < settings.AI_SUMMARY_MIN_TOKENS:
+            return False
+
+        started = time.perf_counter()
+        new_summary = (await complete_chat(
+            _summary_prompt(summary, pending), max_tokens=settings.AI_SUMMARY_MAX_TOKENS, session_id=session_id
+        )).strip()
+        if not new_summary:
+            return False
+
+        stored = await _store_summary(
+            redis_client, session_id, covered_ts, new_summary, pending, int(data.get("messages") or 0)
+        )
+        if stored:
+            print(
+                f"INFO: AI summary updated for {session_id}: +{len(pending)} messages "
+                f"({tokens} tokens) in {time.perf_counter() - started:.2f}s"
+            )
+        else:
+            print(f"INFO: AI summary for {session_id} changed during refresh, discarded.")
+        return stored
+
+    except Exception as e:
+        print(f"ERROR: AI 摘要更新失敗 ({session_id}): {e}")
+        return False
+    finally:
+        # 模型呼叫超過 LOCK_SECONDS 時鎖可能已過期並被其他工作取得，只釋放自己的鎖
+        async with redis_client.pipeline() as pipe:
+            queue_script(pipe, "release_lock", [lock], [token])
+            await execute_pipeline(redis_client, pipe)
+
+
+def schedule_refresh(redis_client: redis.Redis, session_id: str) -> None:
+    """在背景更新摘要（不延遲回覆）"""
+    task = asyncio.create_task(refresh_summary(redis_client, session_id))
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_tasks.discard)
+
+
+def queue_invalidate(pipe, session_id: str) -> None:
+    """摘要涵蓋的訊息被刪除 / 復原時捨棄摘要（加入 pipeline，不執行）"""
+    pipe.unlink(summary_key(session_id))
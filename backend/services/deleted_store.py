@@ -0,0 +1,175 @@
+"""
+刪除紀錄（可復原訊息）的儲存結構與保留期限清理
+
+- deleted_index:{session_id}  Sorted Set，member = "{ts}:{deleted_at}"，score = deleted_at
+- deleted_body:{session_id}   Hash，field = "{ts}:{deleted_at}"，value = 刪除紀錄（utils/message_codec.py 編碼）
+- deleted_sessions            Set，有刪除紀錄的會話（供背景清理器走訪）
+
+讀取與復原以 (ts, deleted_at) 直接定位（O(log n)）；過期紀錄由 app lifespan 中的
+背景清理器以範圍刪除移除（DELETE_RECORD_RETENTION_SECONDS），不再在讀取路徑上重寫資料。
+
+舊的 deleted_history:{session_id} List 由 python manage.py migrate-message-store 一併轉換。
+"""
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+import redis.asyncio as redis
+
+from config import settings
+from utils import message_codec
+
+DELETED_SESSIONS_KEY = "deleted_sessions"
+SWEEP_BATCH_SIZE = 500
+
+
+def index_key(session_id: str) -> str:
+    return f"deleted_index:{session_id}"
+
+
+def body_key(session_id: str) -> str:
+    return f"deleted_body:{session_id}"
+
+
+def record_id(ts: Any, deleted_at: Any) -> str:
+    return f"{int(ts)}:{int(deleted_at)}"
+
+
+def store_record(pipe, session_id: str, record: Dict[str, Any]) -> None:
+    """直接寫入一筆刪除紀錄（遷移、匯入用；加入 pipeline，不執行）"""
+    rid = record_id(record["ts"], record["deleted_at"])
+    pipe.zadd(index_key(session_id), {rid: int(record["deleted_at"])})
+    pipe.hset(body_key(session_id), rid, message_codec.encode(record))
+    pipe.sadd(DELETED_SESSIONS_KEY, session_id)
+
+
+async def get_record(redis_client: redis.Redis, session_id: str, ts: int, deleted_at: int) -> Optional[Dict[str, Any]]:
+    raw = await redis_client.hget(body_key(session_id), record_id(ts, deleted_at))
+    return message_codec.decode(raw) if raw else None
+
+
+async def list_records(redis_client: redis.Redis, session_id: str, now: Optional[int] = None) -> List[Dict[str, Any]]:
+    """依刪除時間排序，回傳仍在保留期限內的刪除紀錄（已過期但尚未清理的直接略過）"""
+    now = int(time.time()) if now is None else now
+    cutoff = now - settings.DELETE_RECORD_RETENTION_SECONDS
+
+    members = await redis_client.zrangebyscore(index_key(session_id), f"({cutoff}", "+inf")
+    if not members:
+        return []
+
+    records: List[Dict[str, Any]] = []
+    for raw in await redis_client.hmget(body_key(session_id), members):
+        if not raw:
+            continue
+        try:
+            records.append(message_codec.decode(raw))
+        except Exception as e:
+            print(f"   ⚠️ 無法解析刪除紀錄: {e}")
+    return records
+
+
+async def iter_batches(
+    redis_client: redis.Redis, session_id: str, batch_size: int = SWEEP_BATCH_SIZE
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """依刪除時間分批取出會話的所有刪除紀錄（含尚未清理的過期紀錄；匯出用）"""
+    start = 0
+    while True:
+        members = await redis_client.zrange(index_key(session_id), start, start + batch_size - 1)
+        if not members:
+            break
+        records = [message_codec.decode(raw) for raw in await redis_client.hmget(body_key(session_id), members) if raw]
+        if records:
+            yield records
+        if len(members) < batch_size:
+            break
+        start += batch_size
+
+
+async def sweep_session(redis_client: redis.Redis, session_id: str, cutoff: int) -> int:
+    """範圍刪除單一會話中 deleted_at <= cutoff 的紀錄，回傳移除筆數"""
+    removed = 0
+    while True:
+        expired = await redis_client.zrangebyscore(index_key(session_id), "-inf", cutoff, start=0, num=SWEEP_BATCH_SIZE)
+        if not expired:
+            break
+        async with redis_client.pipeline() as pipe:
+            pipe.hdel(body_key(session_id), *expired)
+            pipe.zrem(index_key(session_id), *expired)
+            await pipe.execute()
+        removed += len(expired)
+
+    if not await redis_client.exists(index_key(session_id)):
+        await redis_client.srem(DELETED_SESSIONS_KEY, session_id)
+    return removed
+
+
+async def sweep_expired(redis_client: redis.Redis, now: Optional[int] = None) -> int:
+    """走訪所有有刪除紀錄的會話，清除超過保留期限的紀錄"""
+    now = int(time.time()) if now is None else now
+    cutoff = now - settings.DELETE_RECORD_RETENTION_SECONDS
+
+    removed = 0
+    async for session_id in redis_client.sscan_iter(DELETED_SESSIONS_KEY, count=SWEEP_BATCH_SIZE):
+        removed += await sweep_session(redis_client, session_id, cutoff)
+    return removed
+
+
+async def run_retention_sweeper(stop_event: asyncio.Event) -> None:
+    """背景清理器：每 DELETED_SWEEP_INTERVAL_SECONDS 執行一次，直到 stop_event 被設定"""
+    from database.redis_client import get_redis_client
+
+    print(f"INFO: Deleted-record sweeper started (interval={settings.DELETED_SWEEP_INTERVAL_SECONDS}s).")
+    while not stop_event.is_set():
+        try:
+            redis_client = await get_redis_client()
+            removed = await sweep_expired(redis_client)
+            if removed:
+                print(f"🧹 清理了 {removed} 條過期刪除紀錄")
+        except Exception as e:
+            print(f"ERROR: Deleted-record sweep failed: {e}")
+
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=settings.DELETED_SWEEP_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+    print("INFO: Deleted-record sweeper stopped.")
+
+
+async def migrate_session(redis_client: redis.Redis, session_id: str) -> int:
+    """將單一會話的 deleted_history List 轉換為新結構，完成後刪除舊 List"""
+    legacy_key = f"deleted_history:{session_id}"
+    records = await redis_client.lrange(legacy_key, 0, -1)
+
+    migrated = 0
+    async with redis_client.pipeline() as pipe:
+        for raw in records:
+            try:
+                data = json.loads(raw)
+                rid = record_id(data["ts"], data["deleted_at"])
+                pipe.zadd(index_key(session_id), {rid: int(data["deleted_at"])})
+                pipe.hset(body_key(session_id), rid, message_codec.encode(data))
+                migrated += 1
+            except Exception as e:
+                print(f"⚠️ 轉換刪除紀錄失敗 ({session_id}): {e}")
+                continue
+        if migrated:
+            pipe.sadd(DELETED_SESSIONS_KEY, session_id)
+        pipe.unlink(legacy_key)
+        await pipe.execute()
+
+    return migrated
+
+
+async def migrate_all_sessions(redis_client: redis.Redis) -> Dict[str, int]:
+    """轉換所有 deleted_history:* List（可重複執行）"""
+    session_count = 0
+    record_count = 0
+    async for key in redis_client.scan_iter("deleted_history:*", count=SWEEP_BATCH_SIZE):
+        if await redis_client.type(key) != "list":
+            continue
+        _, session_id = key.split(":", 1)
+        record_count += await migrate_session(redis_client, session_id)
+        session_count += 1
+
+    print(f"✅ 刪除紀錄結構轉換完成：{session_count} 個會話，{record_count} 筆紀錄")
+    return {"sessions": session_count, "records": record_count}
@@ -0,0 +1,295 @@
+"""
+背景刪除會話
+
+delete_session 只做 O(1) 的工作就回應：
+1. 從 active_sessions / 會話索引移除，刪除 ChatSession hash
+2. 以 rename_keys 腳本把訊息、刪除紀錄與活躍度統計改名為墓碑 key（deleting:{job_id}:*），
+   之後同名的新會話不會與待回收的資料混在一起
+3. 建立工作 deletion_job:{job_id} 並排入 deletion_jobs（Sorted Set，score = 建立時間）
+
+app lifespan 中的背景工作依序處理 deletion_jobs：
+- messages：從墓碑分批取出訊息，以 pipeline 移除搜尋索引、UNLINK ORM hash，再從墓碑移除（進度即墓碑本身）
+- orphans：以 FT.SEARCH NOCONTENT 找出 ts <= 刪除時間、但不在墓碑中的舊 ORM 文件（例如舊版隨機主鍵）並 UNLINK
+- cleanup：刪除剩下的墓碑 key，標記完成
+
+每個階段都可重複執行，重新啟動後會從 deletion_jobs 中未完成的工作繼續。
+執行失敗時在工作上記錄 attempts / last_error，並把工作移到佇列尾端，不會阻擋後面的工作；
+連續失敗 DELETION_MAX_ATTEMPTS 次後標記為 failed 並移到 deletion_jobs:failed，
+排除問題後以 python manage.py retry-deletion-jobs 重新排入。
+回收完成前，搜尋結果會以 deleting_sessions（session_id -> 刪除時間）過濾掉該會話刪除前的訊息。
+"""
+import asyncio
+import time
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import redis.asyncio as redis
+
+from config import settings
+from database.scripts import execute_pipeline, queue_script
+from models.chat import ChatMessage
+from services import (
+    activity_service, context_service, deleted_store, message_store, projection_service, session_index,
+)
+from services.search_index import unindex_message
+from services.version_service import bump_versions
+
+JOBS_KEY = "deletion_jobs"
+FAILED_JOBS_KEY = "deletion_jobs:failed"
+DELETING_SESSIONS_KEY = "deleting_sessions"
+JOB_TTL_SECONDS = 7 * 24 * 3600
+
+
+def job_key(job_id: str) -> str:
+    return f"deletion_job:{job_id}"
+
+
+def tombstone_key(job_id: str, part: str) -> str:
+    return f"deleting:{job_id}:{part}"
+
+
+def _tombstone_pairs(session_id: str, job_id: str) -> List[Tuple[str, str]]:
+    return [
+        (message_store.order_key(session_id), tombstone_key(job_id, "order")),
+        (message_store.body_key(session_id), tombstone_key(job_id, "body")),
+        (deleted_store.index_key(session_id), tombstone_key(job_id, "deleted_index")),
+        (deleted_store.body_key(session_id), tombstone_key(job_id, "deleted_body")),
+        (activity_service.hourly_key(session_id), tombstone_key(job_id, "activity_hourly")),
+        (activity_service.daily_key(session_id), tombstone_key(job_id, "activity_daily")),
+        (projection_service.session_stats_key(session_id), tombstone_key(job_id, "projection")),
+        (context_service.summary_key(session_id), tombstone_key(job_id, "ai_summary")),
+    ]
+
+
+async def start_deletion(redis_client: redis.Redis, session_id: str) -> Optional[str]:
+    """
+    標記會話已刪除並排入背景回收，回傳 job_id；會話不存在時回傳 None。
+    只有固定數量的指令，回應時間與會話大小無關。
+    """
+    if not await redis_client.srem(session_index.ACTIVE_SESSIONS_KEY, session_id):
+        return None
+
+    now_ms = int(time.time() * 1000)
+    job_id = f"{now_ms}-{uuid.uuid4().hex[:8]}"
+    keys = [key for pair in _tombstone_pairs(session_id, job_id) for key in pair]
+
+    async with redis_client.pipeline() as pipe:
+        pipe.zcard(message_store.order_key(session_id))
+        session_index.remove_session(pipe, session_id)
+        pipe.srem(deleted_store.DELETED_SESSIONS_KEY, session_id)
+        queue_script(pipe, "rename_keys", keys=keys, args=[])
+        pipe.hset(job_key(job_id), mapping={
+            "job_id": job_id,
+            "session_id": session_id,
+            "status": "pending",
+            "stage": "messages",
+            "deleted_at": now_ms,
+            "created_at": now_ms,
+            "processed_messages": 0,
+            "removed_documents": 0,
+        })
+        pipe.zadd(JOBS_KEY, {job_id: now_ms})
+        pipe.hset(DELETING_SESSIONS_KEY, session_id, now_ms)
+        # 版本號遞增，讓包含此會話的搜尋快取失效
+        bump_versions(pipe, session_id)
+        results = await execute_pipeline(redis_client, pipe)
+
+    await redis_client.hset(job_key(job_id), "total_messages", results[0])
+    print(f"🗑️ 會話 {session_id} 已標記刪除，背景回收工作 {job_id}（{results[0]} 則訊息）")
+    return job_id
+
+
+async def get_job(redis_client: redis.Redis, job_id: str) -> Optional[Dict[str, Any]]:
+    data = await redis_client.hgetall(job_key(job_id))
+    if not data:
+        return None
+    for field in (
+        "deleted_at", "created_at", "finished_at", "failed_at",
+        "total_messages", "processed_messages", "removed_documents", "attempts",
+    ):
+        if field in data:
+            data[field] = int(data[field])
+    return data
+
+
+async def list_pending_jobs(redis_client: redis.Redis) -> List[Dict[str, Any]]:
+    """尚未完成的工作（依執行順序），以及已放棄、等待處理的 failed 工作"""
+    jobs = []
+    job_ids = await redis_client.zrange(JOBS_KEY, 0, -1) + await redis_client.zrange(FAILED_JOBS_KEY, 0, -1)
+    for job_id in job_ids:
+        job = await get_job(redis_client, job_id)
+        if job:
+            jobs.append(job)
+    return jobs
+
+
+async def record_failure(redis_client: redis.Redis, job_id: str, error: Exception) -> int:
+    """
+    記錄一次失敗並把工作移到佇列尾端；達到 DELETION_MAX_ATTEMPTS 時標記為 failed 並移出佇列。
+    回傳目前的失敗次數。
+    """
+    now_ms = int(time.time() * 1000)
+    async with redis_client.pipeline() as pipe:
+        pipe.hincrby(job_key(job_id), "attempts", 1)
+        pipe.hset(job_key(job_id), mapping={"status": "retrying", "last_error": str(error)[:500]})
+        pipe.zadd(JOBS_KEY, {job_id: now_ms}, xx=True)
+        attempts = (await pipe.execute())[0]
+
+    if attempts >= settings.DELETION_MAX_ATTEMPTS:
+        async with redis_client.pipeline() as pipe:
+            pipe.hset(job_key(job_id), mapping={"status": "failed", "failed_at": now_ms})
+            pipe.zrem(JOBS_KEY, job_id)
+            pipe.zadd(FAILED_JOBS_KEY, {job_id: now_ms})
+            await pipe.execute()
+    return attempts
+
+
+async def retry_failed_jobs(redis_client: redis.Redis) -> int:
+    """將 failed 工作重新排入 deletion_jobs（失敗次數歸零，從原本的階段繼續），回傳重新排入的數量"""
+    job_ids = await redis_client.zrange(FAILED_JOBS_KEY, 0, -1)
+    now_ms = int(time.time() * 1000)
+    async with redis_client.pipeline() as pipe:
+        for job_id in job_ids:
+            pipe.hset(job_key(job_id), mapping={"status": "pending", "attempts": 0})
+            pipe.hdel(job_key(job_id), "failed_at")
+            pipe.zadd(JOBS_KEY, {job_id: now_ms})
+            pipe.zrem(FAILED_JOBS_KEY, job_id)
+        await pipe.execute()
+    print(f"✅ 已重新排入 {len(job_ids)} 個失敗的回收工作")
+    return len(job_ids)
+
+
+async def filter_deleting(redis_client: redis.Redis, postings: Iterable[Tuple[str, int]]) -> List[Tuple[str, int]]:
+    """移除屬於回收中會話、且在刪除時間之前的 (session_id, ts)"""
+    postings = list(postings)
+    session_ids = list({sid for sid, _ in postings})
+    if not session_ids:
+        return postings
+    deleted_at = dict(zip(session_ids, await redis_client.hmget(DELETING_SESSIONS_KEY, session_ids)))
+    return [
+        (sid, ts) for sid, ts in postings
+        if deleted_at[sid] is None or int(ts) > int(deleted_at[sid])
+    ]
+
+
+async def _reclaim_messages(redis_client: redis.Redis, job: Dict[str, Any]) -> None:
+    session_id, job_id = job["session_id"], job["job_id"]
+    order, body = tombstone_key(job_id, "order"), tombstone_key(job_id, "body")
+    batch_size = settings.DELETION_BATCH_SIZE
+
+    while True:
+        members = await redis_client.zrange(order, 0, batch_size - 1)
+        if not members:
+            break
+        raw_bodies = await redis_client.hmget(body, members)
+
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for ts, raw in zip(members, raw_bodies):
+                try:
+                    msg = message_store.decode_message(raw) if raw else None
+                except Exception as e:
+                    # 損毀的本文無法取得索引詞，仍移除 ORM hash 與墓碑，不讓單一訊息卡住整個工作
+                    print(f"WARNING: Failed to decode message {ts} of job {job_id}: {e}")
+                    msg = None
+                if msg:
+                    unindex_message(pipe, session_id, msg)
+                pipe.unlink(message_store.orm_key(session_id, ts))
+            pipe.hdel(body, *members)
+            pipe.zrem(order, *members)
+            pipe.hincrby(job_key(job_id), "processed_messages", len(members))
+            await pipe.execute()
+        await asyncio.sleep(0)  # 讓出事件迴圈，避免長時間占用
+
+
+async def _reclaim_orphan_documents(redis_client: redis.Redis, job: Dict[str, Any]) -> None:
+    """移除刪除時間之前、不在墓碑中的 ORM 文件（需要 RediSearch）"""
+    from redis.commands.search.query import Query
+    from services.search_service import escape_query
+
+    query = (
+        Query(f"@session_id:{{{escape_query(job['session_id'])}}} @ts:[-inf {job['deleted_at']}]")
+        .no_content()
+        .paging(0, settings.DELETION_BATCH_SIZE)
+        .dialect(2)
+    )
+    try:
+        while True:
+            result = await redis_client.ft(ChatMessage.Meta.index_name).search(query)
+            keys = [doc.id for doc in result.docs]
+            if not keys:
+                break
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.unlink(*keys)
+                pipe.hincrby(job_key(job["job_id"]), "removed_documents", len(keys))
+                await pipe.execute()
+            await asyncio.sleep(0)
+    except Exception as e:
+        print(f"WARNING: Orphan document cleanup skipped for job {job['job_id']}: {e}")
+
+
+async def _finish(redis_client: redis.Redis, job: Dict[str, Any]) -> None:
+    session_id, job_id = job["session_id"], job["job_id"]
+    async with redis_client.pipeline() as pipe:
+        pipe.unlink(*[dst for _, dst in _tombstone_pairs(session_id, job_id)])
+        pipe.hset(job_key(job_id), mapping={"status": "done", "stage": "done", "finished_at": int(time.time() * 1000)})
+        pipe.expire(job_key(job_id), JOB_TTL_SECONDS)
+        pipe.zrem(JOBS_KEY, job_id)
+        await pipe.execute()
+
+    # 只在沒有更新的刪除工作時才移除過濾標記
+    if int(await redis_client.hget(DELETING_SESSIONS_KEY, session_id) or 0) <= job["deleted_at"]:
+        await redis_client.hdel(DELETING_SESSIONS_KEY, session_id)
+
+
+STAGES = [
+    ("messages", _reclaim_messages),
+    ("orphans", _reclaim_orphan_documents),
+]
+
+
+async def run_job(redis_client: redis.Redis, job_id: str) -> None:
+    """執行（或接續）一個回收工作"""
+    job = await get_job(redis_client, job_id)
+    if job is None:
+        await redis_client.zrem(JOBS_KEY, job_id)
+        return
+
+    print(f"INFO: Reclaiming session '{job['session_id']}' (job {job_id}, stage={job['stage']}).")
+    await redis_client.hset(job_key(job_id), "status", "running")
+    names = [name for name, _ in STAGES]
+    start = names.index(job["stage"]) if job["stage"] in names else len(STAGES)
+    for name, stage in STAGES[start:]:
+        await redis_client.hset(job_key(job_id), "stage", name)
+        await stage(redis_client, job)
+    await _finish(redis_client, job)
+
+    job = await get_job(redis_client, job_id)
+    print(f"✅ 會話 {job['session_id']} 回收完成：{job['processed_messages']} 則訊息，{job['removed_documents']} 筆舊文件")
+
+
+async def run_deletion_worker(stop_event: asyncio.Event) -> None:
+    """
+    背景回收工作：依建立順序處理 deletion_jobs，沒有工作或工作失敗後等待 DELETION_POLL_SECONDS 再檢查。
+    失敗的工作移到佇列尾端（見 record_failure），不會一直佔住佇列開頭。
+    """
+    from database.redis_client import get_redis_client
+
+    print("INFO: Session deletion worker started.")
+    while not stop_event.is_set():
+        try:
+            redis_client = await get_redis_client()
+            pending = await redis_client.zrange(JOBS_KEY, 0, 0)
+            if pending:
+                try:
+                    await run_job(redis_client, pending[0])
+                    continue
+                except Exception as e:
+                    attempts = await record_failure(redis_client, pending[0], e)
+                    print(f"ERROR: Session deletion job {pending[0]} failed (attempt {attempts}): {e}")
+        except Exception as e:
+            print(f"ERROR: Session deletion worker error: {e}")
+
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=settings.DELETION_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+    print("INFO: Session deletion worker stopped.")
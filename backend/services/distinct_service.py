@@ -0,0 +1,191 @@
+"""
+不重複活躍會話 / 使用者數（HyperLogLog）
+
+save_message 腳本在寫入使用者訊息（sender=me、內容非空，與活躍度統計相同）時，
+以 PFADD 把 session_id 與該會話的 ChatSession.user_id 加入所在時間桶（UTC，依訊息 ts）：
+
+- hll:sessions:{hour|day}:{bucket_ms}
+- hll:users:{hour|day}:{bucket_ms}
+
+每個 HLL 最多約 12 KB、標準誤差約 0.81%，與活躍數量無關；PFADD 建立 key 時設定 PEXPIREAT
+（時間桶結束 + DISTINCT_{HOUR|DAY}_RETENTION_DAYS）。
+
+任意範圍的查詢先截到日桶保留期內、不晚於現在，並對齊到整點，
+再以整天的日桶加上頭尾不足一天的小時桶覆蓋，PFMERGE 成一個暫存 key 後 PFCOUNT，
+合併結果以對齊後的範圍為 key 保留 DISTINCT_MERGE_CACHE_SECONDS 秒供重複查詢使用。
+時間桶數超過 ROLLUP_MAX_POINTS 的範圍直接拒絕。
+已超過小時保留期的頭尾時段無法再細分，會少算這些時段只出現一次的會話。
+
+舊資料以 python manage.py backfill-distinct 回填。
+"""
+import time
+from typing import Any, Dict, List, Optional, Tuple
+import redis.asyncio as redis
+
+from config import settings
+
+HOUR_MS = 3600 * 1000
+DAY_MS = 24 * HOUR_MS
+KINDS = ("sessions", "users")
+RESOLUTIONS = {"hour": HOUR_MS, "day": DAY_MS}
+BACKFILL_BATCH_SIZE = 500
+
+
+def hll_key(kind: str, resolution: str, bucket_ms: int) -> str:
+    return f"hll:{kind}:{resolution}:{bucket_ms}"
+
+
+def merged_key(kind: str, start_ms: int, end_ms: int) -> str:
+    return f"hll:merged:{kind}:{start_ms}:{end_ms}"
+
+
+def retention_ms(resolution: str) -> int:
+    days = settings.DISTINCT_HOUR_RETENTION_DAYS if resolution == "hour" else settings.DISTINCT_DAY_RETENTION_DAYS
+    return days * DAY_MS
+
+
+def _expire_at(resolution: str, bucket_ms: int) -> int:
+    return bucket_ms + RESOLUTIONS[resolution] + retention_ms(resolution)
+
+
+def _clamp(start_ms: int, end_ms: int, resolution: str) -> Tuple[int, int]:
+    """保留期之前與未來沒有資料：截到 [現在 - 保留期, 現在]（結果可能 start > end，表示範圍內沒有資料）"""
+    now_ms = int(time.time() * 1000)
+    return max(start_ms, now_ms - retention_ms(resolution)), min(end_ms, now_ms)
+
+
+def _check_points(points: int) -> None:
+    if points > settings.ROLLUP_MAX_POINTS:
+        raise ValueError(f"Range too large: {points} buckets (max {settings.ROLLUP_MAX_POINTS})")
+
+
+def script_keys(ts_ms: Any) -> List[str]:
+    """save_message 腳本的 HLL KEYS：[sessions_hour, sessions_day, users_hour, users_day]"""
+    ts_ms = int(ts_ms)
+    hour, day = ts_ms // HOUR_MS * HOUR_MS, ts_ms // DAY_MS * DAY_MS
+    return [
+        hll_key("sessions", "hour", hour),
+        hll_key("sessions", "day", day),
+        hll_key("users", "hour", hour),
+        hll_key("users", "day", day),
+    ]
+
+
+def script_args(ts_ms: Any) -> List[int]:
+    """save_message 腳本的 HLL ARGV：[小時桶到期時間, 日桶到期時間]"""
+    ts_ms = int(ts_ms)
+    return [
+        _expire_at("hour", ts_ms // HOUR_MS * HOUR_MS),
+        _expire_at("day", ts_ms // DAY_MS * DAY_MS),
+    ]
+
+
+def cover(start_ms: int, end_ms: int) -> List[Tuple[str, int]]:
+    """
+    以最少的時間桶覆蓋 [start_ms, end_ms]：中間完整的日桶 + 頭尾的小時桶。
+    先以算式估計桶數，超過 ROLLUP_MAX_POINTS 時丟出 ValueError，不會先建出整個列表。
+    """
+    first_day = -(-start_ms // DAY_MS) * DAY_MS
+    end_day = (end_ms + 1) // DAY_MS * DAY_MS
+    first_hour = start_ms // HOUR_MS * HOUR_MS
+    if first_day >= end_day:
+        _check_points(end_ms // HOUR_MS - start_ms // HOUR_MS + 1)
+        return [("hour", bucket) for bucket in range(first_hour, end_ms + 1, HOUR_MS)]
+    _check_points(
+        (first_day - first_hour) // HOUR_MS + (end_day - first_day) // DAY_MS + end_ms // HOUR_MS - end_day // HOUR_MS + 1
+    )
+    buckets = [("hour", bucket) for bucket in range(first_hour, first_day, HOUR_MS)]
+    buckets += [("day", bucket) for bucket in range(first_day, end_day, DAY_MS)]
+    buckets += [("hour", bucket) for bucket in range(end_day, end_ms + 1, HOUR_MS)]
+    return buckets
+
+
+async def count_range(redis_client: redis.Redis, kind: str, start_ms: int, end_ms: int) -> Dict[str, Any]:
+    """
+    範圍內的不重複會話 / 使用者數（PFMERGE 後 PFCOUNT，合併結果短暫快取）。
+    範圍截到日桶保留期內、不晚於現在，並對齊到整點；回傳的 start_ts / end_ts 為實際涵蓋的範圍。
+    """
+    if kind not in KINDS:
+        raise ValueError(f"Unknown kind: {kind}")
+    start_ms, end_ms = _clamp(start_ms, end_ms, "day")
+    if start_ms > end_ms:
+        return {"kind": kind, "start_ts": start_ms, "end_ts": end_ms, "count": 0, "buckets": {"hour": 0, "day": 0}}
+    # 對齊到整點：同一小時內的不同毫秒範圍涵蓋相同的時間桶，共用合併快取
+    start_ms = start_ms // HOUR_MS * HOUR_MS
+    end_ms = end_ms // HOUR_MS * HOUR_MS + HOUR_MS - 1
+    buckets = cover(start_ms, end_ms)
+    target = merged_key(kind, start_ms, end_ms)
+
+    count = None
+    if await redis_client.exists(target):
+        count = await redis_client.pfcount(target)
+    if count is None:
+        async with redis_client.pipeline() as pipe:
+            pipe.unlink(target)
+            pipe.pfmerge(target, *[hll_key(kind, resolution, bucket) for resolution, bucket in buckets])
+            pipe.expire(target, settings.DISTINCT_MERGE_CACHE_SECONDS)
+            pipe.pfcount(target)
+            count = (await pipe.execute())[-1]
+
+    return {
+        "kind": kind,
+        "start_ts": start_ms,
+        "end_ts": end_ms,
+        "count": count,
+        "buckets": {
+            "hour": sum(1 for resolution, _ in buckets if resolution == "hour"),
+            "day": sum(1 for resolution, _ in buckets if resolution == "day"),
+        },
+    }
+
+
+async def series(
+    redis_client: redis.Redis, kind: str, resolution: str, start_ms: int, end_ms: int
+) -> List[Dict[str, Any]]:
+    """每個時間桶各自的不重複數（範圍截到該解析度的保留期內，最多 ROLLUP_MAX_POINTS 點）"""
+    if kind not in KINDS:
+        raise ValueError(f"Unknown kind: {kind}")
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"Unknown resolution: {resolution}")
+    start_ms, end_ms = _clamp(start_ms, end_ms, resolution)
+    if start_ms > end_ms:
+        return []
+    step = RESOLUTIONS[resolution]
+    _check_points(end_ms // step - start_ms // step + 1)
+    buckets = list(range(start_ms // step * step, end_ms + 1, step))
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for bucket in buckets:
+            pipe.pfcount(hll_key(kind, resolution, bucket))
+        counts = await pipe.execute()
+    return [{"ts": bucket, "count": count} for bucket, count in zip(buckets, counts)]
+
+
+async def backfill(redis_client: redis.Redis, session_ids: Optional[List[str]] = None) -> Dict[str, int]:
+    """從現有訊息回填（PFADD 可重複執行，不會重複計數）"""
+    from services import activity_service, message_store, session_index  # 避免循環導入
+
+    sessions = 0
+    messages = 0
+    async for session_id in message_store.iter_session_ids(redis_client):
+        if session_ids and session_id not in session_ids:
+            continue
+        user_id = await redis_client.hget(session_index.session_key(session_id), "user_id")
+        async for batch in message_store.iter_batches(redis_client, session_id, BACKFILL_BATCH_SIZE):
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for msg in batch:
+                    if not activity_service.is_counted(msg):
+                        continue
+                    keys = script_keys(msg["ts"])
+                    hour_expire, day_expire = script_args(msg["ts"])
+                    for key, expire_at, member in zip(
+                        keys, (hour_expire, day_expire) * 2, (session_id, session_id, user_id, user_id)
+                    ):
+                        if member:
+                            pipe.pfadd(key, member)
+                            pipe.pexpireat(key, expire_at)
+                    messages += 1
+                await pipe.execute()
+        sessions += 1
+
+    print(f"✅ 不重複活躍數回填完成：{sessions} 個會話，{messages} 則使用者訊息")
+    return {"sessions": sessions, "messages": messages}
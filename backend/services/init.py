@@ -13,7 +13,7 @@ from .session_service import (
     delete_session
 )
 from .search_service import search_messages
-from .ai_service import get_ai_response
+from .ai_service import get_ai_response, stream_ai_response
 
 __all__ = [
     "save_message",
@@ -24,5 +24,6 @@ __all__ = [
     "create_session",
     "delete_session",
     "search_messages",
-    "get_ai_response"
+    "get_ai_response",
+    "stream_ai_response"
 ]
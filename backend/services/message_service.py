@@ -1,15 +1,18 @@
 """
 訊息相關的業務邏輯
 """
-import json
 import time
-import asyncio
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 import redis.asyncio as redis  # 統一使用非同步 Redis 模組
 
 # 導入 Redis-OM 的同步連線
 from database.redis_client import redis_om_conn
+from database.scripts import execute_pipeline
 from models.chat import ChatMessage  # 假設 ChatMessage 是 RediSearch ORM 模型
+from services import deleted_store, message_store
+from services.search_index import index_message, unindex_message
+from services.trending_service import record_keywords
+from services.version_service import bump_versions
 
 # 將同步客戶端綁定給 Redis-OM 模型 (這是 Redis-OM 要求的)
 ChatMessage.Meta.database = redis_om_conn
@@ -17,49 +20,63 @@ ChatMessage.Meta.database = redis_om_conn
 
 async def save_message(redis_client: redis.Redis, session_id: str, msg_data: Dict[str, Any]):
     """
-    儲存訊息到 Redis List 和 ORM。
+    儲存訊息：一次往返（MULTI）內以 save_message 腳本寫入 ts 索引結構、ORM hash、chat_stream
+    與會話摘要（訊息數、最後活動時間、預覽），並更新搜尋索引、熱門關鍵詞與版本號。
     """
     print(f"INFO: Saving message to session '{session_id}'...")
 
-    # 1. 儲存到 Redis List (用於快速查詢和歷史)
-    await redis_client.rpush(f"chat_history:{session_id}", json.dumps(msg_data))
+    async with redis_client.pipeline() as pipe:
+        message_store.queue_save(pipe, session_id, msg_data)
+        index_message(pipe, session_id, msg_data)
+        record_keywords(pipe, msg_data)
+        bump_versions(pipe, session_id)
+        await execute_pipeline(redis_client, pipe)
+
+    print(f"INFO: Message saved (PK: {ChatMessage.message_pk(session_id, msg_data['ts'])}).")
+
+
+async def get_message_page(
+    redis_client: redis.Redis,
+    session_id: str,
+    limit: int,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    以游標分頁讀取訊息（ZRANGEBYSCORE 有界視窗 + HMGET）：
+    - 無游標：最新的 limit 則
+    - before：ts < before 的最新 limit 則（往舊的方向捲動）
+    - after：ts > after 的最舊 limit 則（往新的方向補齊）
+    next_cursor 為同方向下一頁要帶入的 ts，沒有更多資料時為 None。
+    """
+    messages, has_more = await message_store.fetch_window(
+        redis_client, session_id, limit, before=before, after=after
+    )
 
-    # 2. 儲存到 RediSearch ORM (用於全文搜索和持久化)
-    try:
-        cm = ChatMessage(
-            session_id=session_id,
-            sender=msg_data["sender"],
-            content=msg_data["content"],
-            ts=msg_data["ts"],
-        )
-        await asyncio.to_thread(cm.save)
-        print(f"INFO: Message saved via Redis-OM (PK: {cm.pk}).")
-    except Exception as e:
-        print(f"ERROR: Failed to save message via Redis-OM: {e}")
-        # 不拋錯，讓服務繼續運行
+    next_cursor = None
+    if has_more and messages:
+        next_cursor = messages[-1]["ts"] if after is not None else messages[0]["ts"]
+
+    print(f"DEBUG history page for {session_id}: {len(messages)} messages, has_more={has_more}")
+    return {"messages": messages, "next_cursor": next_cursor, "has_more": has_more}
 
 
-async def get_message_history(redis_client: redis.Redis, session_id: str) -> List[Dict[str, Any]]:
+async def get_message_history(
+    redis_client: redis.Redis,
+    session_id: str,
+    limit: Optional[int] = None,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+) -> List[Dict[str, Any]]:
     """
     獲取會話的訊息歷史。
+    指定 limit 時改用游標分頁（見 get_message_page），否則回傳完整歷史。
     """
-    history = await redis_client.lrange(f"chat_history:{session_id}", 0, -1)
-    print(f"DEBUG history raw for {session_id}:", history)
-
-    messages: List[Dict[str, Any]] = []
-
-    for msg in history:
-        try:
-            if isinstance(msg, bytes):
-                decoded = msg.decode()
-            else:
-                decoded = msg
+    if limit is not None:
+        page = await get_message_page(redis_client, session_id, limit, before=before, after=after)
+        return page["messages"]
 
-            if decoded != "__deleted__":
-                messages.append(json.loads(decoded))
-        except Exception as e:
-            print(f"WARNING: Failed to decode message in history for {session_id}: {e}")
-            continue
+    messages = await message_store.fetch_all(redis_client, session_id)
 
     print(f"DEBUG parsed messages for {session_id}:", messages)
     return messages
@@ -67,102 +84,53 @@ async def get_message_history(redis_client: redis.Redis, session_id: str) -> Lis
 
 async def delete_messages_batch(redis_client: redis.Redis, session_id: str, ts_list: List[int]) -> int:
     """
-    批量刪除訊息，只使用 List 重建與刪除歷史，不再呼叫 ORM。
+    批量刪除訊息：先讀出指定 ts 的訊息（搜尋索引需要內容），再以 delete_messages 腳本原子地移除。
+    讀取與寫入各一次往返；會話預覽與 AI 滾動摘要的失效由腳本依執行當下的資料決定。
     """
     now_ts = int(time.time())
-    del_hist_key = f"deleted_history:{session_id}"
-
-    msgs_raw = await redis_client.lrange(f"chat_history:{session_id}", 0, -1)
-    to_delete_ts_str = set(map(str, ts_list))
-
-    messages_to_keep: List[str] = []
-    deleted_msgs: List[Dict[str, Any]] = []
-
-    for msg_raw in msgs_raw:
-        try:
-            if isinstance(msg_raw, bytes):
-                decoded = msg_raw.decode()
-            else:
-                decoded = msg_raw
-
-            if decoded == "__deleted__":
-                continue
-
-            data = json.loads(decoded)
-            ts_val = str(data.get("ts"))
-
-            if ts_val in to_delete_ts_str:
-                if "session_id" not in data:
-                    data["session_id"] = session_id
-                data["deleted_at"] = now_ts
-                deleted_msgs.append(data)
-                print(f"🗑️ 標記刪除: ts={ts_val}, content={data.get('content', '')[:30]}...")
-            else:
-                messages_to_keep.append(decoded)
-        except Exception as e:
-            print(f"⚠️ 處理訊息時出錯: {e}")
-            continue
-
-    # 更新 Redis List + 刪除歷史
+
+    deleted_msgs, survivor_ts = await message_store.fetch_for_delete(redis_client, session_id, ts_list)
+    for data in deleted_msgs:
+        if "session_id" not in data:
+            data["session_id"] = session_id
+        data["deleted_at"] = now_ts
+        print(f"🗑️ 標記刪除: ts={data.get('ts')}, content={data.get('content', '')[:30]}...")
+
+    if not deleted_msgs:
+        print(f"✅ 批量刪除完成: session={session_id}, 沒有可刪除的訊息")
+        return 0
+
+    # 一次往返：腳本移除訊息 / 寫入刪除紀錄 / 移除 ORM hash / 記錄 chat_stream / 捨棄涵蓋的 AI 摘要，
+    # 同一交易更新索引與版本號
     async with redis_client.pipeline() as pipe:
-        pipe.delete(f"chat_history:{session_id}")
-        if messages_to_keep:
-            pipe.rpush(f"chat_history:{session_id}", *messages_to_keep)
-        if deleted_msgs:
-            deleted_json_list = [json.dumps(dm) for dm in deleted_msgs]
-            pipe.rpush(del_hist_key, *deleted_json_list)
-        await pipe.execute()
-
-    # Stream 記錄
-    for ts_val in ts_list:
-        await redis_client.xadd(
-            "chat_stream",
-            fields={
-                "session_id": session_id,
-                "sender": "",
-                "content": "",
-                "ts": str(ts_val),
-                "deleted": "true",
-            },
-        )
-
-    print(f"✅ 批量刪除完成: session={session_id}, 共刪除 {len(deleted_msgs)} 條訊息")
-    return len(deleted_msgs)
+        message_store.queue_delete(pipe, session_id, now_ts, deleted_msgs, survivor_ts)
+        for dm in deleted_msgs:
+            unindex_message(pipe, session_id, dm)
+        bump_versions(pipe, session_id)
+        results = await execute_pipeline(redis_client, pipe)
+
+    deleted_count = len(results[0])
+    print(f"✅ 批量刪除完成: session={session_id}, 共刪除 {deleted_count} 條訊息")
+    return deleted_count
 
 
 async def restore_message(redis_client: redis.Redis, session_id: str, ts_to_restore: int, deleted_at: int) -> bool:
     """
     復原已刪除的訊息（按時間順序插入）。
+    刪除紀錄以 "{ts}:{deleted_at}" 直接定位，不需要掃描整個刪除歷史。
     """
-    del_hist_key = f"deleted_history:{session_id}"
-    deleted_messages_raw = await redis_client.lrange(del_hist_key, 0, -1)
-
-    message_to_restore = None
-    remaining_deleted: List[str] = []
-
     print(f"🔍 正在搜尋要復原的訊息: session={session_id}, ts={ts_to_restore}")
 
-    for msg_raw in deleted_messages_raw:
-        try:
-            if isinstance(msg_raw, bytes):
-                decoded = msg_raw.decode()
-            else:
-                decoded = msg_raw
-
-            data = json.loads(decoded)
-
-            if int(data.get("ts")) == int(ts_to_restore) and int(data.get("deleted_at")) == int(deleted_at):
-                message_to_restore = data
-                print("✅ 找到要復原的訊息")
-            else:
-                remaining_deleted.append(decoded)
-        except Exception as e:
-            print(f"⚠️ 無法解析訊息: {e}")
-            continue
+    try:
+        message_to_restore = await deleted_store.get_record(redis_client, session_id, ts_to_restore, deleted_at)
+    except Exception as e:
+        print(f"⚠️ 無法解析訊息: {e}")
+        message_to_restore = None
 
     if not message_to_restore:
         print("❌ 找不到要復原的訊息")
         return False
+    print("✅ 找到要復原的訊息")
 
     # 移除 deleted_at 欄位
     message_to_restore.pop("deleted_at", None)
@@ -172,59 +140,15 @@ async def restore_message(redis_client: redis.Redis, session_id: str, ts_to_rest
         message_to_restore["session_id"] = session_id
 
     try:
-        existing_messages_raw = await redis_client.lrange(f"chat_history:{session_id}", 0, -1)
-        all_messages: List[Dict[str, Any]] = []
-
-        for msg_raw in existing_messages_raw:
-            try:
-                if isinstance(msg_raw, bytes):
-                    decoded = msg_raw.decode()
-                else:
-                    decoded = msg_raw
-
-                if decoded != "__deleted__":
-                    all_messages.append(json.loads(decoded))
-            except Exception as e:
-                print(f"⚠️ 解析現有訊息失敗: {e}")
-                continue
-
-        all_messages.append(message_to_restore)
-        all_messages.sort(key=lambda x: x.get("ts", 0))
-
-        print(f"📝 重新排序訊息: 共 {len(all_messages)} 條")
-
+        # 一次往返：腳本以 HDEL 取回刪除紀錄，成功時才寫回訊息結構 / ORM hash / chat_stream（Sorted Set 依 ts 自動排序）
+        # 並寫入搜尋索引、遞增版本號、捨棄涵蓋此訊息的 AI 滾動摘要；紀錄已不存在時不會留下任何資料
         async with redis_client.pipeline() as pipe:
-            pipe.delete(del_hist_key)
-            pipe.delete(f"chat_history:{session_id}")
-
-            if remaining_deleted:
-                pipe.rpush(del_hist_key, *remaining_deleted)
-
-            sorted_messages_json = [json.dumps(msg) for msg in all_messages]
-            pipe.rpush(f"chat_history:{session_id}", *sorted_messages_json)
-
-            await pipe.execute()
-
-        print("✅ Redis 更新完成（訊息已按時間排序）")
-
-        cm = ChatMessage(
-            session_id=message_to_restore["session_id"],
-            sender=message_to_restore["sender"],
-            content=message_to_restore["content"],
-            ts=message_to_restore["ts"],
-        )
-        await asyncio.to_thread(cm.save)
-
-        await redis_client.xadd(
-            "chat_stream",
-            fields={
-                "session_id": session_id,
-                "sender": message_to_restore["sender"],
-                "content": message_to_restore["content"],
-                "ts": str(message_to_restore["ts"]),
-                "deleted": "false",
-            },
-        )
+            message_store.queue_restore(pipe, session_id, deleted_at, message_to_restore)
+            results = await execute_pipeline(redis_client, pipe)
+
+        if not results[0]:
+            print("❌ 刪除紀錄已被其他請求復原或清除")
+            return False
 
         print("✅ 訊息復原完成（已按時間順序插入）")
         return True
@@ -238,47 +162,10 @@ async def restore_message(redis_client: redis.Redis, session_id: str, ts_to_rest
 
 async def get_deleted_history(redis_client: redis.Redis, session_id: str) -> list:
     """
-    獲取刪除紀錄並清理過期紀錄。
+    獲取保留期限內的刪除紀錄（依刪除時間排序）。
+    過期紀錄以 score 範圍直接排除，實際刪除交給背景清理器（services/deleted_store.py）。
     """
-    from config import settings
-
-    del_hist_key = f"deleted_history:{session_id}"
-    deleted_messages_raw = await redis_client.lrange(del_hist_key, 0, -1)
-
-    current_time = int(time.time())
-    valid_messages: List[Dict[str, Any]] = []
-    expired_indices: List[int] = []
-
     print(f"🔍 正在檢查會話 {session_id} 的刪除紀錄...")
-    print(f"   原始紀錄數: {len(deleted_messages_raw)}")
-
-    for idx, msg_raw in enumerate(deleted_messages_raw):
-        try:
-            if isinstance(msg_raw, bytes):
-                decoded = msg_raw.decode()
-            else:
-                decoded = msg_raw
-
-            data = json.loads(decoded)
-            deleted_at = data.get("deleted_at", 0)
-
-            if current_time - deleted_at > settings.DELETE_RECORD_RETENTION_SECONDS:
-                expired_indices.append(idx)
-                print(f"   ⚠️ 紀錄 {idx} 已過期")
-            else:
-                valid_messages.append(data)
-        except Exception as e:
-            print(f"   ⚠️ 無法解析紀錄 {idx}: {e}")
-            continue
-
-    if expired_indices:
-        async with redis_client.pipeline() as pipe:
-            pipe.delete(del_hist_key)
-            if valid_messages:
-                valid_json_list = [json.dumps(vm) for vm in valid_messages]
-                pipe.rpush(del_hist_key, *valid_json_list)
-            await pipe.execute()
-        print(f"   🧹 清理了 {len(expired_indices)} 條過期紀錄")
-
+    valid_messages = await deleted_store.list_records(redis_client, session_id)
     print(f"✅ 返回 {len(valid_messages)} 條有效刪除紀錄")
     return valid_messages
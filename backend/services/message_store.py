@@ -0,0 +1,330 @@
+"""
+以 ts 為索引的訊息儲存結構
+
+- chat_history_ts:{session_id}    Sorted Set，member = str(ts)，score = ts（決定訊息順序）
+- chat_history_body:{session_id}  Hash，field = str(ts)，value = 訊息 JSON
+
+新增 / 刪除 / 復原只動到受影響的訊息（O(k log n)），順序由 Sorted Set 維護，
+不需要再讀出整個 List、在 Python 重建後寫回，也不會與並行的 save_message 互相覆蓋。
+同一會話內 ts 為唯一鍵（與刪除 / 復原以 ts 定位訊息的語意一致）。
+
+本文以 utils/message_codec.py 編碼（精簡 JSON，長訊息壓縮），讀取時相容舊的 JSON 字串。
+寫入路徑透過 database/scripts.py 的 Lua 腳本，一次原子地更新訊息結構、ORM hash、chat_stream、會話摘要與活躍度統計。
+
+舊的 chat_history:{session_id} List 以 migrate_all_sessions 一次轉換（python manage.py migrate-message-store）。
+"""
+import json
+import time
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple
+import redis.asyncio as redis
+
+from database.scripts import queue_script
+from models.chat import ChatMessage
+from config import settings
+from services import activity_service, deleted_store, distinct_service, session_index, stream_service
+from services.version_service import GLOBAL_VERSION_KEY, session_version_key
+from utils import message_codec
+
+MIGRATION_BATCH_SIZE = 500
+
+
+def order_key(session_id: str) -> str:
+    return f"chat_history_ts:{session_id}"
+
+
+def body_key(session_id: str) -> str:
+    return f"chat_history_body:{session_id}"
+
+
+def encode_message(msg_data: Dict[str, Any]) -> str:
+    """訊息本文 / 刪除紀錄的儲存格式（見 utils/message_codec.py）"""
+    return message_codec.encode(msg_data)
+
+
+def decode_message(raw: Any) -> Optional[Dict[str, Any]]:
+    """解碼任一版本的儲存格式（含舊的 json.dumps 字串）"""
+    return message_codec.decode(raw)
+
+
+def orm_key(session_id: str, ts: Any) -> str:
+    return ChatMessage.make_primary_key(ChatMessage.message_pk(session_id, ts))
+
+
+def store_message(pipe, session_id: str, msg_data: Dict[str, Any]) -> None:
+    """寫入（或覆蓋同 ts 的）訊息，不含 ORM / stream（遷移、匯入用；加入 pipeline，不執行）"""
+    ts = int(msg_data["ts"])
+    pipe.zadd(order_key(session_id), {str(ts): ts})
+    pipe.hset(body_key(session_id), str(ts), encode_message(msg_data))
+
+
+def store_document(pipe, session_id: str, msg_data: Dict[str, Any]) -> None:
+    """寫入 chatmessage_idx 使用的 ORM hash（與 save_message 腳本相同欄位；加入 pipeline，不執行）"""
+    ts = int(msg_data["ts"])
+    pk = ChatMessage.message_pk(session_id, ts)
+    pipe.hset(
+        ChatMessage.make_primary_key(pk),
+        mapping={
+            "pk": pk,
+            "session_id": session_id,
+            "sender": msg_data.get("sender", ""),
+            "content": msg_data.get("content", ""),
+            "ts": ts,
+        },
+    )
+
+
+def queue_save(pipe, session_id: str, msg_data: Dict[str, Any]) -> None:
+    """以 save_message 腳本寫入訊息 + ORM hash + chat_stream（加入 pipeline，不執行）"""
+    ts = int(msg_data["ts"])
+    queue_script(
+        pipe,
+        "save_message",
+        keys=[
+            order_key(session_id),
+            body_key(session_id),
+            orm_key(session_id, ts),
+            stream_service.stream_key(session_id, ts),
+            session_index.session_key(session_id),
+            session_index.ORDER_KEYS["activity"],
+            activity_service.hourly_key(session_id),
+            activity_service.daily_key(session_id),
+            stream_service.PARTITIONS_KEY,
+            *distinct_service.script_keys(ts),
+        ],
+        args=[
+            ts,
+            encode_message(msg_data),
+            ChatMessage.message_pk(session_id, ts),
+            session_id,
+            msg_data.get("sender", ""),
+            msg_data.get("content", ""),
+            settings.SESSION_PREVIEW_BYTES,
+            *activity_service.slot_args(msg_data),
+            *stream_service.event_args(ts),
+            *distinct_service.script_args(ts),
+        ],
+    )
+
+
+async def fetch_for_delete(
+    redis_client: redis.Redis, session_id: str, ts_list: List[Any]
+) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    """
+    一次往返取回要刪除的訊息，以及刪除後預期成為最新一則的訊息 ts（沒有剩下的訊息時為 None）。
+    後者只是提示：delete_messages 腳本會自行確認實際的最新訊息。
+    """
+    fields = [str(int(ts)) for ts in ts_list]
+    if not fields:
+        return [], None
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hmget(body_key(session_id), fields)
+        pipe.zrevrange(order_key(session_id), 0, len(fields))
+        raw_bodies, top = await pipe.execute()
+
+    removing = {int(ts) for ts in fields}
+    survivor_ts = next((int(member) for member in top if int(member) not in removing), None)
+    return _decode_bodies(raw_bodies, session_id), survivor_ts
+
+
+def queue_delete(
+    pipe, session_id: str, deleted_at: int, records: List[Dict[str, Any]], survivor_ts: Optional[int] = None
+) -> None:
+    """
+    以 delete_messages 腳本移除訊息、寫入刪除紀錄（deleted_store）、移除 ORM hash、記錄 chat_stream，
+    刪除的訊息落在 AI 滾動摘要涵蓋的範圍內時一併捨棄摘要（加入 pipeline，不執行）。
+    records 為要寫入刪除紀錄的內容（已含 deleted_at）；survivor_ts 為預期刪除後的最新訊息（fetch_for_delete），
+    腳本確認仍是最新訊息時從其 ORM hash 讀取會話預覽。
+    """
+    from services import context_service  # 避免循環導入（context_service 需要本模組）
+
+    if not records:
+        return
+    keys = [
+        order_key(session_id),
+        body_key(session_id),
+        deleted_store.index_key(session_id),
+        deleted_store.body_key(session_id),
+        deleted_store.DELETED_SESSIONS_KEY,
+        stream_service.stream_key(session_id, int(deleted_at) * 1000),
+        session_index.session_key(session_id),
+        session_index.ORDER_KEYS["activity"],
+        activity_service.hourly_key(session_id),
+        activity_service.daily_key(session_id),
+        stream_service.PARTITIONS_KEY,
+        context_service.summary_key(session_id),
+    ]
+    if survivor_ts is not None:
+        keys.append(orm_key(session_id, survivor_ts))
+    args: List[Any] = [
+        session_id, int(deleted_at), settings.SESSION_PREVIEW_BYTES, "" if survivor_ts is None else int(survivor_ts),
+        *stream_service.event_args(),
+    ]
+    for record in records:
+        keys.append(orm_key(session_id, record["ts"]))
+        args.extend([int(record["ts"]), encode_message(record), *activity_service.slot_args(record)])
+    queue_script(pipe, "delete_messages", keys=keys, args=args)
+
+
+def queue_restore(pipe, session_id: str, deleted_at: int, msg_data: Dict[str, Any]) -> None:
+    """
+    以 restore_message 腳本將刪除紀錄移回訊息結構，並寫入搜尋索引、遞增版本號、
+    必要時捨棄 AI 滾動摘要（皆在取回紀錄成功後才執行；加入 pipeline，不執行）
+    """
+    from services import context_service, search_index  # 避免循環導入（兩者都需要本模組）
+
+    ts = int(msg_data["ts"])
+    posting, term_keys = search_index.posting_keys(session_id, msg_data)
+    queue_script(
+        pipe,
+        "restore_message",
+        keys=[
+            deleted_store.index_key(session_id),
+            deleted_store.body_key(session_id),
+            order_key(session_id),
+            body_key(session_id),
+            orm_key(session_id, ts),
+            stream_service.stream_key(session_id, time.time() * 1000),
+            session_index.session_key(session_id),
+            session_index.ORDER_KEYS["activity"],
+            activity_service.hourly_key(session_id),
+            activity_service.daily_key(session_id),
+            stream_service.PARTITIONS_KEY,
+            context_service.summary_key(session_id),
+            GLOBAL_VERSION_KEY,
+            session_version_key(session_id),
+            *term_keys,
+        ],
+        args=[
+            deleted_store.record_id(ts, deleted_at),
+            ts,
+            encode_message(msg_data),
+            ChatMessage.message_pk(session_id, ts),
+            session_id,
+            msg_data.get("sender", ""),
+            msg_data.get("content", ""),
+            settings.SESSION_PREVIEW_BYTES,
+            *activity_service.slot_args(msg_data),
+            *stream_service.event_args(),
+            posting,
+        ],
+    )
+
+
+def _decode_bodies(raw_bodies: List[Any], session_id: str) -> List[Dict[str, Any]]:
+    messages: List[Dict[str, Any]] = []
+    for raw in raw_bodies:
+        try:
+            msg = decode_message(raw)
+            if msg is not None:
+                messages.append(msg)
+        except Exception as e:
+            print(f"WARNING: Failed to decode message in history for {session_id}: {e}")
+    return messages
+
+
+async def fetch_messages(redis_client: redis.Redis, session_id: str, ts_list: Iterable[int]) -> List[Dict[str, Any]]:
+    """依 ts 取回訊息（不存在的略過）"""
+    fields = [str(int(ts)) for ts in ts_list]
+    if not fields:
+        return []
+    return _decode_bodies(await redis_client.hmget(body_key(session_id), fields), session_id)
+
+
+async def fetch_window(
+    redis_client: redis.Redis,
+    session_id: str,
+    limit: int,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    以 ZRANGEBYSCORE 取出一個有界視窗，回傳 (依 ts 遞增的訊息, 同方向是否還有更多)。
+    多取一筆用來判斷 has_more。
+    """
+    key = order_key(session_id)
+    if after is not None:
+        members = await redis_client.zrangebyscore(key, f"({int(after)}", "+inf", start=0, num=limit + 1)
+        has_more = len(members) > limit
+        members = members[:limit]
+    else:
+        high = "+inf" if before is None else f"({int(before)}"
+        members = await redis_client.zrevrangebyscore(key, high, "-inf", start=0, num=limit + 1)
+        has_more = len(members) > limit
+        members = list(reversed(members[:limit]))
+
+    if not members:
+        return [], False
+    raw_bodies = await redis_client.hmget(body_key(session_id), members)
+    return _decode_bodies(raw_bodies, session_id), has_more
+
+
+async def fetch_all(redis_client: redis.Redis, session_id: str) -> List[Dict[str, Any]]:
+    """依 ts 順序取出整個會話（匯出、重建索引等離線用途）"""
+    members = await redis_client.zrange(order_key(session_id), 0, -1)
+    if not members:
+        return []
+    return _decode_bodies(await redis_client.hmget(body_key(session_id), members), session_id)
+
+
+async def iter_batches(
+    redis_client: redis.Redis, session_id: str, batch_size: int = MIGRATION_BATCH_SIZE
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """依 ts 順序（由舊到新）分批取出整個會話，每批最多 batch_size 則（匯出等需要固定記憶體的用途）"""
+    key = order_key(session_id)
+    low = "-inf"
+    while True:
+        members = await redis_client.zrangebyscore(key, low, "+inf", start=0, num=batch_size)
+        if not members:
+            break
+        messages = _decode_bodies(await redis_client.hmget(body_key(session_id), members), session_id)
+        if messages:
+            yield messages
+        if len(members) < batch_size:
+            break
+        low = f"({members[-1]}"
+
+
+async def iter_session_ids(redis_client: redis.Redis) -> AsyncIterator[str]:
+    """列出所有有訊息的會話（掃描 chat_history_ts:*）"""
+    prefix = order_key("")
+    async for key in redis_client.scan_iter(f"{prefix}*", count=MIGRATION_BATCH_SIZE):
+        yield key[len(prefix):]
+
+
+async def migrate_session(redis_client: redis.Redis, session_id: str) -> int:
+    """將單一會話從 chat_history List 轉換到新結構，完成後刪除舊 List"""
+    legacy_key = f"chat_history:{session_id}"
+    history = await redis_client.lrange(legacy_key, 0, -1)
+
+    migrated = 0
+    async with redis_client.pipeline() as pipe:
+        for raw in history:
+            try:
+                decoded = raw.decode() if isinstance(raw, bytes) else raw
+                if decoded == "__deleted__":
+                    continue
+                store_message(pipe, session_id, json.loads(decoded))
+                migrated += 1
+            except Exception as e:
+                print(f"⚠️ 轉換訊息失敗 ({session_id}): {e}")
+                continue
+        pipe.unlink(legacy_key)
+        await pipe.execute()
+
+    return migrated
+
+
+async def migrate_all_sessions(redis_client: redis.Redis) -> Dict[str, int]:
+    """轉換所有 chat_history:* List（可重複執行，已轉換的會話不會再被掃到）"""
+    session_count = 0
+    message_count = 0
+    async for key in redis_client.scan_iter("chat_history:*", count=MIGRATION_BATCH_SIZE):
+        if await redis_client.type(key) != "list":
+            continue
+        _, session_id = key.split(":", 1)
+        message_count += await migrate_session(redis_client, session_id)
+        session_count += 1
+        print(f"   📦 已轉換會話 {session_id}")
+
+    print(f"✅ 訊息儲存結構轉換完成：{session_count} 個會話，{message_count} 則訊息")
+    return {"sessions": session_count, "messages": message_count}
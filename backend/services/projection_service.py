@@ -0,0 +1,260 @@
+"""
+事件流投影（chat_stream 的消費者群組）
+
+寫入路徑只負責 XADD 事件（見 services/stream_service.py），衍生的統計由背景投影工作以
+消費者群組 PROJECTION_GROUP 讀取事件後更新，讀取端只需讀一個小 hash（最終一致）：
+
+- projection:senders          Hash，field = sender，value = 寫入的訊息數（含覆寫與復原，單調遞增）
+- projection:hourly           Hash，field = "YYYY-MM-DD HH:00"（台灣時間），value = 所有會話寫入的訊息數
+- projection:session:{sid}    Hash：saved / deleted / events / first_ts / last_ts（訊息 ts 的最小 / 最大值）/ last_event_id
+- projection:status           Hash：processed / last_event_id / last_applied_at
+- rollup:*                    全域分鐘 / 小時 / 日統計（見 services/rollup_service.py）
+
+每批事件的統計更新與 XACK 放在同一個 MULTI 中，因此不會重複計數；
+處理到一半中斷的事件留在 PEL 中，由 XAUTOCLAIM 在閒置 PROJECTION_CLAIM_IDLE_MS 後轉給其他消費者。
+多個程序以不同的 consumer 名稱加入同一群組即可水平擴充（python manage.py run-projections）。
+已不在 active_sessions 中的會話事件只會被確認、不會再建立統計。
+"""
+import asyncio
+import os
+import socket
+import time
+from typing import Any, Dict, List, Optional, Tuple
+import redis.asyncio as redis
+from redis.exceptions import ResponseError
+
+from config import settings
+from database.scripts import execute_pipeline, queue_script
+from services import activity_service, rollup_service, session_index, stream_service
+
+SENDERS_KEY = "projection:senders"
+HOURLY_KEY = "projection:hourly"
+STATUS_KEY = "projection:status"
+STREAMS_PER_READ = 100
+CLAIM_EVERY_ROUNDS = 30
+
+
+def session_stats_key(session_id: str) -> str:
+    return f"projection:session:{session_id}"
+
+
+def consumer_name() -> str:
+    return settings.PROJECTION_CONSUMER or f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _id_ms(entry_id: str) -> int:
+    return int(entry_id.split("-")[0])
+
+
+async def ensure_groups(redis_client: redis.Redis, known: set) -> List[str]:
+    """
+    為所有事件流分區建立消費者群組（已存在則略過），回傳目前的分區列表。
+    已過期的分區（key 不存在）從 chat_stream_partitions 移除，不重新建立。
+    """
+    streams = []
+    for key in sorted(await redis_client.smembers(stream_service.PARTITIONS_KEY)):
+        if key not in known:
+            if not await redis_client.exists(key):
+                await redis_client.srem(stream_service.PARTITIONS_KEY, key)
+                continue
+            try:
+                await redis_client.xgroup_create(key, settings.PROJECTION_GROUP, id="0")
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+            known.add(key)
+        streams.append(key)
+    return streams
+
+
+async def apply_events(
+    redis_client: redis.Redis, entries: List[Tuple[str, str, Dict[str, Any]]]
+) -> int:
+    """將一批 (stream, entry_id, fields) 投影到統計 hash，並在同一個 MULTI 中 XACK"""
+    if not entries:
+        return 0
+
+    session_ids = sorted({fields.get("session_id", "") for _, _, fields in entries})
+    active = await redis_client.smismember(session_index.ACTIVE_SESSIONS_KEY, session_ids)
+    active_sessions = {sid for sid, is_active in zip(session_ids, active) if is_active}
+    # 本批事件中各會話訊息 ts 的最小 / 最大值（事件可能不依 ts 順序到達），與既有值的比較在伺服器端進行
+    bounds: Dict[str, List[int]] = {}
+
+    acks: Dict[str, List[str]] = {}
+    last_id = ""
+    async with redis_client.pipeline() as pipe:
+        for stream, entry_id, fields in entries:
+            acks.setdefault(stream, []).append(entry_id)
+            if _id_ms(entry_id) >= _id_ms(last_id or "0-0"):
+                last_id = entry_id
+
+            session_id = fields.get("session_id", "")
+            if session_id not in active_sessions:
+                continue
+
+            stats_key = session_stats_key(session_id)
+            ts = fields.get("ts", "")
+            pipe.hincrby(stats_key, "events", 1)
+            pipe.hset(stats_key, "last_event_id", entry_id)
+            if fields.get("deleted") == "true":
+                pipe.hincrby(stats_key, "deleted", 1)
+                continue
+
+            pipe.hincrby(stats_key, "saved", 1)
+            pipe.hincrby(SENDERS_KEY, fields.get("sender") or "unknown", 1)
+            if str(ts).isdigit():
+                first, last = bounds.get(session_id, (int(ts), int(ts)))
+                bounds[session_id] = [min(first, int(ts)), max(last, int(ts))]
+                hour, _ = activity_service.time_slots(ts)
+                pipe.hincrby(HOURLY_KEY, hour, 1)
+
+        for session_id, (first, last) in bounds.items():
+            queue_script(pipe, "session_range", [session_stats_key(session_id)], [first, last])
+
+        # 全域統計不分會話是否仍存在（事件確實發生過）
+        rollup_service.queue_events(
+            pipe, [(rollup_service.event_time(_id_ms(entry_id), fields), fields) for _, entry_id, fields in entries]
+        )
+        for stream, ids in acks.items():
+            pipe.xack(stream, settings.PROJECTION_GROUP, *ids)
+        pipe.hincrby(STATUS_KEY, "processed", len(entries))
+        pipe.hset(STATUS_KEY, mapping={"last_event_id": last_id, "last_applied_at": int(time.time() * 1000)})
+        await execute_pipeline(redis_client, pipe)
+    return len(entries)
+
+
+async def claim_stale(redis_client: redis.Redis, streams: List[str], consumer: str) -> int:
+    """以 XAUTOCLAIM 接手其他消費者閒置過久的待確認事件並套用"""
+    claimed = 0
+    for stream in streams:
+        start = "0-0"
+        while True:
+            result = await redis_client.xautoclaim(
+                stream, settings.PROJECTION_GROUP, consumer,
+                settings.PROJECTION_CLAIM_IDLE_MS, start_id=start, count=settings.PROJECTION_BATCH_SIZE,
+            )
+            start, messages = result[0], result[1]
+            entries = [(stream, entry_id, fields) for entry_id, fields in messages if fields]
+            claimed += await apply_events(redis_client, entries)
+            # 已被修剪的事件（fields 為空）不會再有內容，直接確認
+            trimmed = [entry_id for entry_id, fields in messages if not fields]
+            if trimmed:
+                await redis_client.xack(stream, settings.PROJECTION_GROUP, *trimmed)
+            if start == "0-0" or not messages:
+                break
+    if claimed:
+        print(f"INFO: Projection consumer '{consumer}' reclaimed {claimed} pending events.")
+    return claimed
+
+
+async def read_once(redis_client: redis.Redis, streams: List[str], consumer: str, block_ms: Optional[int]) -> int:
+    """XREADGROUP 讀取新事件並套用（分區很多時分批讀取）"""
+    applied = 0
+    for i in range(0, len(streams), STREAMS_PER_READ):
+        chunk = streams[i:i + STREAMS_PER_READ]
+        response = await redis_client.xreadgroup(
+            settings.PROJECTION_GROUP, consumer, {key: ">" for key in chunk},
+            count=settings.PROJECTION_BATCH_SIZE, block=block_ms,
+        )
+        entries = [
+            (stream, entry_id, fields)
+            for stream, messages in (response or [])
+            for entry_id, fields in messages
+        ]
+        applied += await apply_events(redis_client, entries)
+    return applied
+
+
+async def get_status(redis_client: redis.Redis) -> Dict[str, Any]:
+    """
+    投影進度：每個分區的待確認數、尚未讀取的事件數（Redis 7 的 XINFO GROUPS lag）
+    以及以時間表示的落後量（分區最後一筆事件與群組最後讀取位置的毫秒差）。
+    """
+    status = await redis_client.hgetall(STATUS_KEY)
+    partitions = []
+    for stream in sorted(await redis_client.smembers(stream_service.PARTITIONS_KEY)):
+        try:
+            groups = await redis_client.xinfo_groups(stream)
+            info = await redis_client.xinfo_stream(stream)
+        except ResponseError:
+            continue
+        group = next((g for g in groups if g.get("name") == settings.PROJECTION_GROUP), None)
+        last_entry = info.get("last-generated-id") or "0-0"
+        delivered = (group or {}).get("last-delivered-id") or "0-0"
+        if delivered == "0-0" and info.get("first-entry"):
+            # 尚未讀取任何事件：落後量為整個分區的時間跨度
+            delivered = info["first-entry"][0]
+        partitions.append({
+            "stream": stream,
+            "length": info.get("length", 0),
+            "pending": (group or {}).get("pending", 0),
+            "lag": (group or {}).get("lag"),
+            "lag_ms": max(0, _id_ms(last_entry) - _id_ms(delivered)),
+            "consumers": (group or {}).get("consumers", 0),
+        })
+    return {
+        "group": settings.PROJECTION_GROUP,
+        "processed": int(status.get("processed", 0)),
+        "last_event_id": status.get("last_event_id"),
+        "last_applied_at": int(status.get("last_applied_at", 0)) or None,
+        "pending": sum(p["pending"] for p in partitions),
+        "lag_ms": max((p["lag_ms"] for p in partitions), default=0),
+        "partitions": partitions,
+    }
+
+
+async def get_sender_counts(redis_client: redis.Redis) -> Dict[str, int]:
+    counts = await redis_client.hgetall(SENDERS_KEY)
+    return {sender: int(count) for sender, count in counts.items()}
+
+
+async def get_global_hourly(redis_client: redis.Redis) -> List[Dict[str, Any]]:
+    counts = await redis_client.hgetall(HOURLY_KEY)
+    return [{"time_slot": slot, "count": int(count)} for slot, count in sorted(counts.items())]
+
+
+async def get_session_stats(redis_client: redis.Redis, session_id: str) -> Dict[str, Any]:
+    data = await redis_client.hgetall(session_stats_key(session_id))
+    return {
+        "session_id": session_id,
+        "saved": int(data.get("saved", 0)),
+        "deleted": int(data.get("deleted", 0)),
+        "events": int(data.get("events", 0)),
+        "first_ts": int(data.get("first_ts", 0)) or None,
+        "last_ts": int(data.get("last_ts", 0)) or None,
+        "last_event_id": data.get("last_event_id"),
+    }
+
+
+async def run_projection_worker(stop_event: asyncio.Event, consumer: Optional[str] = None) -> None:
+    """背景投影工作：阻塞讀取新事件，定期接手閒置的待確認事件並發現新的分區"""
+    from database.redis_client import get_redis_client
+
+    consumer = consumer or consumer_name()
+    known: set = set()
+    streams: List[str] = []
+    rounds = 0
+    print(f"INFO: Projection worker '{consumer}' started (group={settings.PROJECTION_GROUP}).")
+    while not stop_event.is_set():
+        try:
+            redis_client = await get_redis_client()
+            if rounds % CLAIM_EVERY_ROUNDS == 0 or not streams:
+                streams = await ensure_groups(redis_client, known)
+                await claim_stale(redis_client, streams, consumer)
+            rounds += 1
+            if not streams:
+                await asyncio.wait_for(stop_event.wait(), timeout=settings.PROJECTION_BLOCK_MS / 1000)
+                continue
+            await read_once(redis_client, streams, consumer, settings.PROJECTION_BLOCK_MS)
+        except asyncio.TimeoutError:
+            pass
+        except Exception as e:
+            print(f"ERROR: Projection worker failed: {e}")
+            known.clear()
+            streams = []
+            rounds = 0
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=settings.PROJECTION_BLOCK_MS / 1000)
+            except asyncio.TimeoutError:
+                pass
+    print(f"INFO: Projection worker '{consumer}' stopped.")
@@ -0,0 +1,64 @@
+"""
+條件式 GET（ETag / If-None-Match）與回應本體快取
+
+前端會反覆輪詢會話列表、聊天歷史與趨勢圖。這些端點的 ETag 由資料版本號
+（見 services/version_service.py）與查詢參數組成：
+
+- 請求帶的 If-None-Match 與目前 ETag 相同 → 只讀一次版本號就回 304，不讀訊息、不序列化
+- 否則先查行程內 LRU（以版本號驗證，沿用 SearchResultCache），命中就直接回傳已序列化的本體
+- 都沒有才讀取資料並序列化，存入快取
+
+版本號在讀取資料之前取得：讀取期間若有寫入，本體只會比版本號新，下一次請求會因版本改變而重新產生。
+"""
+import json
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import Request, Response
+
+from config import settings
+from services.search_cache import SearchResultCache
+
+response_cache = SearchResultCache(
+    max_size=settings.RESPONSE_CACHE_SIZE,
+    ttl_seconds=settings.RESPONSE_CACHE_TTL_SECONDS,
+)
+
+
+def make_etag(cache_key: str, version: int) -> str:
+    return f'W/"{cache_key[:16]}-{version}"'
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = {tag.strip() for tag in header.split(",")}
+    # 弱比較：忽略 W/ 前綴
+    return "*" in candidates or etag in candidates or etag[2:] in candidates
+
+
+async def versioned_json(
+    request: Request,
+    version: int,
+    key_parts: Tuple[Any, ...],
+    build: Callable[[], Awaitable[Tuple[Any, Optional[Dict[str, str]]]]],
+) -> Response:
+    """
+    以版本號回應 JSON：build() 回傳 (payload, 額外標頭)，只在 ETag 不符且快取未命中時呼叫。
+    """
+    cache_key = SearchResultCache.make_key(*key_parts)
+    etag = make_etag(cache_key, version)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    cached = await response_cache.get(None, cache_key, version)
+    if cached is None:
+        payload, extra_headers = await build()
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        cached = (body, extra_headers or {})
+        await response_cache.set(None, cache_key, version, cached)
+
+    body, extra_headers = cached
+    return Response(content=body, media_type="application/json", headers={**headers, **extra_headers})
@@ -0,0 +1,216 @@
+"""
+全域多解析度統計（所有會話）
+
+事件流投影工作（services/projection_service.py）每處理一批事件，就把計數累加到三種解析度：
+
+- rollup:{resolution}:{metric}:{chunk}      Hash，field = 時間桶起點（毫秒），value = 事件數
+  依解析度把時間切成固定長度的 chunk（minute 一天、hour 30 天、day 一年），
+  整個 chunk key 以 PEXPIREAT 在「chunk 結束 + 該解析度保留期」過期，不需要清理程序。
+- rollup:{resolution}:active_sessions:{bucket}  Set，該時間桶內有事件的 session_id（到期時間同上）
+
+指標（metric）：messages（寫入的訊息）、user_messages（sender=me）、ai_replies（sender=AI）、
+deleted（刪除事件）、active_sessions（時間桶內不重複的會話數）。
+時間以訊息 ts 為準（刪除事件用事件 ID 的毫秒，即刪除時間），時間桶以 UTC 對齊。
+
+查詢時自動挑選最細、且點數不超過 max_points、保留期仍涵蓋起點的解析度；
+連 day 都超過時把相鄰的日桶合併，因此任何範圍最多回傳 max_points 個點，
+讀取的 key 數只與 chunk 數有關（數個月的資料只需讀取數個 hash）。
+"""
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import redis.asyncio as redis
+
+from config import settings
+
+MINUTE_MS = 60 * 1000
+HOUR_MS = 60 * MINUTE_MS
+DAY_MS = 24 * HOUR_MS
+
+# 解析度 -> (時間桶長度, chunk 長度)
+RESOLUTIONS: Dict[str, Tuple[int, int]] = {
+    "minute": (MINUTE_MS, DAY_MS),
+    "hour": (HOUR_MS, 30 * DAY_MS),
+    "day": (DAY_MS, 366 * DAY_MS),
+}
+COUNTER_METRICS = ("messages", "user_messages", "ai_replies", "deleted")
+METRICS = COUNTER_METRICS + ("active_sessions",)
+
+
+def retention_ms(resolution: str) -> int:
+    days = {
+        "minute": settings.ROLLUP_MINUTE_RETENTION_DAYS,
+        "hour": settings.ROLLUP_HOUR_RETENTION_DAYS,
+        "day": settings.ROLLUP_DAY_RETENTION_DAYS,
+    }[resolution]
+    return days * DAY_MS
+
+
+def counter_key(resolution: str, metric: str, chunk: int) -> str:
+    return f"rollup:{resolution}:{metric}:{chunk}"
+
+
+def active_key(resolution: str, bucket_ms: int) -> str:
+    return f"rollup:{resolution}:active_sessions:{bucket_ms}"
+
+
+def event_time(entry_ms: int, fields: Dict[str, Any]) -> int:
+    """事件計入的時間：儲存事件用訊息 ts（串流 ID 可能因亂序退回伺服器時間），其他用事件 ID"""
+    ts = str(fields.get("ts", ""))
+    if fields.get("deleted") != "true" and ts.isdigit():
+        return int(ts)
+    return entry_ms
+
+
+def event_metrics(fields: Dict[str, Any]) -> List[str]:
+    """事件計入的計數指標"""
+    if fields.get("deleted") == "true":
+        return ["deleted"]
+    metrics = ["messages"]
+    sender = str(fields.get("sender", "")).lower()
+    if sender == "me":
+        metrics.append("user_messages")
+    elif sender == "ai":
+        metrics.append("ai_replies")
+    return metrics
+
+
+def queue_events(pipe, events: Iterable[Tuple[int, Dict[str, Any]]]) -> None:
+    """
+    將一批 (事件毫秒, 事件欄位) 累加到各解析度的統計（先在記憶體合併，每個時間桶一個 HINCRBY；
+    加入 pipeline，不執行）。
+    """
+    counts: Dict[Tuple[str, str, int, int], int] = {}
+    active: Dict[Tuple[str, int], set] = {}
+    for event_ms, fields in events:
+        for resolution, (bucket_len, chunk_len) in RESOLUTIONS.items():
+            bucket = event_ms // bucket_len * bucket_len
+            chunk = event_ms // chunk_len
+            for metric in event_metrics(fields):
+                counts[(resolution, metric, chunk, bucket)] = counts.get((resolution, metric, chunk, bucket), 0) + 1
+            if fields.get("session_id"):
+                active.setdefault((resolution, bucket), set()).add(fields["session_id"])
+
+    expiring: Dict[str, int] = {}
+    for (resolution, metric, chunk, bucket), count in counts.items():
+        key = counter_key(resolution, metric, chunk)
+        pipe.hincrby(key, bucket, count)
+        chunk_len = RESOLUTIONS[resolution][1]
+        expiring[key] = (chunk + 1) * chunk_len + retention_ms(resolution)
+    for (resolution, bucket), session_ids in active.items():
+        key = active_key(resolution, bucket)
+        pipe.sadd(key, *session_ids)
+        expiring[key] = bucket + RESOLUTIONS[resolution][0] + retention_ms(resolution)
+    for key, expire_at in expiring.items():
+        pipe.pexpireat(key, expire_at)
+
+
+def pick_resolution(start_ms: int, end_ms: int, max_points: int, now_ms: Optional[int] = None) -> str:
+    """點數不超過 max_points、且保留期涵蓋起點的最細解析度（都不符合時用 day）"""
+    now_ms = now_ms or int(time.time() * 1000)
+    for resolution, (bucket_len, _) in RESOLUTIONS.items():
+        points = (end_ms // bucket_len) - (start_ms // bucket_len) + 1
+        if points <= max_points and start_ms >= now_ms - retention_ms(resolution):
+            return resolution
+    return "day"
+
+
+async def _read_counters(
+    redis_client: redis.Redis, resolution: str, metric: str, buckets: List[int]
+) -> Dict[int, int]:
+    chunk_len = RESOLUTIONS[resolution][1]
+    chunks = sorted({bucket // chunk_len for bucket in buckets})
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for chunk in chunks:
+            pipe.hgetall(counter_key(resolution, metric, chunk))
+        results = await pipe.execute()
+    values: Dict[int, int] = {}
+    for data in results:
+        for bucket, count in data.items():
+            values[int(bucket)] = int(count)
+    return values
+
+
+async def query(
+    redis_client: redis.Redis,
+    metric: str,
+    start_ms: int,
+    end_ms: int,
+    max_points: Optional[int] = None,
+    resolution: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    取得 [start_ms, end_ms] 的時間序列（含 0 的點），最多 max_points 點。
+    未指定 resolution 時自動挑選；點數超過上限時合併相鄰時間桶（計數相加、活躍會話取聯集）。
+    範圍只取該解析度保留期內、不晚於現在的部分（之外沒有資料）。
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric: {metric}")
+    if resolution is not None and resolution not in RESOLUTIONS:
+        raise ValueError(f"Unknown resolution: {resolution}")
+    max_points = min(max_points or settings.ROLLUP_MAX_POINTS, settings.ROLLUP_MAX_POINTS)
+    resolution = resolution or pick_resolution(start_ms, end_ms, max_points)
+
+    bucket_len = RESOLUTIONS[resolution][0]
+    # 保留期之前與未來沒有資料：先截到 [現在 - 保留期, 現在]，時間桶數量不超過保留期內的桶數
+    now_ms = int(time.time() * 1000)
+    start_ms = max(start_ms, now_ms - retention_ms(resolution))
+    end_ms = min(end_ms, now_ms)
+    if start_ms > end_ms:
+        return {"metric": metric, "resolution": resolution, "step_ms": bucket_len, "points": []}
+    buckets = list(range(start_ms // bucket_len * bucket_len, end_ms + 1, bucket_len))
+    group = -(-len(buckets) // max_points)  # 每個點合併的時間桶數（向上取整）
+    groups = [buckets[i:i + group] for i in range(0, len(buckets), group)]
+
+    points: List[Dict[str, Any]] = []
+    if metric == "active_sessions":
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for members in groups:
+                pipe.sunion(*[active_key(resolution, bucket) for bucket in members])
+            unions = await pipe.execute()
+        for members, union in zip(groups, unions):
+            points.append({"ts": members[0], "value": len(union)})
+    else:
+        values = await _read_counters(redis_client, resolution, metric, buckets)
+        for members in groups:
+            points.append({"ts": members[0], "value": sum(values.get(bucket, 0) for bucket in members)})
+
+    return {
+        "metric": metric,
+        "resolution": resolution,
+        "step_ms": bucket_len * group,
+        "points": points,
+    }
+
+
+async def backfill(redis_client: redis.Redis) -> Dict[str, int]:
+    """
+    從現有訊息與刪除紀錄重建統計（覆蓋現有值）。
+    建議在投影工作已追上時執行；尚未處理的事件之後仍會再被累加一次。
+    """
+    from services import deleted_store, message_store  # 避免循環導入
+
+    async for key in redis_client.scan_iter("rollup:*", count=500):
+        await redis_client.unlink(key)
+
+    messages = 0
+    deleted = 0
+    async for session_id in message_store.iter_session_ids(redis_client):
+        async for batch in message_store.iter_batches(redis_client, session_id):
+            async with redis_client.pipeline(transaction=False) as pipe:
+                queue_events(pipe, [
+                    (int(msg["ts"]), {"session_id": session_id, "sender": msg.get("sender", ""), "deleted": "false"})
+                    for msg in batch
+                ])
+                await pipe.execute()
+            messages += len(batch)
+        async for records in deleted_store.iter_batches(redis_client, session_id):
+            async with redis_client.pipeline(transaction=False) as pipe:
+                queue_events(pipe, [
+                    (int(record["deleted_at"]) * 1000, {"session_id": session_id, "deleted": "true"})
+                    for record in records
+                ])
+                await pipe.execute()
+            deleted += len(records)
+
+    print(f"✅ 全域統計回填完成：{messages} 則訊息，{deleted} 筆刪除紀錄")
+    return {"messages": messages, "deleted": deleted}
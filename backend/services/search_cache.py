@@ -0,0 +1,107 @@
+"""
+搜尋結果快取
+
+- 行程內 LRU（OrderedDict），可設定容量與 TTL
+- 可選的 Redis 層（SEARCH_CACHE_REDIS_ENABLED），讓多個 worker 共用結果
+
+每筆快取都記下產生時的資料版本號（見 services/version_service.py），
+讀取時版本不同即視為失效，因此資料沒變動時重複查詢只需一次版本檢查。
+"""
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+import redis.asyncio as redis
+
+from config import settings
+
+REDIS_KEY_PREFIX = "search_cache:"
+
+
+class SearchResultCache:
+    """以資料版本號驗證的 LRU 快取"""
+
+    def __init__(self, max_size: int, ttl_seconds: int, use_redis: bool = False, key_prefix: str = REDIS_KEY_PREFIX):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.use_redis = use_redis
+        self.key_prefix = key_prefix
+        self._entries: "OrderedDict[str, tuple[int, float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale = 0
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _get_local(self, key: str, version: int) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        entry_version, expires_at, value = entry
+        if entry_version != version or expires_at < time.monotonic():
+            del self._entries[key]
+            self.stale += 1
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def _set_local(self, key: str, version: int, value: Any) -> None:
+        self._entries[key] = (version, time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get(self, redis_client: redis.Redis, key: str, version: int) -> Optional[Any]:
+        value = self._get_local(key, version)
+
+        if value is None and self.use_redis:
+            raw = await redis_client.get(f"{self.key_prefix}{key}")
+            if raw:
+                cached = json.loads(raw)
+                if cached.get("version") == version:
+                    value = cached["value"]
+                    self._set_local(key, version, value)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, redis_client: redis.Redis, key: str, version: int, value: Any) -> None:
+        self._set_local(key, version, value)
+        if self.use_redis:
+            await redis_client.set(
+                f"{self.key_prefix}{key}",
+                json.dumps({"version": version, "value": value}, ensure_ascii=False),
+                ex=self.ttl_seconds,
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "redis_enabled": self.use_redis,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+search_cache = SearchResultCache(
+    max_size=settings.SEARCH_CACHE_SIZE,
+    ttl_seconds=settings.SEARCH_CACHE_TTL_SECONDS,
+    use_redis=settings.SEARCH_CACHE_REDIS_ENABLED,
+)
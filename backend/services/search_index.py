@@ -0,0 +1,105 @@
+"""
+搜尋倒排索引（寫入時維護）
+
+結構：
+- search_idx:term:{term}  Set，成員為 "{ts}:{session_id}"（ts 為毫秒整數，不含冒號，可安全切分）
+
+save / delete / restore 在寫入的同一個 pipeline 中更新索引（刪除會話時由背景回收工作移除），
+查詢時只需對查詢詞的 posting set 取交集，成本取決於命中數量而非資料總量。
+"""
+from typing import Any, Dict, List, Tuple
+import redis.asyncio as redis
+
+from services import message_store
+from utils.tokenizer import tokenize, query_terms
+
+TERM_KEY_PREFIX = "search_idx:term:"
+REBUILD_BATCH_SIZE = 500
+
+
+def term_key(term: str) -> str:
+    return f"{TERM_KEY_PREFIX}{term}"
+
+
+def _posting(session_id: str, ts: Any) -> str:
+    return f"{int(ts)}:{session_id}"
+
+
+def _parse_posting(member: str) -> Tuple[str, int]:
+    ts_str, session_id = member.split(":", 1)
+    return session_id, int(ts_str)
+
+
+def posting_keys(session_id: str, msg_data: Dict[str, Any]) -> Tuple[str, List[str]]:
+    """一則訊息的 posting 成員與索引詞 key（供腳本在同一次執行中寫入索引）"""
+    member = _posting(session_id, msg_data["ts"])
+    return member, [term_key(term) for term in tokenize(str(msg_data.get("content", "")))]
+
+
+def index_message(pipe, session_id: str, msg_data: Dict[str, Any]) -> None:
+    """將一則訊息的索引詞加入 pipeline（不執行）"""
+    if msg_data.get("ts") is None:
+        return
+    member, keys = posting_keys(session_id, msg_data)
+    for key in keys:
+        pipe.sadd(key, member)
+
+
+def unindex_message(pipe, session_id: str, msg_data: Dict[str, Any]) -> None:
+    """將一則訊息的索引詞從 pipeline 中移除（不執行）；空的 Set 會由 Redis 自動刪除"""
+    if msg_data.get("ts") is None:
+        return
+    member = _posting(session_id, msg_data["ts"])
+    for term in tokenize(str(msg_data.get("content", ""))):
+        pipe.srem(term_key(term), member)
+
+
+async def query_postings(redis_client: redis.Redis, query: str) -> List[Tuple[str, int]]:
+    """
+    查詢同時包含所有查詢詞的訊息，回傳 (session_id, ts) 列表。
+    中文以 bigram 取交集，長片段可能出現少量誤判（bigram 皆出現但不相鄰）。
+    """
+    terms = query_terms(query)
+    if not terms:
+        return []
+
+    members = await redis_client.sinter([term_key(t) for t in terms])
+    return [_parse_posting(m) for m in members]
+
+
+async def clear_index(redis_client: redis.Redis) -> int:
+    """刪除所有索引 key"""
+    removed = 0
+    batch: List[str] = []
+    async for key in redis_client.scan_iter(f"{TERM_KEY_PREFIX}*", count=REBUILD_BATCH_SIZE):
+        batch.append(key)
+        if len(batch) >= REBUILD_BATCH_SIZE:
+            removed += await redis_client.unlink(*batch)
+            batch = []
+    if batch:
+        removed += await redis_client.unlink(*batch)
+    return removed
+
+
+async def rebuild_index(redis_client: redis.Redis) -> Dict[str, int]:
+    """
+    從現有的訊息資料（chat_history_ts / chat_history_body）重建索引。
+    先清空舊索引，再逐個會話以 iter_batches 分批讀取，每批一個 pipeline（記憶體與 pipeline 大小固定）。
+    """
+    removed_keys = await clear_index(redis_client)
+    print(f"🧹 已清除 {removed_keys} 個舊索引 key")
+
+    session_count = 0
+    message_count = 0
+
+    async for session_id in message_store.iter_session_ids(redis_client):
+        async for batch in message_store.iter_batches(redis_client, session_id, REBUILD_BATCH_SIZE):
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for msg in batch:
+                    index_message(pipe, session_id, msg)
+                await pipe.execute()
+            message_count += len(batch)
+        session_count += 1
+
+    print(f"✅ 索引重建完成：{session_count} 個會話，{message_count} 則訊息")
+    return {"sessions": session_count, "messages": message_count}
@@ -1,17 +1,36 @@
 """
-全文搜尋相關的服務 (不使用 RediSearch / Redis-OM，直接掃 chat_history)
+全文搜尋相關的服務
+- search_messages：使用寫入時維護的倒排索引（見 services/search_index.py），回傳命中的會話
+- search_message_hits：使用 chatmessage_idx (RediSearch FT.SEARCH)，回傳排序、分頁後的訊息
 """
+import html
 import json
-from typing import List, Dict, Any
+import re
+from typing import List, Dict, Any, Optional
 import redis.asyncio as redis
+from redis.commands.search.query import Query
 
 from database.redis_client import get_redis_client  # 若路由用 Depends，就從這裡拿 client
+from models.chat import ChatMessage
+from services.search_cache import search_cache, SearchResultCache
+from services import message_store
+from services.search_index import query_postings
+from services.deletion_service import filter_deleting
+from services.version_service import get_global_version, get_session_versions
+from services.trending_service import get_trending_keywords
+from utils.tokenizer import normalize_text
+
+# RediSearch 查詢語法中需要跳脫的字元
+_REDISEARCH_SPECIAL_RE = re.compile(r"([,.<>{}\[\]\"':;!@#$%^&*()\-+=~|/\\\s])")
+SNIPPET_WIDTH = 80
+HIGHLIGHT_PRE = "<mark>"
+HIGHLIGHT_POST = "</mark>"
 
 
 async def search_messages(query: str, redis_client: redis.Redis | None = None) -> List[str]:
     """
-    在所有會話訊息中執行簡單全文搜尋，回傳包含關鍵字的 session_id 列表。
-    不使用 ChatMessage.find / RediSearch，只讀 chat_history:*。
+    在所有會話訊息中執行全文搜尋，回傳包含關鍵字的 session_id 列表。
+    查詢詞切分後對倒排索引取交集，不再掃描所有會話的訊息。
     """
     query = (query or "").strip()
     if not query:
@@ -21,71 +40,209 @@ async def search_messages(query: str, redis_client: redis.Redis | None = None) -
     if redis_client is None:
         redis_client = await get_redis_client()  # 如果 get_redis_client 是 async 的
 
-    print(f"🔍 正在執行全文搜索(簡單版): '{query}'")
-
-    matched_sessions: set[str] = set()
-
-    # 掃描所有 chat_history:* key
-    async for key in redis_client.scan_iter("chat_history:*"):
-        # key 形如 "chat_history:fresh1"
-        _, session_id = key.split(":", 1)
-
-        history = await redis_client.lrange(key, 0, -1)
-        for msg in history:
-            try:
-                if isinstance(msg, bytes):
-                    decoded = msg.decode()
-                else:
-                    decoded = msg
-
-                if decoded == "__deleted__":
-                    continue
-
-                data = json.loads(decoded)
-                content = str(data.get("content", ""))
-                if query in content:
-                    matched_sessions.add(session_id)
-                    break  # 這個會話已經命中，直接檢查下一個 session
-            except Exception as e:
-                print(f"⚠️ 解析訊息失敗: {e}")
-                continue
+    version = await get_global_version(redis_client)
+    cache_key = SearchResultCache.make_key("sessions", query)
+    cached = await search_cache.get(redis_client, cache_key, version)
+    if cached is not None:
+        print(f"⚡ 搜尋快取命中: '{query}' (version={version})")
+        return cached
+
+    print(f"🔍 正在執行全文搜索(倒排索引): '{query}'")
+
+    postings = await filter_deleting(redis_client, await query_postings(redis_client, query))
+    matched_sessions = {session_id for session_id, _ in postings}
 
     result = sorted(matched_sessions)
+    await search_cache.set(redis_client, cache_key, version, result)
     print(f"✅ 搜索完成，命中 {len(result)} 個會話: {result}")
     return result
 
 
-async def get_hot_keywords(n: int = 5, redis_client: redis.Redis | None = None) -> Dict[str, Any]:
-    """
-    簡單版熱門關鍵詞：從 chat_history:* 統計出現次數最多的 content 片段。
-    （無分詞，只是示範；之後如果要真的做熱門詞，可以改成對字詞切割）
-    """
-    if redis_client is None:
-        redis_client = await get_redis_client()
+def escape_query(value: str) -> str:
+    """跳脫 RediSearch 查詢語法的特殊字元（全文詞與 TAG 值皆適用）"""
+    return _REDISEARCH_SPECIAL_RE.sub(r"\\\1", value)
+
 
-    from collections import Counter
+def _build_ft_query(
+    query: str,
+    session_id: Optional[str],
+    sender: Optional[str],
+    start_ts: Optional[int],
+    end_ts: Optional[int],
+) -> str:
+    """組合 FT.SEARCH 查詢字串：全文條件 + TAG / NUMERIC 過濾"""
+    words = [escape_query(w) for w in query.split() if w]
+    parts = [f"@content_fts:({' '.join(words)})"]
 
-    counter: Counter[str] = Counter()
+    if session_id:
+        parts.append(f"@session_id:{{{escape_query(session_id)}}}")
+    if sender:
+        parts.append(f"@sender:{{{escape_query(sender)}}}")
+    if start_ts is not None or end_ts is not None:
+        low = start_ts if start_ts is not None else "-inf"
+        high = end_ts if end_ts is not None else "+inf"
+        parts.append(f"@ts:[{low} {high}]")
 
-    async for key in redis_client.scan_iter("chat_history:*"):
-        history = await redis_client.lrange(key, 0, -1)
-        for msg in history:
-            try:
-                if isinstance(msg, bytes):
-                    decoded = msg.decode()
-                else:
-                    decoded = msg
+    return " ".join(parts)
 
-                if decoded == "__deleted__":
-                    continue
 
-                data = json.loads(decoded)
-                content = str(data.get("content", "")).strip()
-                if content:
-                    counter[content] += 1
-            except Exception:
+def _build_snippet(content: str, query: str, width: int = SNIPPET_WIDTH) -> str:
+    """
+    以第一個命中位置為中心擷取片段，並以 <mark> 標示查詢詞。
+    訊息內容先做 HTML 跳脫，只有 <mark> 是標記，前端可以直接當 HTML 顯示。
+    只處理當頁結果，成本與 limit 成正比。
+    """
+    words = [w for w in normalize_text(query).split() if w]
+    if not words:
+        return html.escape(content[:width])
+
+    pattern = re.compile("|".join(re.escape(w) for w in words), re.IGNORECASE)
+    first = pattern.search(content)
+    start = 0 if first is None else max(0, first.start() - width // 4)
+    end = min(len(content), start + width)
+
+    window = content[start:end]
+    parts: List[str] = []
+    pos = 0
+    for match in pattern.finditer(window):
+        parts.append(html.escape(window[pos:match.start()]))
+        parts.append(f"{HIGHLIGHT_PRE}{html.escape(match.group(0))}{HIGHLIGHT_POST}")
+        pos = match.end()
+    parts.append(html.escape(window[pos:]))
+
+    snippet = "".join(parts)
+    if start > 0:
+        snippet = "…" + snippet
+    if end < len(content):
+        snippet = snippet + "…"
+    return snippet
+
+
+async def search_message_hits(
+    query: str,
+    redis_client: redis.Redis,
+    limit: int = 20,
+    offset: int = 0,
+    session_id: Optional[str] = None,
+    sender: Optional[str] = None,
+    start_ts: Optional[int] = None,
+    end_ts: Optional[int] = None,
+    sort: str = "relevance",
+) -> Dict[str, Any]:
+    """
+    在 chatmessage_idx 上執行 FT.SEARCH，回傳排序後的訊息命中與分頁資訊。
+    sort = "relevance"（依相關度）或 "newest"（依 ts 由新到舊）。
+    """
+    query = (query or "").strip()
+    if not query:
+        return {"hits": [], "total": 0, "next_offset": None}
+
+    # 指定會話時只需比對該會話的版本號，其他會話的寫入不會讓快取失效
+    if session_id:
+        version = (await get_session_versions(redis_client, [session_id]))[session_id]
+    else:
+        version = await get_global_version(redis_client)
+    cache_key = SearchResultCache.make_key(
+        "messages", query, limit, offset, session_id, sender, start_ts, end_ts, sort
+    )
+    cached = await search_cache.get(redis_client, cache_key, version)
+    if cached is not None:
+        return cached
+
+    ft_query = (
+        Query(_build_ft_query(query, session_id, sender, start_ts, end_ts))
+        .language("chinese")
+        .with_scores()
+        .return_fields("session_id", "sender", "content", "ts")
+        .paging(offset, limit)
+        .dialect(2)
+    )
+    if sort == "newest":
+        ft_query = ft_query.sort_by("ts", asc=False)
+
+    print(f"🔍 FT.SEARCH {ChatMessage.Meta.index_name}: {ft_query.query_string()} (offset={offset}, limit={limit})")
+    index = redis_client.ft(ChatMessage.Meta.index_name)
+
+    # 背景回收中的會話：ORM 文件可能尚未刪除，依刪除時間過濾。
+    # 被過濾掉的文件由後面的文件補上；每次只取還缺的數量，position 恰好停在最後一個處理過的文件之後，
+    # 下一頁從 position 開始，命中不會被跳過或重複
+    hits: List[Dict[str, Any]] = []
+    position = offset
+    total = 0
+    exhausted = False
+    while len(hits) < limit:
+        result = await index.search(ft_query.paging(position, limit - len(hits)))
+        total = result.total
+        visible = set(await filter_deleting(
+            redis_client, [(getattr(doc, "session_id", ""), int(getattr(doc, "ts", 0))) for doc in result.docs]
+        ))
+        for doc in result.docs:
+            if (getattr(doc, "session_id", ""), int(getattr(doc, "ts", 0))) not in visible:
                 continue
+            content = getattr(doc, "content", "")
+            hits.append(
+                {
+                    "session_id": getattr(doc, "session_id", ""),
+                    "sender": getattr(doc, "sender", ""),
+                    "ts": int(getattr(doc, "ts", 0)),
+                    "score": float(doc.score) if doc.score is not None else None,
+                    "snippet": _build_snippet(content, query),
+                }
+            )
+        position += len(result.docs)
+        if not result.docs or position >= total:
+            exhausted = True
+            break
+
+    # total 為 FT.SEARCH 的命中數（含尚未回收完的已刪除會話文件）
+    response = {
+        "hits": hits,
+        "total": total,
+        "next_offset": None if exhausted else position,
+    }
+    await search_cache.set(redis_client, cache_key, version, response)
+    return response
+
+
+async def rebuild_message_documents(redis_client: redis.Redis) -> Dict[str, int]:
+    """
+    以訊息儲存結構為準重建 chatmessage_idx 的 ORM hash：
+    清除舊的（隨機主鍵、可能包含已刪除訊息的）:chat_msg:* 文件，改以固定主鍵重新寫入。
+    """
+    removed = 0
+    batch: List[str] = []
+    async for key in redis_client.scan_iter(ChatMessage.make_key("*"), count=500):
+        batch.append(key)
+        if len(batch) >= 500:
+            removed += await redis_client.unlink(*batch)
+            batch = []
+    if batch:
+        removed += await redis_client.unlink(*batch)
+
+    written = 0
+    async for session_id in message_store.iter_session_ids(redis_client):
+        messages = await message_store.fetch_all(redis_client, session_id)
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for data in messages:
+                message_store.store_document(pipe, session_id, data)
+                written += 1
+            await pipe.execute()
+
+    print(f"✅ 訊息文件重建完成：移除 {removed} 筆舊文件，寫入 {written} 筆")
+    return {"removed": removed, "written": written}
+
+
+async def get_hot_keywords(
+    n: int = 5,
+    redis_client: redis.Redis | None = None,
+    window: str = "day",
+) -> Dict[str, Any]:
+    """
+    熱門關鍵詞：讀取寫入時累加的時間桶（見 services/trending_service.py），
+    回傳指定視窗（hour / day / week）內出現次數最多的關鍵詞。
+    """
+    if redis_client is None:
+        redis_client = await get_redis_client()
 
-    most_common = counter.most_common(n)
-    keywords = [{"keyword": k, "count": v} for k, v in most_common]
-    return {"keywords": keywords}
+    keywords = await get_trending_keywords(redis_client, n=n, window=window)
+    return {"window": window, "keywords": keywords}
@@ -0,0 +1,290 @@
+"""
+會話索引（側邊欄列表用）
+
+- :chatsession:{session_id}   ChatSession hash（主鍵固定為 session_id，可直接定位，不需要掃描）；
+                              message_count / last_activity / preview / last_sender 由寫入腳本原子地維護
+- session_index:created       Sorted Set，member = session_id，score = 建立時間（毫秒）
+- session_index:activity      Sorted Set，member = session_id，score = 最後一則訊息的 ts
+
+create_session / delete_session 在同一個 pipeline 中維護索引，最後活動時間由訊息寫入腳本更新；
+列表以 ZREVRANGEBYSCORE 取一頁 id（游標為 (score, session_id)），再一次 pipeline HGETALL，成本只與頁面大小有關。
+
+舊資料（ULID 主鍵的 ChatSession）以 python manage.py rebuild-session-index 轉換。
+"""
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import redis.asyncio as redis
+
+from config import settings
+from models.session import ChatSession
+from services.version_service import GLOBAL_VERSION_KEY
+
+ACTIVE_SESSIONS_KEY = "active_sessions"
+ORDER_KEYS = {
+    "created": "session_index:created",
+    "activity": "session_index:activity",
+}
+REBUILD_BATCH_SIZE = 500
+
+
+def session_key(session_id: str) -> str:
+    return ChatSession.make_primary_key(session_id)
+
+
+def to_ms(created_at: Any) -> int:
+    if isinstance(created_at, datetime):
+        return int(created_at.timestamp() * 1000)
+    try:
+        return int(datetime.fromisoformat(str(created_at)).timestamp() * 1000)
+    except ValueError:
+        return 0
+
+
+def add_session(pipe, session_obj: ChatSession) -> None:
+    """寫入 ChatSession hash 並加入索引（與 HashModel.save 相同的欄位格式；加入 pipeline，不執行）"""
+    document = {k: v for k, v in session_obj.dict().items() if v is not None}
+    for field, value in document.items():
+        if isinstance(value, datetime):
+            document[field] = value.isoformat()
+    created_ms = to_ms(session_obj.created_at)
+
+    pipe.sadd(ACTIVE_SESSIONS_KEY, session_obj.session_id)
+    pipe.hset(session_key(session_obj.session_id), mapping=document)
+    index_session(pipe, session_obj.session_id, created_ms)
+
+
+def index_session(pipe, session_id: str, created_ms: int, nx: bool = False) -> None:
+    """
+    將會話加入兩個排序索引（加入 pipeline，不執行）。
+    nx=True 時不覆蓋既有的分數（匯入時先寫入 session_meta，再補上沒有 meta 的會話）。
+    """
+    for key in ORDER_KEYS.values():
+        pipe.zadd(key, {session_id: int(created_ms)}, nx=nx)
+
+
+def touch_session(pipe, session_id: str, ts: Any) -> None:
+    """更新最後活動時間（只更新已在索引中的會話，且只往後移；加入 pipeline，不執行）"""
+    pipe.zadd(ORDER_KEYS["activity"], {session_id: int(ts)}, xx=True, gt=True)
+
+
+def remove_session(pipe, session_id: str) -> None:
+    """移除會話 hash 與索引（加入 pipeline，不執行）"""
+    pipe.srem(ACTIVE_SESSIONS_KEY, session_id)
+    pipe.unlink(session_key(session_id))
+    for key in ORDER_KEYS.values():
+        pipe.zrem(key, session_id)
+
+
+def clip_preview(text: str, limit: int) -> str:
+    """以 UTF-8 bytes 截斷並退回到字元邊界（與腳本中的 clip 相同）"""
+    return text.encode("utf-8")[:limit].decode("utf-8", "ignore")
+
+
+def summarize(session_id: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "session_id": session_id,
+        "title": data.get("title", "新對話"),
+        "created_at": data.get("created_at"),
+        "message_count": int(data.get("message_count", 0)),
+        "last_activity": int(data.get("last_activity", 0)) or None,
+        "preview": data.get("preview", ""),
+        "last_sender": data.get("last_sender", ""),
+    }
+
+
+async def get_summary(redis_client: redis.Redis, session_id: str) -> Optional[Dict[str, Any]]:
+    """單一會話的摘要（一次 HGETALL）；會話不存在時回傳 None"""
+    data = await redis_client.hgetall(session_key(session_id))
+    if not data:
+        return None
+    return summarize(session_id, data)
+
+
+def _parse_cursor(cursor: str) -> Tuple[float, Optional[str]]:
+    """游標 "{score}:{session_id}"；只有分數（舊格式）時略過所有同分的會話"""
+    score, _, session_id = str(cursor).partition(":")
+    return float(score), session_id or None
+
+
+async def list_sessions(
+    redis_client: redis.Redis,
+    limit: int,
+    cursor: Optional[str] = None,
+    order: str = "created",
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    依建立時間或最後活動時間（新到舊）取出一頁會話，回傳 (會話列表, 下一頁游標)。
+    游標為上一頁最後一筆的 "{score}:{session_id}"，沒有更多資料時為 None。
+    同分的會話（同一毫秒建立、匯入等）依 session_id 由大到小排列（ZREVRANGEBYSCORE 的順序），
+    下一頁從游標的分數（含）開始，略過排在游標那筆之前（含）的同分會話，不會漏掉或重複。
+    """
+    key = ORDER_KEYS[order]
+    cursor_score, cursor_id = _parse_cursor(cursor) if cursor is not None else (None, None)
+    high = "+inf" if cursor_score is None else repr(cursor_score)
+
+    rows: List[Tuple[str, float]] = []
+    offset = 0
+    while len(rows) <= limit:
+        page = await redis_client.zrevrangebyscore(key, high, "-inf", start=offset, num=limit + 1, withscores=True)
+        for session_id, score in page:
+            if score == cursor_score and (cursor_id is None or session_id >= cursor_id):
+                continue
+            rows.append((session_id, score))
+        if len(page) < limit + 1:
+            break
+        offset += len(page)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not rows:
+        return [], None
+
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for session_id, _ in rows:
+            pipe.hgetall(session_key(session_id))
+        hashes = await pipe.execute()
+
+    sessions = [summarize(session_id, data or {}) for (session_id, _), data in zip(rows, hashes)]
+    last_id, last_score = rows[-1]
+    next_cursor = f"{int(last_score)}:{last_id}" if has_more else None
+    return sessions, next_cursor
+
+
+def _summary_fields(count: int, latest: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """由訊息數與最新一則訊息算出會話摘要欄位（與寫入腳本維護的值相同）"""
+    if not latest:
+        return {"message_count": count, "last_activity": 0, "preview": "", "last_sender": ""}
+    return {
+        "message_count": count,
+        "last_activity": int(latest["ts"]),
+        "preview": clip_preview(str(latest.get("content", "")), settings.SESSION_PREVIEW_BYTES),
+        "last_sender": latest.get("sender", ""),
+    }
+
+
+async def _fetch_latest(redis_client: redis.Redis, latest_ts: Dict[str, int]) -> Dict[str, Dict[str, Any]]:
+    """以一次 pipeline 取回各會話最新一則訊息（session_id -> 訊息；讀不到或無法解碼的略過）"""
+    from services import message_store  # 避免循環導入（message_store 寫入時需要本模組的 key）
+
+    items = list(latest_ts.items())
+    if not items:
+        return {}
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for session_id, ts in items:
+            pipe.hget(message_store.body_key(session_id), str(int(ts)))
+        raw_bodies = await pipe.execute()
+
+    latest: Dict[str, Dict[str, Any]] = {}
+    for (session_id, _), raw in zip(items, raw_bodies):
+        try:
+            msg = message_store.decode_message(raw) if raw else None
+        except Exception as e:
+            print(f"WARNING: Failed to decode latest message of {session_id}: {e}")
+            msg = None
+        if msg:
+            latest[session_id] = msg
+    return latest
+
+
+async def refresh_summaries(redis_client: redis.Redis, session_ids: Iterable[str]) -> int:
+    """
+    依訊息資料重新計算指定會話的摘要欄位與最後活動時間（匯入等繞過寫入腳本的寫入之後使用）。
+    每 REBUILD_BATCH_SIZE 個會話三次往返（統計、最新訊息、寫入）；會話 hash 不存在的會話略過，回傳更新的會話數。
+    """
+    from services import message_store  # 避免循環導入（message_store 寫入時需要本模組的 key）
+
+    session_ids = list(session_ids)
+    refreshed = 0
+    for start in range(0, len(session_ids), REBUILD_BATCH_SIZE):
+        batch = session_ids[start:start + REBUILD_BATCH_SIZE]
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for session_id in batch:
+                pipe.exists(session_key(session_id))
+                pipe.zcard(message_store.order_key(session_id))
+                pipe.zrevrange(message_store.order_key(session_id), 0, 0)
+                pipe.zscore(ORDER_KEYS["created"], session_id)
+            stats = await pipe.execute()
+
+        rows = [(session_id, *stats[4 * i:4 * i + 4]) for i, session_id in enumerate(batch)]
+        latest = await _fetch_latest(redis_client, {row[0]: int(row[3][0]) for row in rows if row[1] and row[3]})
+
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for session_id, has_hash, count, _, created_ms in rows:
+                if not has_hash:
+                    continue
+                summary = _summary_fields(count, latest.get(session_id))
+                pipe.hset(session_key(session_id), mapping=summary)
+                activity = max(int(created_ms or 0), summary["last_activity"])
+                pipe.zadd(ORDER_KEYS["activity"], {session_id: activity}, xx=True)
+                refreshed += 1
+            await pipe.execute()
+    return refreshed
+
+
+async def rebuild_index(redis_client: redis.Redis) -> Dict[str, int]:
+    """
+    由 active_sessions 與現有 ChatSession hash 重建索引：
+    ULID 主鍵的 hash 改存到 :chatsession:{session_id}，最後活動時間取最後一則訊息的 ts，
+    並回填 message_count / last_activity / preview / last_sender。
+    不在 active_sessions 中的舊 hash 不會被加入索引。
+    """
+    from services import message_store  # 避免循環導入（message_store 寫入時需要本模組的 key）
+
+    active = set(await redis_client.smembers(ACTIVE_SESSIONS_KEY))
+    created: Dict[str, int] = {}
+    moved = 0
+
+    async for key in redis_client.scan_iter(ChatSession.make_key("*"), count=REBUILD_BATCH_SIZE):
+        data = await redis_client.hgetall(key)
+        session_id = data.get("session_id")
+        if not session_id or session_id not in active:
+            continue
+        created[session_id] = to_ms(data.get("created_at"))
+        if key != session_key(session_id):
+            data["pk"] = session_id
+            async with redis_client.pipeline() as pipe:
+                pipe.hset(session_key(session_id), mapping=data)
+                pipe.unlink(key)
+                await pipe.execute()
+            moved += 1
+
+    # 每 REBUILD_BATCH_SIZE 個會話一批：統計、最新訊息、寫入各一次往返，記憶體與 pipeline 大小固定
+    active_list = list(active)
+    for start in range(0, len(active_list), REBUILD_BATCH_SIZE):
+        batch = active_list[start:start + REBUILD_BATCH_SIZE]
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for session_id in batch:
+                pipe.zcard(message_store.order_key(session_id))
+                pipe.zrevrange(message_store.order_key(session_id), 0, 0, withscores=True)
+                pipe.exists(session_key(session_id))
+            stats = await pipe.execute()
+
+        rows = [(session_id, *stats[3 * i:3 * i + 3]) for i, session_id in enumerate(batch)]
+        latest = await _fetch_latest(
+            redis_client, {session_id: int(last[0][1]) for session_id, _, last, has_hash in rows if last and has_hash}
+        )
+
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for session_id, count, last, has_hash in rows:
+                created_ms = created.get(session_id, 0)
+                last_ts = int(last[0][1]) if last else created_ms
+                pipe.zadd(ORDER_KEYS["created"], {session_id: created_ms})
+                pipe.zadd(ORDER_KEYS["activity"], {session_id: max(created_ms, last_ts)})
+
+                # 補上摘要欄位（舊資料從未更新 message_count，也沒有 last_activity / preview）
+                if has_hash:
+                    pipe.hset(session_key(session_id), mapping=_summary_fields(count, latest.get(session_id)))
+            await pipe.execute()
+
+    # 索引是就地覆寫（重建期間列表不會變空），最後移除不在 active_sessions 中的成員
+    for key in ORDER_KEYS.values():
+        stale: List[str] = []
+        async for session_id, _ in redis_client.zscan_iter(key, count=REBUILD_BATCH_SIZE):
+            if session_id not in active:
+                stale.append(session_id)
+        for start in range(0, len(stale), REBUILD_BATCH_SIZE):
+            await redis_client.zrem(key, *stale[start:start + REBUILD_BATCH_SIZE])
+    await redis_client.incr(GLOBAL_VERSION_KEY)  # 讓會話列表的 ETag / 回應快取失效
+
+    print(f"✅ 會話索引重建完成：{len(active)} 個會話，{moved} 筆 ChatSession 改為以 session_id 為主鍵")
+    return {"sessions": len(active), "moved": moved}
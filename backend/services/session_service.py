@@ -6,7 +6,7 @@ import asyncio
 import redis.asyncio as redis
 from datetime import datetime
 # === 關鍵修正：確保導入 Optional, Dict, Any, Awaitable ===
-from typing import List, Dict, Any, Awaitable, Optional 
+from typing import List, Dict, Any, Awaitable, Optional, Tuple
 
 # 導入 Redis-OM 的同步連線
 from database.redis_client import redis_om_conn 
@@ -17,40 +17,33 @@ from models.chat import ChatMessage
 from models.session import ChatSession 
 # 假設 save_message 是一個異步函數
 from services.message_service import save_message
+from services import session_index
+from services.deletion_service import start_deletion
+from config import settings
 
 # 將同步客戶端綁定給 Redis-OM 模型
 ChatSession.Meta.database = redis_om_conn
 from database.redis_client import redis_om_conn
 
-async def get_all_sessions(redis_client: redis.Redis) -> List[Dict[str, Any]]:
+async def get_all_sessions(
+    redis_client: redis.Redis,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    order: str = "created",
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
     """
-    暫時版本：不用 Redis-OM 查詢，只用原生 Redis 讀出 sessions。
-    回傳簡單 dict list 給前端。
+    從會話索引取出一頁會話（新到舊），回傳 (簡單 dict list, 下一頁游標)。
+    只需要一次 ZREVRANGEBYSCORE + 一次 pipeline HGETALL，不再掃描 :chatsession:*。
     """
-    session_ids = await redis_client.smembers("active_sessions")
-    print("DEBUG active_sessions:", session_ids)
-    results: List[Dict[str, Any]] = []
-    for sid in session_ids:
-    # 掃描所有 chatsession:*，找出 session_id = sid 的那一筆
-        for key in redis_om_conn.scan_iter(":chatsession:*"):
-            data = redis_om_conn.hgetall(key)
-            print("DEBUG chatsession key/data:", key, data)
-            if not data:
-                continue
-            if data.get("session_id") == sid:
-                results.append(
-                    {
-                        "session_id": data.get("session_id"),
-                        "title": data.get("title", "新對話"),
-                        "created_at": data.get("created_at"),
-                        "message_count": int(data.get("message_count", 0)),
-                    }
-                )
-                break
+    limit = settings.SESSION_PAGE_SIZE if limit is None else limit
+    sessions, next_cursor = await session_index.list_sessions(redis_client, limit, cursor=cursor, order=order)
+    print(f"DEBUG sessions page: {len(sessions)} sessions, next_cursor={next_cursor}")
+    return sessions, next_cursor
 
-    # 依 created_at 排序（字串排序先不管時區，重點是前端有資料）
-    results.sort(key=lambda s: s.get("created_at", ""), reverse=True)
-    return results
+
+async def get_session_summary(redis_client: redis.Redis, session_id: str) -> Optional[Dict[str, Any]]:
+    """會話摘要：標題、建立時間、訊息數、最後活動時間與最後一則訊息預覽（不讀取訊息列表）"""
+    return await session_index.get_summary(redis_client, session_id)
 
 
 # def _sort_sessions(sessions: List[ChatSession]) -> List[ChatSession]:
@@ -80,22 +73,22 @@ async def get_all_sessions(redis_client: redis.Redis) -> List[Dict[str, Any]]:
     
 #     return sessions
 
-async def create_session(redis_client: redis.Redis, session_id: str):
-    """創建新會話"""
+async def create_session(redis_client: redis.Redis, session_id: str, user_id: Optional[str] = None):
+    """創建新會話（user_id 用於不重複活躍使用者統計）"""
     print(f"INFO: Creating new session: {session_id}")
 
-    # 1. 將 session ID 加入活動會話 Set
-    await redis_client.sadd("active_sessions", session_id)
-    
     session_obj = ChatSession(
-    session_id=session_id,
-    created_at=datetime.utcnow(), # 不要用 int(time.time())
+        pk=session_id,  # 主鍵固定為 session_id，讀取時可直接定位
+        session_id=session_id,
+        created_at=datetime.utcnow(), # 不要用 int(time.time())
+        user_id=user_id,
     )
 
-
-    #由於 Redis-OM 的 save 是同步的，使用 asyncio.to_thread
-    await asyncio.to_thread(session_obj.save)
-    print(f"INFO: ChatSession object saved via Redis-OM (PK: {session_obj.pk}).")
+    # 1. 寫入 ChatSession hash、加入 active_sessions 與會話索引（同一個 pipeline）
+    async with redis_client.pipeline() as pipe:
+        session_index.add_session(pipe, session_obj)
+        await pipe.execute()
+    print(f"INFO: ChatSession saved and indexed (PK: {session_obj.pk}).")
     
     # 2. 準備 AI 歡迎訊息
     ai_welcome_message: Dict[str, Any] = {
@@ -105,50 +98,21 @@ async def create_session(redis_client: redis.Redis, session_id: str):
         "ts": int(time.time() * 1000) # 使用毫秒時間戳
     }
     
-    # 3. 儲存訊息
+    # 3. 儲存訊息（save_message 會一併記錄到 Stream）
     # 關鍵修正: 必須將 redis_client 傳遞給 save_message
     await save_message(redis_client, session_id, ai_welcome_message) 
     
-    # 4. 記錄到 Stream
-    await redis_client.xadd("chat_stream", fields={
-        "session_id": ai_welcome_message["session_id"],
-        "sender": ai_welcome_message["sender"],
-        "content": ai_welcome_message["content"],
-        "ts": str(ai_welcome_message["ts"]),
-        "deleted": "false"
-    })
-    
     print(f"INFO: Session '{session_id}' created with welcome message.")
 
-def _find_and_delete_pks(session_id: str):
-    """同步地查找並刪除 ChatMessage，供 asyncio.to_thread 使用"""
-    from redis_om import NotFoundError # 在這裡局部導入，避免循環依賴
-    try:
-        msgs = ChatMessage.find(ChatMessage.session_id == session_id).all()
-        pk_list = [m.pk for m in msgs]
-        for pk in pk_list:
-            ChatMessage.delete(pk)
-        return len(pk_list)
-    except NotFoundError:
-        return 0
-    except Exception as e:
-        print(f"ERROR during message cleanup for session {session_id}: {e}")
-        return 0
-
-async def delete_session(redis_client: redis.Redis, session_id: str) -> bool:
-    """刪除會話及其所有訊息"""
-    removed = await redis_client.srem("active_sessions", session_id)
-    
-    if not removed:
+async def delete_session(redis_client: redis.Redis, session_id: str) -> Optional[str]:
+    """
+    刪除會話：立即從列表移除並把資料移到墓碑 key，實際回收交給背景工作（見 services/deletion_service.py）。
+    回傳回收工作的 job_id；會話不存在時回傳 None。
+    """
+    job_id = await start_deletion(redis_client, session_id)
+    if job_id is None:
         print(f"WARNING: Session '{session_id}' not found.")
-        return False
-    
-    # 將同步的刪除操作放入單獨的線程中運行
-    deleted_count = await asyncio.to_thread(_find_and_delete_pks, session_id)
-    
-    # 清理非 Redis-OM 結構 (異步操作)
-    await redis_client.delete(f"chat_history:{session_id}")
-    await redis_client.delete(f"deleted_history:{session_id}")
-    
-    print(f"INFO: Session '{session_id}' deleted with {deleted_count} messages.")
-    return True
\ No newline at end of file
+        return None
+
+    print(f"INFO: Session '{session_id}' deleted (reclaim job {job_id}).")
+    return job_id
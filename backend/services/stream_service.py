@@ -0,0 +1,216 @@
+"""
+訊息事件流（chat_stream）
+
+每次儲存 / 刪除 / 復原都會在寫入腳本中 XADD 一筆事件（欄位：session_id, sender, content, ts, deleted）。
+
+- 分區（STREAM_PARTITION）：
+  none     chat_stream
+  session  chat_stream:{session_id}
+  day      chat_stream:{YYYY-MM-DD}（UTC，依訊息 ts / 事件時間）
+  所有用過的分區記錄在 chat_stream_partitions（Set），供讀取端與消費者發現。
+- 條目 ID：儲存事件使用 "{ts}-*"（Redis 7+），時間範圍查詢可直接 XRANGE {start_ts} {end_ts}；
+  ts 比串流最後一筆還舊或伺服器不支援時，腳本退回 "*"。刪除 / 復原事件使用事件時間（"*"）。
+- 保留（每次 XADD 時近似修剪）：
+  STREAM_RETENTION_SECONDS > 0  以 MINID ~ (現在 - 保留時間) 修剪，分區 key 另設 PEXPIREAT
+  否則 STREAM_MAXLEN > 0        以 MAXLEN ~ STREAM_MAXLEN 修剪
+
+既有的單一 chat_stream 以 python manage.py split-stream 依目前設定分區。
+"""
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+import redis.asyncio as redis
+
+from config import settings
+
+STREAM_KEY = "chat_stream"
+PARTITIONS_KEY = "chat_stream_partitions"
+SPLIT_PROGRESS_KEY = "chat_stream_split"
+DAY_MS = 24 * 3600 * 1000
+SPLIT_BATCH_SIZE = 1000
+
+
+def _day(ts_ms: int) -> str:
+    return datetime.fromtimestamp(ts_ms / 1000.0, tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+def stream_key(session_id: str, ts_ms: Any) -> str:
+    """事件所屬的串流 key（依 STREAM_PARTITION）"""
+    partition = settings.STREAM_PARTITION
+    if partition == "session":
+        return f"{STREAM_KEY}:{session_id}"
+    if partition == "day":
+        return f"{STREAM_KEY}:{_day(int(ts_ms))}"
+    return STREAM_KEY
+
+
+def _trim(now_ms: int) -> Tuple[str, str]:
+    if settings.STREAM_RETENTION_SECONDS > 0:
+        return "MINID", str(max(0, now_ms - settings.STREAM_RETENTION_SECONDS * 1000))
+    if settings.STREAM_MAXLEN > 0:
+        return "MAXLEN", str(settings.STREAM_MAXLEN)
+    return "", ""
+
+
+def _expire_at(ts_ms: int, now_ms: int) -> str:
+    """分區 key 的到期時間：day 分區在該日結束後保留期滿，session 分區自最後寫入起算"""
+    if settings.STREAM_RETENTION_SECONDS <= 0:
+        return ""
+    retention_ms = settings.STREAM_RETENTION_SECONDS * 1000
+    if settings.STREAM_PARTITION == "day":
+        return str((ts_ms // DAY_MS + 1) * DAY_MS + retention_ms)
+    if settings.STREAM_PARTITION == "session":
+        return str(now_ms + retention_ms)
+    return ""
+
+
+def event_args(ts_ms: Optional[Any] = None) -> List[str]:
+    """
+    寫入腳本的串流 ARGV：[id_ms, trim_strategy, trim_threshold, expire_at]。
+    ts_ms 為 None（刪除 / 復原事件）時 id_ms 為空字串，由 Redis 以目前時間產生 ID。
+    """
+    now_ms = int(time.time() * 1000)
+    strategy, threshold = _trim(now_ms)
+    base_ms = now_ms if ts_ms is None else int(ts_ms)
+    return ["" if ts_ms is None else str(int(ts_ms)), strategy, threshold, _expire_at(base_ms, now_ms)]
+
+
+def _window_keys(start_ms: int, end_ms: int, session_id: Optional[str]) -> List[str]:
+    partition = settings.STREAM_PARTITION
+    if partition == "session" and session_id:
+        return [stream_key(session_id, start_ms)]
+    if partition == "day":
+        first, last = start_ms // DAY_MS, end_ms // DAY_MS
+        return [f"{STREAM_KEY}:{_day(day * DAY_MS)}" for day in range(first, last + 1)]
+    if partition == "session":
+        return []  # 未指定會話時由呼叫端改用 partitions 列表
+    return [STREAM_KEY]
+
+
+async def read_window(
+    redis_client: redis.Redis,
+    start_ms: int,
+    end_ms: int,
+    session_id: Optional[str] = None,
+    count: int = 1000,
+) -> List[Dict[str, Any]]:
+    """
+    以 XRANGE 切出 [start_ms, end_ms] 的事件（最多 count 筆，依 ID 排序）。
+    儲存事件的 ID 即訊息 ts，因此這是直接的範圍切片，不需要掃描整個串流。
+    """
+    keys = _window_keys(start_ms, end_ms, session_id)
+    if not keys and settings.STREAM_PARTITION == "session":
+        keys = sorted(await redis_client.smembers(PARTITIONS_KEY))
+
+    events: List[Dict[str, Any]] = []
+    for key in keys:
+        # 分區不只一個會話時 XRANGE 的 count 在過濾之前：分頁讀取直到湊滿 count 筆或讀完範圍
+        matched = 0
+        start: Any = start_ms
+        while matched < count:
+            entries = await redis_client.xrange(key, start, end_ms, count=count)
+            for entry_id, fields in entries:
+                if session_id and fields.get("session_id") != session_id:
+                    continue
+                events.append({"id": entry_id, "stream": key, **fields})
+                matched += 1
+            if len(entries) < count:
+                break
+            start = f"({entries[-1][0]}"
+
+    events.sort(key=lambda e: tuple(int(p) for p in e["id"].split("-")))
+    return events[:count]
+
+
+def _parse_id(entry_id: str) -> Tuple[int, int]:
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+async def _last_generated_id(redis_client: redis.Redis, key: str) -> Tuple[int, int]:
+    """串流最後產生的 ID（包含已刪除 / 修剪的條目）；串流不存在時為 (0, 0)"""
+    if not await redis_client.exists(key):
+        return 0, 0
+    info = await redis_client.xinfo_stream(key)
+    return _parse_id(info["last-generated-id"])
+
+
+async def split_stream(redis_client: redis.Redis, keep_source: bool = False) -> Dict[str, int]:
+    """
+    依目前的 STREAM_PARTITION 把舊的單一 chat_stream 拆到分區串流：
+    儲存事件的 ID 改為訊息 ts，其他事件沿用原本的時間；為維持單調遞增，
+    若比目標串流最後一筆還舊則改用該筆的時間（ID 以 "{ms}-{seq}" 明確指定，不需要 Redis 7）。
+    完成後套用保留設定並刪除來源（keep_source=True 時保留）。
+
+    可重複執行：每批的 XADD 與進度（chat_stream_split，最後處理的來源 ID）放在同一個 MULTI 中，
+    中斷後重新執行會從進度之後繼續；新 ID 一律排在目標串流最後產生的 ID 之後，
+    分區中已有即時寫入（或搬移期間寫入）時接在其後，不會因 ID 過小而失敗。
+    """
+    if settings.STREAM_PARTITION == "none":
+        strategy, threshold = _trim(int(time.time() * 1000))
+        trimmed = 0
+        if strategy:
+            trimmed = await redis_client.execute_command("XTRIM", STREAM_KEY, strategy, "~", threshold)
+        print(f"✅ 未啟用分區，只套用保留設定：修剪 {trimmed} 筆")
+        return {"moved": 0, "trimmed": trimmed}
+
+    last_ids: Dict[str, Tuple[int, int]] = {}
+    moved = 0
+    progress = await redis_client.get(SPLIT_PROGRESS_KEY)
+    start = f"({progress}" if progress else "-"
+    if progress:
+        print(f"   ↩️ 從上次的進度 {progress} 之後繼續")
+
+    while True:
+        entries = await redis_client.xrange(STREAM_KEY, start, "+", count=SPLIT_BATCH_SIZE)
+        if not entries:
+            break
+
+        batch: List[Tuple[str, Dict[str, Any]]] = []
+        async with redis_client.pipeline() as pipe:
+            for entry_id, fields in entries:
+                original_ms = _parse_id(entry_id)[0]
+                is_save = fields.get("deleted") != "true" and str(fields.get("ts", "")).isdigit()
+                desired_ms = int(fields["ts"]) if is_save else original_ms
+                key = stream_key(fields.get("session_id", ""), desired_ms)
+                if key not in last_ids:
+                    last_ids[key] = await _last_generated_id(redis_client, key)
+                last = last_ids[key]
+                new_id = (desired_ms, 0) if desired_ms > last[0] else (last[0], last[1] + 1)
+                last_ids[key] = new_id
+                pipe.xadd(key, fields, id=f"{new_id[0]}-{new_id[1]}")
+                batch.append((key, fields))
+            pipe.set(SPLIT_PROGRESS_KEY, entries[-1][0])
+            results = await pipe.execute(raise_on_error=False)
+
+        for (key, fields), result in zip(batch, results):
+            if not isinstance(result, Exception):
+                continue
+            if "equal or smaller" not in str(result):
+                raise result
+            # 讀取最後 ID 之後有即時寫入：接在目標串流最後一筆之後
+            last_ms, last_seq = await _last_generated_id(redis_client, key)
+            await redis_client.xadd(key, fields, id=f"{last_ms}-{last_seq + 1}")
+            last_ids[key] = (last_ms, last_seq + 1)
+
+        moved += len(entries)
+        start = f"({entries[-1][0]}"
+        print(f"   📦 已搬移 {moved} 筆事件")
+
+    now_ms = int(time.time() * 1000)
+    strategy, threshold = _trim(now_ms)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for key, (latest, _) in last_ids.items():
+            pipe.sadd(PARTITIONS_KEY, key)
+            if strategy:
+                pipe.execute_command("XTRIM", key, strategy, "~", threshold)
+            expire_at = _expire_at(latest, now_ms)
+            if expire_at:
+                pipe.pexpireat(key, int(expire_at))
+        if not keep_source:
+            # 保留來源時也保留進度，重新執行不會重複搬移
+            pipe.unlink(STREAM_KEY, SPLIT_PROGRESS_KEY)
+        await pipe.execute()
+
+    print(f"✅ chat_stream 分區完成：{moved} 筆事件，{len(last_ids)} 個分區（partition={settings.STREAM_PARTITION}）")
+    return {"moved": moved, "partitions": len(last_ids)}
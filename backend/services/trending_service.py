@@ -0,0 +1,98 @@
+"""
+熱門關鍵詞（串流式統計）
+
+儲存訊息時切出關鍵詞，累加到「時間桶」Sorted Set：
+- trending:hour:{epoch_hour}  每小時一桶（保留 26 小時）
+- trending:day:{epoch_day}    每天一桶（保留 8 天）
+
+每個桶最多保留 TRENDING_BUCKET_CAPACITY 個詞（超過兩倍時修剪低頻詞，見 track_keywords 腳本），
+記憶體用量與流量無關；查詢時只合併固定數量的桶（滑動視窗），成本為常數。
+"""
+import time
+from typing import Any, Dict, List, Optional
+import redis.asyncio as redis
+
+from config import settings
+from database.scripts import queue_script
+from utils.tokenizer import extract_keywords
+
+HOUR_SECONDS = 3600
+DAY_SECONDS = 24 * HOUR_SECONDS
+
+# 視窗名稱 -> (桶粒度, 完整桶數, 桶秒數)
+WINDOWS = {
+    "hour": ("hour", 1, HOUR_SECONDS),
+    "day": ("hour", 24, HOUR_SECONDS),
+    "week": ("day", 7, DAY_SECONDS),
+}
+BUCKET_TTL = {
+    "hour": 26 * HOUR_SECONDS,
+    "day": 8 * DAY_SECONDS,
+}
+
+
+def _bucket_key(granularity: str, bucket: int) -> str:
+    return f"trending:{granularity}:{bucket}"
+
+
+def record_keywords(pipe, msg_data: Dict[str, Any], now: Optional[float] = None) -> None:
+    """
+    將訊息關鍵詞累加到目前的小時桶與日桶（加入 pipeline，不執行）。
+    只統計使用者訊息（sender=me），避免 AI 長回覆與歡迎訊息淹沒真正的熱門詞。
+    """
+    if str(msg_data.get("sender", "")).lower() != "me":
+        return
+
+    keywords = extract_keywords(str(msg_data.get("content", "")))
+    if not keywords:
+        return
+
+    now = time.time() if now is None else now
+    keys = [
+        _bucket_key("hour", int(now // HOUR_SECONDS)),
+        _bucket_key("day", int(now // DAY_SECONDS)),
+    ]
+    args = [settings.TRENDING_BUCKET_CAPACITY, BUCKET_TTL["hour"], BUCKET_TTL["day"], *keywords]
+    queue_script(pipe, "track_keywords", keys=keys, args=args)
+
+
+def _window_weights(window: str, now: float) -> Dict[str, float]:
+    """
+    滑動視窗：目前桶 + 往前完整桶，再加上一個依經過比例遞減權重的最舊桶。
+    """
+    granularity, count, seconds = WINDOWS[window]
+    current = int(now // seconds)
+    elapsed_fraction = (now % seconds) / seconds
+
+    weights = {_bucket_key(granularity, current - i): 1.0 for i in range(count)}
+    oldest_weight = 1.0 - elapsed_fraction
+    if oldest_weight > 0:
+        weights[_bucket_key(granularity, current - count)] = oldest_weight
+    return weights
+
+
+async def get_trending_keywords(
+    redis_client: redis.Redis,
+    n: int = 10,
+    window: str = "day",
+    now: Optional[float] = None,
+) -> List[Dict[str, Any]]:
+    """
+    回傳指定視窗（hour / day / week）內前 n 個熱門關鍵詞。
+    合併結果快取 TRENDING_WINDOW_CACHE_SECONDS 秒，重複查詢只需一次 ZREVRANGE。
+    """
+    if window not in WINDOWS:
+        raise ValueError(f"Unsupported window: {window}")
+
+    dest = f"trending:window:{window}"
+    top = await redis_client.zrevrange(dest, 0, n - 1, withscores=True)
+
+    if not top:
+        weights = _window_weights(window, time.time() if now is None else now)
+        async with redis_client.pipeline() as pipe:
+            pipe.zunionstore(dest, weights, aggregate="SUM")
+            pipe.expire(dest, settings.TRENDING_WINDOW_CACHE_SECONDS)
+            pipe.zrevrange(dest, 0, n - 1, withscores=True)
+            *_, top = await pipe.execute()
+
+    return [{"keyword": k, "count": round(v)} for k, v in top]
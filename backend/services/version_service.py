@@ -0,0 +1,34 @@
+"""
+資料寫入版本號
+
+- data_version:global             任何訊息寫入 / 刪除 / 復原都會遞增
+- data_version:session:{id}       該會話的訊息有變動時遞增
+
+快取（搜尋結果等）記下產生時的版本號，讀取時只需比對一次版本即可判斷是否仍有效。
+"""
+from typing import Dict, Iterable
+import redis.asyncio as redis
+
+GLOBAL_VERSION_KEY = "data_version:global"
+
+
+def session_version_key(session_id: str) -> str:
+    return f"data_version:session:{session_id}"
+
+
+def bump_versions(pipe, session_id: str) -> None:
+    """遞增全域與會話版本號（加入 pipeline，不執行）"""
+    pipe.incr(GLOBAL_VERSION_KEY)
+    pipe.incr(session_version_key(session_id))
+
+
+async def get_global_version(redis_client: redis.Redis) -> int:
+    return int(await redis_client.get(GLOBAL_VERSION_KEY) or 0)
+
+
+async def get_session_versions(redis_client: redis.Redis, session_ids: Iterable[str]) -> Dict[str, int]:
+    session_ids = list(session_ids)
+    if not session_ids:
+        return {}
+    values = await redis_client.mget([session_version_key(sid) for sid in session_ids])
+    return {sid: int(v or 0) for sid, v in zip(session_ids, values)}
@@ -0,0 +1,83 @@
+"""
+訊息編碼基準測試（python manage.py benchmark-codec）
+
+比較舊格式（json.dumps）與 utils/message_codec.py 各種格式的
+平均每則訊息大小與編碼 / 解碼吞吐量。
+"""
+import json
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from utils import message_codec
+
+_USER_PHRASES = ["請問", "這個功能", "要怎麼設定", "謝謝", "Redis 的記憶體用量", "可以幫我整理一下嗎", "今天的會議紀錄"]
+_AI_SENTENCES = [
+    "首先，我們需要確認目前的資料結構與存取模式。",
+    "根據您提供的資訊，建議將熱資料與冷資料分開儲存。",
+    "以下是具體的步驟：一、盤點現有的 key；二、估算每種結構的大小；三、設定合理的過期時間。",
+    "If you are using Redis Stack, RediSearch can index hash fields directly.",
+    "此外，也可以考慮對較長的內容進行壓縮，以降低記憶體成本。",
+    "總結來說，這個做法在大部分情況下都能帶來明顯的效益。",
+]
+
+
+def sample_messages(count: int = 1000, seed: int = 42) -> List[Dict[str, Any]]:
+    """產生一組模擬訊息：約一半是簡短的使用者訊息，一半是長度不一的 AI 回覆（最長約 800 tokens）"""
+    rng = random.Random(seed)
+    base_ts = 1_700_000_000_000
+    messages = []
+    for i in range(count):
+        if i % 2 == 0:
+            content = "".join(rng.choice(_USER_PHRASES) for _ in range(rng.randint(1, 4)))
+            sender = "me"
+        else:
+            content = "".join(rng.choice(_AI_SENTENCES) for _ in range(rng.randint(2, 40)))
+            sender = "AI"
+        messages.append({"session_id": f"session-{i % 20}", "sender": sender, "content": content, "ts": base_ts + i})
+    return messages
+
+
+def _formats() -> Dict[str, Callable[[Dict[str, Any]], str]]:
+    formats: Dict[str, Callable[[Dict[str, Any]], str]] = {
+        "legacy json.dumps": json.dumps,
+        "1j compact json": lambda m: message_codec.encode(m, compression="none"),
+        "1z zlib": lambda m: message_codec.encode(m, compression="zlib"),
+    }
+    if message_codec.zstandard is not None:
+        formats["1s zstd"] = lambda m: message_codec.encode(m, compression="zstd")
+    return formats
+
+
+def run_benchmark(messages: Optional[List[Dict[str, Any]]] = None, rounds: int = 5) -> List[Dict[str, Any]]:
+    """回傳各格式的 bytes/msg 與每秒編碼 / 解碼則數，並印出表格"""
+    messages = messages if messages is not None else sample_messages()
+    results = []
+
+    for name, encode in _formats().items():
+        encoded = [encode(m) for m in messages]
+        size = sum(len(e.encode("utf-8")) for e in encoded) / len(messages)
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for m in messages:
+                encode(m)
+        encode_rate = rounds * len(messages) / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for e in encoded:
+                message_codec.decode(e)
+        decode_rate = rounds * len(messages) / (time.perf_counter() - start)
+
+        results.append({"format": name, "bytes_per_msg": size, "encode_per_sec": encode_rate, "decode_per_sec": decode_rate})
+
+    baseline = results[0]["bytes_per_msg"]
+    print(f"📊 {len(messages)} 則訊息，{rounds} 輪（orjson={'yes' if message_codec.orjson else 'no'}）")
+    print(f"{'format':<20}{'bytes/msg':>12}{'vs legacy':>11}{'encode/s':>12}{'decode/s':>12}")
+    for r in results:
+        print(
+            f"{r['format']:<20}{r['bytes_per_msg']:>12.1f}{r['bytes_per_msg'] / baseline:>10.0%}"
+            f"{r['encode_per_sec']:>12,.0f}{r['decode_per_sec']:>12,.0f}"
+        )
+    return results
@@ -0,0 +1,101 @@
+"""
+訊息編碼（訊息本文 / 刪除紀錄在 Redis 中的儲存格式）
+
+格式以前綴區分版本，讀取時自動判斷：
+- "{..."          舊格式：json.dumps（預設 ensure_ascii，中文會變成 \\uXXXX，佔 6 bytes/字）
+- "1j:{..."       精簡 JSON：不跳脫非 ASCII、去除多餘空白（中文 3 bytes/字）
+- "1z:<base64>"   zlib 壓縮後的精簡 JSON
+- "1s:<base64>"   zstd 壓縮後的精簡 JSON（需安裝 zstandard）
+
+連線使用 decode_responses=True，值必須是合法 UTF-8 字串，因此壓縮結果以 base64 保存；
+只有超過 MESSAGE_COMPRESS_THRESHOLD bytes 且壓縮後確實較小時才使用壓縮格式（主要是長的 AI 回覆）。
+有安裝 orjson 時用來加速 JSON 編解碼，輸出格式相同。
+"""
+import base64
+import json
+import zlib
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from config import settings
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - 選用相依套件
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - 選用相依套件
+    zstandard = None
+
+PREFIX_JSON = "1j:"
+PREFIX_ZLIB = "1z:"
+PREFIX_ZSTD = "1s:"
+
+
+def _dumps(data: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _loads(raw: Any) -> Dict[str, Any]:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _zstd_compress(payload: bytes) -> bytes:
+    return zstandard.ZstdCompressor(level=3).compress(payload)
+
+
+def _zstd_decompress(payload: bytes) -> bytes:
+    return zstandard.ZstdDecompressor().decompress(payload)
+
+
+def _compressor(name: str) -> Optional[Tuple[str, Callable[[bytes], bytes]]]:
+    if name == "zstd" and zstandard is not None:
+        return PREFIX_ZSTD, _zstd_compress
+    if name in ("zlib", "zstd"):
+        # 沒有安裝 zstandard 時退回 zlib
+        return PREFIX_ZLIB, lambda payload: zlib.compress(payload, 6)
+    return None
+
+
+_DECOMPRESSORS: Dict[str, Callable[[bytes], bytes]] = {
+    PREFIX_ZLIB: zlib.decompress,
+    PREFIX_ZSTD: _zstd_decompress,
+}
+
+
+def encode(data: Dict[str, Any], compression: Optional[str] = None, threshold: Optional[int] = None) -> str:
+    """編碼為儲存用字串（compression / threshold 預設取自設定）"""
+    compression = settings.MESSAGE_CODEC_COMPRESSION if compression is None else compression
+    threshold = settings.MESSAGE_COMPRESS_THRESHOLD if threshold is None else threshold
+
+    payload = _dumps(data)
+    if len(payload) >= threshold:
+        compressor = _compressor(compression)
+        if compressor is not None:
+            prefix, compress = compressor
+            packed = base64.b64encode(compress(payload)).decode("ascii")
+            if len(packed) + len(prefix) < len(payload):
+                return prefix + packed
+    return PREFIX_JSON + payload.decode("utf-8")
+
+
+def decode(raw: Any) -> Optional[Dict[str, Any]]:
+    """解碼任一版本的儲存格式（含舊的 json.dumps 字串）"""
+    if raw is None:
+        return None
+    if isinstance(raw, bytes):
+        raw = raw.decode("utf-8")
+
+    prefix = raw[:3]
+    if prefix == PREFIX_JSON:
+        return _loads(raw[3:])
+    if prefix in _DECOMPRESSORS:
+        if prefix == PREFIX_ZSTD and zstandard is None:
+            raise RuntimeError("Message is zstd-compressed but zstandard is not installed")
+        return _loads(_DECOMPRESSORS[prefix](base64.b64decode(raw[3:])))
+    return json.loads(raw)
@@ -0,0 +1,115 @@
+"""
+模擬 Azure OpenAI 部署的本機 HTTP 伺服器（python manage.py mock-ai）
+
+在沒有真實部署時測試多部署路由、熔斷與對沖請求，例如啟動一快一慢兩個部署：
+    python manage.py mock-ai --port 9001 --name fast --latency-ms 200
+    python manage.py mock-ai --port 9002 --name slow --latency-ms 2000 --error-rate 0.3 --error-status 429 --retry-after 2
+再設定
+    AI_DEPLOYMENTS='[{"name": "fast", "endpoint": "http://127.0.0.1:9001/"},
+                     {"name": "slow", "endpoint": "http://127.0.0.1:9002/"}]'
+
+支援 POST /openai/deployments/{deployment}/chat/completions（stream=true 時以 SSE 分段回傳），
+回覆內容為最後一則使用者訊息的回聲；第一個 token 之前等待 latency_ms（加上隨機抖動），
+依 error_rate 回傳 error_status（可附 Retry-After）。GET /openai/models 供啟動預熱使用，
+GET /stats 回傳請求與錯誤數。
+"""
+import asyncio
+import json
+import random
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+CHUNK_CHARS = 4
+
+
+def create_app(
+    name: str = "mock",
+    latency_ms: int = 200,
+    jitter_ms: int = 50,
+    token_delay_ms: int = 20,
+    error_rate: float = 0.0,
+    error_status: int = 429,
+    retry_after: Optional[float] = None,
+) -> FastAPI:
+    app = FastAPI(title=f"Mock Azure OpenAI ({name})")
+    counters = {"requests": 0, "errors": 0, "streams": 0, "prewarms": 0}
+
+    def reply_text(body: Dict[str, Any]) -> str:
+        user_messages = [m for m in body.get("messages", []) if m.get("role") == "user"]
+        prompt = str(user_messages[-1].get("content", "")) if user_messages else ""
+        return f"[{name}] 收到：{prompt[:200]}"
+
+    def chunk(completion_id: str, model: str, delta: Dict[str, Any], finish_reason: Optional[str]) -> str:
+        payload = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    async def stream_reply(completion_id: str, model: str, text: str) -> AsyncIterator[str]:
+        yield chunk(completion_id, model, {"role": "assistant", "content": ""}, None)
+        for i in range(0, len(text), CHUNK_CHARS):
+            yield chunk(completion_id, model, {"content": text[i:i + CHUNK_CHARS]}, None)
+            await asyncio.sleep(token_delay_ms / 1000)
+        yield chunk(completion_id, model, {}, "stop")
+        yield "data: [DONE]\n\n"
+
+    @app.post("/openai/deployments/{deployment}/chat/completions")
+    async def chat_completions(deployment: str, request: Request):
+        counters["requests"] += 1
+        body = await request.json()
+        await asyncio.sleep(max(0.0, latency_ms + random.uniform(-jitter_ms, jitter_ms)) / 1000)
+
+        if random.random() < error_rate:
+            counters["errors"] += 1
+            headers = {"retry-after": str(retry_after)} if retry_after is not None else {}
+            return JSONResponse(
+                {"error": {"code": str(error_status), "message": f"Mock error from {name}"}},
+                status_code=error_status,
+                headers=headers,
+            )
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        text = reply_text(body)
+        if body.get("stream"):
+            counters["streams"] += 1
+            return StreamingResponse(stream_reply(completion_id, deployment, text), media_type="text/event-stream")
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": deployment,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+
+    @app.get("/openai/models")
+    async def list_models():
+        # 主程式啟動時以此預熱連線
+        counters["prewarms"] += 1
+        return {"object": "list", "data": [{"id": name, "object": "model"}]}
+
+    @app.get("/stats")
+    async def stats():
+        return {"name": name, **counters}
+
+    return app
+
+
+async def serve(port: int, host: str = "127.0.0.1", **options: Any) -> None:
+    import uvicorn
+
+    print(f"🧪 Mock Azure OpenAI '{options.get('name', 'mock')}' listening on http://{host}:{port}/")
+    server = uvicorn.Server(uvicorn.Config(create_app(**options), host=host, port=port, log_level="warning"))
+    await server.serve()
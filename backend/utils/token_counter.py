@@ -0,0 +1,66 @@
+"""
+token 數估算（組裝 AI 對話上下文時控制提示長度用）
+
+有安裝 tiktoken 且 AI_TOKENIZER=auto 時使用模型對應的編碼精確計算；
+否則以字元估算：CJK 字元（含全形標點）每字 1 token，其他字元每 4 個 1 token。
+估算值對中文偏高、對英文接近實際，用於預算控制時寧可少放一點上下文。
+"""
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+from config import settings
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - 選用相依套件
+    tiktoken = None
+
+# 每則訊息的格式開銷（role、分隔符號）
+MESSAGE_OVERHEAD = 4
+
+
+def _is_cjk(ch: str) -> bool:
+    code = ord(ch)
+    return (
+        0x3000 <= code <= 0x9FFF      # CJK 標點、假名、部首、統一漢字
+        or 0xAC00 <= code <= 0xD7AF   # 韓文音節
+        or 0xF900 <= code <= 0xFAFF   # 相容漢字
+        or 0xFF00 <= code <= 0xFFEF   # 全形字元
+        or 0x20000 <= code <= 0x2FFFF # 擴充漢字
+    )
+
+
+@lru_cache(maxsize=1)
+def _encoding() -> Optional[Any]:
+    if tiktoken is None or settings.AI_TOKENIZER != "auto":
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(settings.AZURE_OPENAI_MODEL)
+        except KeyError:
+            # Azure 的部署名稱不一定是模型名稱
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # 編碼檔需要下載，離線環境改用估算
+        print(f"WARNING: tiktoken unavailable, falling back to heuristic token counts: {e}")
+        return None
+
+
+def estimate_heuristic(text: str) -> int:
+    cjk = sum(1 for ch in text if _is_cjk(ch))
+    other = len(text) - cjk
+    return cjk + (other + 3) // 4
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = _encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return estimate_heuristic(text)
+
+
+def count_message_tokens(message: Dict[str, Any]) -> int:
+    """一則 chat completion 訊息（{"role", "content"}）的 token 數"""
+    return count_tokens(str(message.get("content") or "")) + MESSAGE_OVERHEAD
@@ -0,0 +1,82 @@
+"""
+文字切詞工具（供搜尋索引與熱門關鍵詞使用）
+- 中日韓文字：以字元 unigram + bigram 切分（不需要詞典，適合中文為主的內容）
+- 拉丁字母 / 數字：以連續字元為一個單字，統一轉小寫
+"""
+import re
+import unicodedata
+from typing import List, Set
+
+# 中日韓字元範圍：平假名/片假名、CJK 擴充 A、CJK 統一表意文字、韓文音節、CJK 相容表意文字
+_CJK_CHARS = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_TOKEN_RE = re.compile(rf"[{_CJK_CHARS}]+|[a-z0-9]+")
+_CJK_RE = re.compile(rf"[{_CJK_CHARS}]")
+
+
+def normalize_text(text: str) -> str:
+    """NFKC 正規化（全形轉半形）並轉小寫"""
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+
+def _is_cjk_run(run: str) -> bool:
+    return bool(_CJK_RE.match(run))
+
+
+def _bigrams(run: str) -> List[str]:
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+def tokenize(text: str) -> Set[str]:
+    """
+    將訊息內容切成索引詞。
+    中文片段同時輸出 unigram 與 bigram，讓單字查詢與多字查詢都能命中。
+    """
+    terms: Set[str] = set()
+    for run in _TOKEN_RE.findall(normalize_text(text)):
+        if _is_cjk_run(run):
+            terms.update(run)
+            terms.update(_bigrams(run))
+        else:
+            terms.add(run)
+    return terms
+
+
+def query_terms(query: str) -> List[str]:
+    """
+    將查詢字串切成要取交集的索引詞。
+    長度 >= 2 的中文片段只取 bigram（其 unigram 不會再縮小結果集）。
+    """
+    terms: Set[str] = set()
+    for run in _TOKEN_RE.findall(normalize_text(query)):
+        if _is_cjk_run(run) and len(run) > 1:
+            terms.update(_bigrams(run))
+        else:
+            terms.add(run)
+    return sorted(terms)
+
+
+# 熱門關鍵詞用的停用詞：含有這些虛字的中文 bigram 多半不是有意義的詞
+_CJK_STOP_CHARS = set("的了是在我你他她它們嗎呢吧啊呀喔哦和與及就都也還這那有個不很要會讓把被給對於麼")
+_CJK_STOP_BIGRAMS = {"什麼", "怎麼", "為什", "可以", "知道", "一下", "請問", "謝謝", "如何", "因為", "所以", "但是", "如果", "已經"}
+_LATIN_STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "can", "do", "for", "from",
+    "have", "how", "i", "if", "in", "is", "it", "me", "my", "no", "not", "of", "on",
+    "or", "so", "that", "the", "this", "to", "was", "we", "what", "with", "you", "your",
+}
+
+
+def extract_keywords(text: str) -> List[str]:
+    """
+    擷取熱門關鍵詞候選：中文 bigram + 拉丁單字，移除停用詞與純數字，
+    同一則訊息內重複出現的詞只計一次。
+    """
+    keywords: Set[str] = set()
+    for run in _TOKEN_RE.findall(normalize_text(text)):
+        if _is_cjk_run(run):
+            keywords.update(
+                b for b in _bigrams(run)
+                if b not in _CJK_STOP_BIGRAMS and not (set(b) & _CJK_STOP_CHARS)
+            )
+        elif len(run) > 1 and not run.isdigit() and run not in _LATIN_STOPWORDS:
+            keywords.add(run)
+    return sorted(keywords)
@@ -181,13 +181,30 @@ async function fetchDeletedHistory(sid: string) {
     
     ws.onmessage = (e) => {
       const data = JSON.parse(e.data);
-      
+
+      // AI 回覆串流：ai_start 建立空白訊息，ai_delta 逐段附加；完成後會再收到完整訊息（同一個 ts）
+      if (data.type === "ai_start") {
+        setIsAITyping(false);
+        setMessages(msgs => [...(msgs || []), { sender: "AI", content: "", ts: data.ts }]);
+        return;
+      }
+      if (data.type === "ai_delta") {
+        setMessages(msgs => msgs.map(m =>
+          m.sender === "AI" && m.ts === data.ts ? { ...m, content: m.content + data.delta } : m
+        ));
+        return;
+      }
+
       if (data.sender === "AI") {
         setIsAITyping(false);
       }
       
       setMessages(msgs => {
         if (msgs.some(m => m.ts === data.ts && m.content === data.content && m.sender === data.sender)) return msgs;
+        // 完整的 AI 回覆取代串流中的同 ts 訊息
+        if (data.sender === "AI" && msgs.some(m => m.sender === "AI" && m.ts === data.ts)) {
+          return msgs.map(m => (m.sender === "AI" && m.ts === data.ts ? data : m));
+        }
         return [...(msgs || []), data];
       });
     };
@@ -205,17 +222,30 @@ async function fetchDeletedHistory(sid: string) {
   }, [messages, isAITyping]);
 
   // 新增會話
-    useEffect(() => {
-    fetch(`${API_BASE_URL}/sessions/`)
-      .then(res => res.json())
-      .then((data) => {
-        // data 形狀是 [{ session_id, title, created_at, message_count }, ...]
-        setSessions(data.map((s: { session_id: string }) => s.session_id));
-      })
-      .catch(err => {
+  // 會話列表分頁回傳，依 X-Next-Cursor 標頭逐頁載入，直到沒有下一頁
+  useEffect(() => {
+    let cancelled = false;
+    async function loadSessions() {
+      const ids: SessionId[] = [];
+      let cursor: string | null = null;
+      try {
+        do {
+          const query: string = cursor ? `?cursor=${encodeURIComponent(cursor)}` : "";
+          const res: Response = await fetch(`${API_BASE_URL}/sessions/${query}`);
+          // data 形狀是 [{ session_id, title, created_at, message_count, ... }, ...]
+          const data: { session_id: string }[] = await res.json();
+          ids.push(...data.map(s => s.session_id));
+          cursor = res.headers.get("X-Next-Cursor");
+        } while (cursor && !cancelled);
+      } catch (err) {
         console.error("載入會話列表失敗:", err);
-        setSessions([]);
-      });
+      }
+      if (!cancelled) setSessions(ids);
+    }
+    loadSessions();
+    return () => {
+      cancelled = true;
+    };
   }, []);
 
   // 詢問刪除會話